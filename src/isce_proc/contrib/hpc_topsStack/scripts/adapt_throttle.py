@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+############################################################
+# Adapt the throttle (%max_task) of the running topsStack job arrays to the file-system load
+#
+# This script is executed under run_files/, e.g. on the login node after submit_chained_dependencies.sh:
+#   nohup python adapt_throttle.py > adapt_throttle.log 2>&1 &
+############################################################
+# The `batch` column of resources.cfg sets a static throttle; too low wastes the allocation, too high and
+# the tasks get stuck on the shared file system. Here the throttle of each active array is adjusted at runtime
+# with additive-increase / multiplicative-decrease (AIMD), from two signals polled every interval:
+#   + file-system latency: time to create, write, fsync, stat and remove a small probe file in the processing dir
+#   + progress rate:       array tasks finished per minute (from squeue)
+# Decrease (x beta) when the latency goes above its threshold, or when the last increase made the progress slower;
+# increase (+ step) when the throttle is what limits the array (pending tasks and all slots in use).
+# The slurm commands can be taken from another dir (--slurm-bin), e.g. stand-in scripts for testing
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# probe file written in the processing dir to measure the file-system latency
+PROBE_SIZE = 4096  # bytes
+
+# an increase did not pay off if the progress rate after it is below this fraction of the rate before it
+RATE_TOL = 0.9
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Adapt the array throttle of the running topsStack jobs to the file-system load (AIMD)'
+
+    EXAMPLE = f"""Examples:
+        # watch the jobs of the latest job_id_logfile_*.txt every 2 min
+        {os.path.basename(__file__)} --interval 120
+
+        # given job IDs, throttle between 16 and 400, only print the scontrol commands
+        {os.path.basename(__file__)} -j 123456 123457 --min 16 --max 400 --dry-run
+
+        # dry run against the stand-in slurm commands of scripts/fake_slurm/ (a simulated chain of job arrays),
+        # in an empty dir; remove fake_slurm_state.json to start over
+        {os.path.basename(__file__)} --slurm-bin path/to/scripts/fake_slurm -j 1001 1002 --interval 1 --iterations 10 --probe-dir . --dry-run
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('-j', '--jobs', dest='job_ids', type=str, nargs='+',
+                        help = 'job IDs to control (default: read from the latest job_id_logfile_*.txt)')
+    parser.add_argument('--interval', dest='interval', type=float, default=60,
+                        help = 'seconds between two polls (default: %(default)s)')
+    parser.add_argument('--iterations', dest='iterations', type=int, default=0,
+                        help = 'stop after this many polls, 0 to run until no job is left (default: %(default)s)')
+    parser.add_argument('--min', dest='min_task', type=int, default=8,
+                        help = 'lowest throttle (default: %(default)s)')
+    parser.add_argument('--max', dest='max_task', type=int, default=400,
+                        help = 'highest throttle (default: %(default)s)')
+    parser.add_argument('--step', dest='step', type=int, default=8,
+                        help = 'additive increase of the throttle (default: %(default)s)')
+    parser.add_argument('--beta', dest='beta', type=float, default=0.5,
+                        help = 'multiplicative decrease of the throttle (default: %(default)s)')
+    parser.add_argument('--probe-dir', dest='probe_dir', type=str, default='..',
+                        help = 'dir on the file system to probe, i.e. the processing dir (default: %(default)s)')
+    parser.add_argument('--lat-max', dest='lat_max', type=float, default=None,
+                        help = 'probe latency (sec) above which to decrease the throttle\n'
+                               '(default: --lat-factor x the lowest latency seen)')
+    parser.add_argument('--lat-factor', dest='lat_factor', type=float, default=5,
+                        help = 'latency threshold relative to the lowest latency seen (default: %(default)s)')
+    parser.add_argument('--slurm-bin', dest='slurm_bin', type=str, default='',
+                        help = 'dir of the slurm commands squeue/scontrol (default: from $PATH)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help = 'print the scontrol update commands instead of running them')
+    return parser
+
+
+#########################################################################################
+
+def slurm_cmd(args, slurm_bin=''):
+    """Run a slurm command and return its stdout
+    """
+    args = [os.path.join(slurm_bin, args[0])] + args[1:] if slurm_bin else args
+    if slurm_bin and not os.path.isfile(args[0]):
+        raise Exception(f'{os.path.basename(args[0])} not found in --slurm-bin {slurm_bin}')
+    proc = subprocess.run(args, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f' {" ".join(args)} failed: {proc.stderr.strip()}')
+    return proc.stdout
+
+
+def read_job_ids(id_logfile=None):
+    """Read the job IDs from the job_id_logfile written by submit_chained_dependencies.sh
+    """
+    if not id_logfile:
+        id_logfiles = sorted(glob.glob('job_id_logfile_*.txt'), key=os.path.getmtime)
+        if not id_logfiles:
+            raise Exception('No job_id_logfile_*.txt found, give the job IDs with -j')
+        id_logfile = id_logfiles[-1]
+    job_ids = []
+    with open(id_logfile) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) == 2 and tokens[1].isdigit():
+                job_ids.append(tokens[1])
+    print(f'read {len(job_ids)} job IDs from {id_logfile}')
+    return job_ids
+
+
+def probe_latency(probe_dir, nprobe=3):
+    """Median time (sec) to create, write, fsync, stat and remove a small file in probe_dir
+    """
+    probe_file = os.path.join(probe_dir, f'.throttle_probe.{os.getpid()}')
+    data = b'0' * PROBE_SIZE
+    lats = []
+    for i in range(nprobe):
+        t0 = time.perf_counter()
+        fd = os.open(probe_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        os.write(fd, data)
+        os.fsync(fd)
+        os.close(fd)
+        os.stat(probe_file)
+        os.remove(probe_file)
+        lats.append(time.perf_counter() - t0)
+    return statistics.median(lats)
+
+
+def query_tasks(job_ids, slurm_bin=''):
+    """Number of running and pending array tasks of each job
+    Return:
+        tasks:  dict of {job ID: [running, pending]}, for the jobs still in the queue
+    """
+    out = slurm_cmd(['squeue', '-h', '-r', '-j', ','.join(job_ids), '-o', '%i %T'], slurm_bin)
+    tasks = {}
+    for line in out.splitlines():
+        tokens = line.split()
+        if len(tokens) < 2:
+            continue
+        job_id = tokens[0].split('_')[0]
+        count = tasks.setdefault(job_id, [0, 0])
+        if tokens[1] == 'RUNNING':
+            count[0] += 1
+        elif tokens[1] == 'PENDING':
+            count[1] += 1
+    return tasks
+
+
+def get_throttle(job_id, slurm_bin=''):
+    """Current ArrayTaskThrottle of a job array, 0 if not set
+    """
+    out = slurm_cmd(['scontrol', 'show', 'job', job_id], slurm_bin)
+    for token in out.split():
+        if token.startswith('ArrayTaskThrottle='):
+            return int(token.split('=')[1])
+    return 0
+
+
+def set_throttle(job_id, throttle, slurm_bin='', dry_run=False):
+    """Update the ArrayTaskThrottle of a job array
+    """
+    args = ['scontrol', 'update', f'JobId={job_id}', f'ArrayTaskThrottle={throttle}']
+    if dry_run:
+        print(' (dry-run) ' + ' '.join(args))
+    else:
+        slurm_cmd(args, slurm_bin)
+
+
+def aimd(throttle, running, pending, latency, lat_max, rate, prev_rate, increased,
+         min_task=8, max_task=400, step=8, beta=0.5):
+    """New throttle of one job array
+    Return:
+        throttle:   new throttle
+        action:     'decrease', 'increase' or 'keep'
+    """
+    if latency > lat_max or (increased and prev_rate is not None and rate < RATE_TOL * prev_rate):
+        # file system congested, or the last increase did not pay off
+        new = max(min_task, int(throttle * beta))
+        return new, 'decrease' if new < throttle else 'keep'
+    if pending > 0 and running >= throttle:
+        # the throttle is what limits the array
+        new = min(max_task, throttle + step)
+        return new, 'increase' if new > throttle else 'keep'
+    return throttle, 'keep'
+
+
+def run_controller(inps):
+    """Poll the jobs and adapt their throttle until no job is left
+    """
+    job_ids = inps.job_ids or read_job_ids()
+    lat_min = None
+    prev = {}   # job ID -> (remaining tasks, rate, increased)
+    fmt = '{:<22s}{:<12s}{:<10s}{:<10s}{:<10s}{:<12s}{:<10s}{}'
+    print(fmt.format('Time', 'Job ID', 'Running', 'Pending', 'Throttle', 'Rate/min', 'Latency', 'Action'))
+
+    iteration = 0
+    t_prev = time.time()
+    while True:
+        iteration += 1
+        latency = probe_latency(inps.probe_dir)
+        lat_min = latency if lat_min is None else min(lat_min, latency)
+        lat_max = inps.lat_max if inps.lat_max else inps.lat_factor * lat_min
+
+        t_now = time.time()
+        tasks = query_tasks(job_ids, inps.slurm_bin)
+        if not tasks:
+            print('no job left in the queue, stop.')
+            break
+
+        for job_id, (running, pending) in tasks.items():
+            remaining = running + pending
+            remaining0, prev_rate, increased = prev.get(job_id, (None, None, False))
+            rate = (remaining0 - remaining) / (t_now - t_prev) * 60 if remaining0 is not None else None
+
+            action = 'keep'
+            throttle = get_throttle(job_id, inps.slurm_bin)
+            if running > 0 and throttle > 0 and rate is not None:
+                new, action = aimd(throttle, running, pending, latency, lat_max, rate, prev_rate, increased,
+                                   inps.min_task, inps.max_task, inps.step, inps.beta)
+                if new != throttle:
+                    set_throttle(job_id, new, inps.slurm_bin, inps.dry_run)
+                    throttle = new
+            prev[job_id] = (remaining, rate, action == 'increase')
+
+            print(fmt.format(time.strftime('%Y-%m-%d %H:%M:%S'), job_id, str(running), str(pending), str(throttle),
+                             f'{rate:.2f}' if rate is not None else '-', f'{latency:.3f}s', action))
+        sys.stdout.flush()
+
+        t_prev = t_now
+        if inps.iterations and iteration >= inps.iterations:
+            break
+        time.sleep(inps.interval)
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    run_controller(inps)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
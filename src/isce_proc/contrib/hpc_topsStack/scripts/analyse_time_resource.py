@@ -7,7 +7,13 @@
 # + Addtional function to guage your job’s resource used with sacct
 # + Codes are written for Caltech HPC
 
+import argparse
+import glob
 import os
+import subprocess
+import sys
+import tempfile
+import time
 import pandas as pd
 import numpy as np
 from datetime import datetime, timezone, timedelta
@@ -15,6 +21,26 @@ from pytz import timezone as ptimezone
 import matplotlib.pyplot as plt
 import math
 
+from write_slurmJobs import read_fused_steps, add_fused_rows, rsc_step, line_key, FUSE_FILE
+
+
+# Caltech Resnick HPC rate: fee per compute unit (1 CPU core hour = 1 unit, 1 GPU hour = GPU_UNITS units)
+COST_RATE = 0.008
+GPU_UNITS = 10
+
+# sacct fields of each job allocation / array task / job step, queried once for all the jobs
+SACCT_FIELDS = ['JobID', 'JobName', 'NodeList', 'ReqMem', 'MaxRSS', 'MaxVMSize', 'AveRSS', 'AveVMSize', 'Elapsed', 'State']
+
+# queue wait: sacct fields of the times of each array task
+QUEUE_FIELDS = ['JobID', 'Submit', 'Eligible', 'Start', 'End', 'State']
+
+# stragglers: array tasks with a robust z-score (from the median and MAD of their step) above ROBUST_Z in elapsed time
+# or MaxRSS. Slow nodes: median slowdown (elapsed / median of the step) of their tasks above SLOW_NODE_RATIO,
+# over at least MIN_NODE_TASKS tasks
+ROBUST_Z        = 3.5
+SLOW_NODE_RATIO = 1.5
+MIN_NODE_TASKS  = 3
+
 
 #############################################
 ########      Utility functions    ##########
@@ -35,10 +61,17 @@ def format_timedeltas(seconds, digits=1):
     return out
 
 
+def format_timedelta_series(td):
+    ''' Format a Series of timedeltas as H:MM:SS (rounded to seconds, NaT as 0:00:00)'''
+    sec = td.dt.total_seconds().fillna(0).round().astype(int)
+    return (sec // 3600).astype(str) + ':' + ((sec // 60) % 60).astype(str).str.zfill(2) + ':' + (sec % 60).astype(str).str.zfill(2)
+
+
 def convert_size(size_in):
     '''Convert string to formatted-size string and total bytes
     '''
     size_name = ["B", "K", "M", "G", "T", "P", "E", "Z", "Y"]
+    size_bytes = size_in
     if type(size_in) == str:
         for i, x in enumerate(size_name):
             if x in size_in:
@@ -58,6 +91,21 @@ def convert_size(size_in):
     return f'{s:.2f}{size_name[i]:s}', size_bytes
 
 
+def read_time_table(infile):
+    '''
+    Read the per-task records from time_unix.txt, one row per array element
+    + Start/Finish as datetime, Elapsed as timedelta
+    '''
+    # Pandas DF saving time and jobID info
+    df = pd.read_table(infile, names=['Step','Job ID','Slurm array','Start','Finish','Elapsed'], sep=r'\s+', comment='#')
+
+    # Convert unix timestamps to datetime objects
+    df['Start']     = pd.to_datetime(df['Start'],unit='s')
+    df['Finish']    = pd.to_datetime(df['Finish'],unit='s')
+    df['Elapsed']   = pd.to_timedelta(df['Elapsed'],unit='s')
+    return df
+
+
 def read_time_unix(infile):
     '''
     Read time info from time_unit.txt
@@ -73,57 +121,20 @@ def read_time_unix(infile):
     sub_time = pd.to_datetime(sub_time, unit='s')
 
     # Pandas DF saving time and jobID info
-    df = pd.read_table(infile, names=['Step','Job ID','Slurm array','Start','Finish','Elapsed'], sep=r'\s+', comment='#')
-
-    # Convert unix timestamps to datetime objects
-    df['Start']     = pd.to_datetime(df['Start'],unit='s')
-    df['Finish']    = pd.to_datetime(df['Finish'],unit='s')
-    df['Elapsed']   = pd.to_timedelta(df['Elapsed'],unit='s')
-
-    # Calculate the run time for each stage
-    stages           = df['Step'].unique()
-    stage_elapsed    = [] # elapse time
-    stage_std        = [] # time std
-    stage_mean       = [] # time mean; If mean + std is very different from elapsed that suggests lots of arrays have been queuing
-    stage_start      = [] # start time
-    stage_finish     = [] # end time
-    stage_queue_time = [] # queue time
-    stage_num_jobs   = [] # num of jobs in the array
-    job_ids          = [] # job id
-
-    for stage in stages:
-        stage_df = df.loc[df['Step']==stage]
-        num_jobs = len(stage_df.index)
-
-        # Get Job ID for each stage
-        job_ids.append(stage_df['Job ID'].unique()[0])
-
-        # Find the earliest start and latest finish for each stage
-        start = stage_df['Start'].min()
-        finish = stage_df['Finish'].max()
-        elapsed = finish - start
-        std = stage_df['Elapsed'].std()
-        mean = stage_df['Elapsed'].mean()
-
-        # Save
-        stage_elapsed.append(elapsed)
-        stage_start.append(start)
-        stage_finish.append(finish)
-        stage_std.append(std)
-        stage_mean.append(mean)
-        stage_num_jobs.append(num_jobs)
-
-    # Store summary data for each stage in a new dataframe
-    data = {'Step':stages,
-            'Start':stage_start,
-            'Finish':stage_finish,
-            'Total elapsed':stage_elapsed,
-            'Array mean':stage_mean,
-            'Array std':stage_std,
-            'Num jobs':stage_num_jobs,
-            'Job ID':job_ids
-            }
-    summary_df = pd.DataFrame(data)
+    df = read_time_table(infile)
+
+    # Summary of each stage, in the order of the table:
+    #  + earliest start and latest finish, mean and std of the array elements, num of elements, first job ID
+    #  + if mean + std is very different from elapsed that suggests lots of arrays have been queuing
+    summary_df = df.groupby('Step', sort=False).agg(**{
+        'Start'         :   ('Start',   'min'),
+        'Finish'        :   ('Finish',  'max'),
+        'Array mean'    :   ('Elapsed', 'mean'),
+        'Array std'     :   ('Elapsed', 'std'),
+        'Num jobs'      :   ('Elapsed', 'size'),
+        'Job ID'        :   ('Job ID',  'first'),
+    }).reset_index()
+    summary_df.insert(3, 'Total elapsed', summary_df['Finish'] - summary_df['Start'])
     return summary_df, sub_time
 
 
@@ -146,19 +157,19 @@ def write_simple_runtime(summary_df):
     return
 
 
-def estimate_cost(rsc_file, summary_df):
+def estimate_cost(rsc_file, summary_df, fused={}):
     """
     Estimates HPC cost by updating summary_df in-place.
-    Rate based on Caltech Resnick High Performance Computing Center rates (0.008 $/CPU unit).
+    Rate based on Caltech Resnick High Performance Computing Center rates (COST_RATE $/CPU unit).
     Minimalist error handling: checks for file existence and required columns only.
+    Fused steps (fused: {fused step: [member steps]}) get the resources of their job, from their member steps.
     """
-    rate = 0.008  # Fee per compute unit (1 CPU core hour = 1 computing unit)
-
     if not os.path.exists(rsc_file):
         raise FileNotFoundError(f"Resource file not found: {rsc_file}")
 
     # Read resource file and clean column names
     res_df = pd.read_table(rsc_file, header=0, sep=r'\s+').rename(columns=lambda x: x.replace('#', ''))
+    res_df = add_fused_rows(res_df, fused)
 
     # Essential column validation (without try-except)
     # These will raise KeyError if columns are missing
@@ -179,10 +190,19 @@ def estimate_cost(rsc_file, summary_df):
     else:
         res_df['Gres_count'] = 0 # If 'Gres' column doesn't exist, assume 0 GPUs
 
-    # Map resource info to summary_df based on 'Step'
+    # Packed steps (`pack` column as KxP) run P commands at once, each with Ncpus_per_task
+    if 'pack' in res_df.columns:
+        res_df['Ncpus_per_task'] *= (
+            res_df['pack'].astype(str).str.extract(r'x(\d+)', expand=False)
+            .astype(float)
+            .fillna(1)
+            .astype(int)
+        )
+
+    # Map resource info to summary_df based on 'Step' (the merge phase STEP_merge with the row of STEP)
     res_lookup = res_df.set_index('Step')
-    summary_df['Ncpus_per_task_rsc'] = summary_df['Step'].map(res_lookup['Ncpus_per_task'])
-    summary_df['Gres_count_rsc']     = summary_df['Step'].map(res_lookup['Gres_count'])
+    summary_df['Ncpus_per_task_rsc'] = summary_df['Step'].map(rsc_step).map(res_lookup['Ncpus_per_task'])
+    summary_df['Gres_count_rsc']     = summary_df['Step'].map(rsc_step).map(res_lookup['Gres_count'])
 
     # Identify rows that have all necessary data for calculation (from both DFs)
     # Using .notna() to handle NaNs introduced by .map() for unmatched steps
@@ -195,10 +215,10 @@ def estimate_cost(rsc_file, summary_df):
     # Convert timedelta to hours for calculable rows
     hours = summary_df.loc[calculable_mask, 'Array mean'].dt.total_seconds() / 3600
 
-    # Calculate CPU Units (10 CPU units per GPU hour) for calculable rows
+    # Calculate CPU Units (GPU_UNITS CPU units per GPU hour) for calculable rows
     cpu_units = (
         (summary_df.loc[calculable_mask, 'Ncpus_per_task_rsc'] +
-         summary_df.loc[calculable_mask, 'Gres_count_rsc'] * 10) *
+         summary_df.loc[calculable_mask, 'Gres_count_rsc'] * GPU_UNITS) *
         summary_df.loc[calculable_mask, 'Num jobs'] *
         hours
     )
@@ -213,7 +233,7 @@ def estimate_cost(rsc_file, summary_df):
     summary_df.loc[calculable_mask, 'CPUs']        = summary_df.loc[calculable_mask, 'Ncpus_per_task_rsc'].astype(int)
     summary_df.loc[calculable_mask, 'GPUs']        = summary_df.loc[calculable_mask, 'Gres_count_rsc'].astype(int)
     summary_df.loc[calculable_mask, 'CPU Units']   = cpu_units
-    summary_df.loc[calculable_mask, 'Cost ($)']    = cpu_units * rate
+    summary_df.loc[calculable_mask, 'Cost ($)']    = cpu_units * COST_RATE
 
     # Clean up temporary columns created for mapping
     summary_df.drop(columns=['Ncpus_per_task_rsc', 'Gres_count_rsc'], inplace=True)
@@ -243,68 +263,63 @@ def plot_timings(summary_df, pic_file='cpu_wall_time.pdf'):
     return
 
 
-def shorter_sacct_output(sacctfile, shortfile):
+def query_sacct(job_ids, fields=SACCT_FIELDS):
+    '''
+    Query sacct once for all the jobs (--parsable2), straight into a DataFrame of strings
+    + one row per job allocation / array task (e.g. 1234_5) and per job step (e.g. 1234_5.batch, 1234_5.0)
+    + added columns: Task (e.g. 1234_5), JobStep (e.g. batch, 0; empty for the allocation) and ArrayJob (e.g. 1234)
+    '''
+    cmd = ['sacct', '--parsable2', '--noheader', '-j', ','.join(str(x) for x in job_ids), '--format=' + ','.join(fields)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception(f'sacct failed: {proc.stderr.strip()}')
+    rows = [line.split('|', len(fields)-1) for line in proc.stdout.splitlines() if line.strip()]
+    df = pd.DataFrame(rows, columns=fields)
+    if 'JobID' in fields:
+        parts = df['JobID'].str.partition('.')
+        df['Task'], df['JobStep'] = parts[0], parts[2]
+        df['ArrayJob'] = df['Task'].str.partition('_')[0]
+    return df
+
+
+def mem2bytes(mem):
+    '''Memory strings of sacct (e.g. 123456K, 1.50G, 0) to bytes, over a Series; NaN if empty'''
+    parts = mem.astype(str).str.extract(r'^([\d.]+)([KMGTP]?)')
+    scale = parts[1].map({'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4, 'P': 1024**5})
+    return pd.to_numeric(parts[0], errors='coerce') * scale
+
+
+def robust_zscore(values, groups):
+    '''Robust z-score of each value within its group: 0.6745 * (x - median) / MAD, 0 if the MAD is 0'''
+    med = values.groupby(groups).transform('median')
+    mad = (values - med).abs().groupby(groups).transform('median')
+    return (0.6745 * (values - med) / mad.where(mad > 0)).fillna(0)
+
+
+def sacct_task_table(df):
     '''
-    Function to read from sacct output and condense the info to a new output .txt
-    Return the result table as an array
+    One row per array task from the sacct rows: ReqMem, Elapsed, State and NodeList of the allocation,
+    MaxRSS/AveRSS of its job step with the largest MaxRSS (srun steps .0, .1, ..., or .batch if the task has none)
     '''
-    df = pd.read_fwf(sacctfile, delim_whitespace=True, skiprows=[1])
-    df.rename(columns=lambda x: x.strip(), inplace=True)  # header trim whitespace
-    res = [list(df.columns.values)+['SizeBytes']]
-
-    job_id = None
-    method = 'srun'
-    for i, id_i in enumerate(df['JobID']):
-        # Get the relevant lines for header & memory
-        # Usage of sed, check: + https://stackoverflow.com/questions/1665549/have-sed-ignore-non-matching-lines
-        #                      + https://unix.stackexchange.com/questions/33157/what-is-the-purpose-of-e-in-sed-command
-        # For Slurm job steps: + https://stackoverflow.com/questions/52447602/slurm-sacct-shows-batch-and-extern-job-names
-        if '.' not in id_i:
-            if job_id: # change job in the job array, save the previous job
-                MaxRSS, sbytes = convert_size(MaxRSS)
-                MaxVMSize      = convert_size(MaxVMSize)[0]
-                AveRSS         = convert_size(AveRSS)[0]
-                AveVMSize      = convert_size(AveVMSize)[0]
-                if sbytes:
-                    row = [step_id,node,ReqMem,MaxRSS,MaxVMSize,AveRSS,AveVMSize,Elapsed,State,sbytes]
-                    row[:-1] = [s.strip() for s in row[:-1]]  # strip all the strings
-                    res.append(row)
-            job_id = id_i
-            ReqMem = df.loc[i,'ReqMem']
-        else:
-            if method == 'srun':
-                if id_i.split(job_id.strip())[-1] in [f'.{x}' for x in range(10)]:
-                    step_id, node, MaxRSS, MaxVMSize, AveRSS, AveVMSize, Elapsed, State =\
-                        df.loc[i,'JobID'], df.loc[i,'NodeList'], df.loc[i,'MaxRSS'], df.loc[i,'MaxVMSize'],\
-                        df.loc[i,'AveRSS'], df.loc[i,'AveVMSize'], df.loc[i,'Elapsed'], df.loc[i,'State']
-            else:
-                if id_i.split(job_id.strip())[-1] == '.batch':
-                    step_id, node, MaxRSS, MaxVMSize, AveRSS, AveVMSize, Elapsed, State =\
-                        df.loc[i,'JobID'], df.loc[i,'NodeList'], df.loc[i,'MaxRSS'], df.loc[i,'MaxVMSize'],\
-                        df.loc[i,'AveRSS'], df.loc[i,'AveVMSize'], df.loc[i,'Elapsed'], df.loc[i,'State']
-        # end of the job array, save the last job
-        if i == len(df)-1:
-            MaxRSS, sbytes = convert_size(MaxRSS)
-            MaxVMSize      = convert_size(MaxVMSize)[0]
-            AveRSS         = convert_size(AveRSS)[0]
-            AveVMSize      = convert_size(AveVMSize)[0]
-            if sbytes:
-                row = [step_id,node,ReqMem,MaxRSS,MaxVMSize,AveRSS,AveVMSize,Elapsed,State,sbytes]
-                row[:-1] = [s.strip() for s in row[:-1]]  # strip all the strings
-                res.append(row)
-
-    res = np.array(res)
-    with open(shortfile, 'w') as ofile:
-        fmt = '%16s %16s %8s %8s %10s %8s %10s %12s %12s'
-        np.savetxt(ofile, res[:,:-1], fmt=fmt)
-    return res
+    alloc = df[df['JobStep'] == ''].drop_duplicates('Task', keep='last').set_index('Task')
+    steps = df[~df['JobStep'].isin(['', 'extern'])].copy()
+    is_srun = steps['JobStep'].str.isdigit()
+    steps = steps[is_srun | ~steps['Task'].isin(steps.loc[is_srun, 'Task'])]
+    steps['MaxRSS_bytes'] = mem2bytes(steps['MaxRSS']).fillna(0)
+    steps['AveRSS_bytes'] = mem2bytes(steps['AveRSS']).fillna(0)
+
+    tasks = steps.loc[steps.groupby('Task')['MaxRSS_bytes'].idxmax()].set_index('Task')
+    tasks = tasks[['ArrayJob', 'JobID', 'MaxRSS_bytes', 'AveRSS_bytes']].rename(columns={'JobID': 'StepID'})
+    for col in ['ReqMem', 'Elapsed', 'State', 'NodeList']:
+        tasks[col] = tasks.index.map(alloc[col]) if col in alloc else ''
+    return tasks.reset_index()
 
 
 #############################################
 ########   Major analysis functions  ########
 #############################################
 
-def call_analyse_time(infile, rsc_file, pic_file, time_file):
+def call_analyse_time(infile, rsc_file, pic_file, time_file, fused={}):
     '''
     Major function to read and analyse timings and resources spent
     '''
@@ -330,7 +345,7 @@ def call_analyse_time(infile, rsc_file, pic_file, time_file):
 
 
     ## 3. Estimate the HPC cost
-    total_cost = estimate_cost(rsc_file, summary_df)
+    total_cost = estimate_cost(rsc_file, summary_df, fused)
 
     ## 4. Write & Print summaries
 
@@ -364,13 +379,8 @@ def call_analyse_time(infile, rsc_file, pic_file, time_file):
         f.write('\n')
 
     # Change formatting of timedeltas
-    for index, row in summary_df.iterrows():
-        summary_df.loc[index,'Array mean'] = format_timedeltas(row['Array mean'].seconds,digits=0)
-        # Replace NaTs with 0
-        if pd.isnull(row['Array std']):
-            summary_df.loc[index,'Array std'] = pd.Timedelta(0)
-        else:
-            summary_df.loc[index,'Array std'] = format_timedeltas(row['Array std'].seconds,digits=0)
+    summary_df['Array mean'] = format_timedelta_series(summary_df['Array mean'])
+    summary_df['Array std']  = format_timedelta_series(summary_df['Array std'])   # NaTs (single element) as 0
 
     # Write to formatted table
     use_cols = ['Step','Num jobs', 'Start', 'Finish', 'Total elapsed', 'Queue time', 'Array mean', 'Array std', 'CPUs', 'GPUs', 'Cost ($)']
@@ -383,46 +393,282 @@ def call_analyse_time(infile, rsc_file, pic_file, time_file):
     return summary_df
 
 
-def call_analyse_max_mem_use(jobIDs, stageNames, mem_dir='./mem_usage/', mem_file='max_mem_usage.txt'):
+def call_analyse_max_mem_use(jobIDs, stageNames, mem_dir='./mem_usage/', mem_file='max_mem_usage.txt',
+                             task_file='sacct_tasks.txt'):
     '''
     Major function to read from sacct output and find the max mem usage job
     + might also need to look at 'State' if we're having job failures
-    + assuming that we're using topsStack with slurm arrays for each step, each step having a separate SLURM job id
+    + assuming that we're using topsStack with slurm arrays for each step, each step having separate SLURM job id(s)
+    + one sacct call for all the jobs, per-task and per-step tables from groupby
     + todo: we get an easier output format (showing usage and efficiency for memory and CPU) using 'seff <job_id>_<array_index>'
     '''
     mem_file = mem_dir + mem_file
+    task_file = mem_dir + task_file
     if not os.path.exists(mem_dir):
         os.makedirs(mem_dir)
 
+    ## 1. Run sacct once for all the jobs
+    # + https://www.hpc.caltech.edu/documentation/slurm-commands
+    # + https://srcc.stanford.edu/sites/g/files/sbiybj25536/files/media/file/sherlock_onboarding-11-2022.pdf
+    job_stage = dict(zip([str(x) for x in jobIDs], stageNames))
+    df = query_sacct(list(job_stage.keys()))
+
+    ## 2. One row per array task
+    tasks = sacct_task_table(df)
+    tasks['stageName'] = tasks['ArrayJob'].map(job_stage)
+    tasks['MaxRSS'] = [convert_size(float(x))[0] for x in tasks['MaxRSS_bytes']]
+    tasks['AveRSS'] = [convert_size(float(x))[0] for x in tasks['AveRSS_bytes']]
+    # '|'-separated as sacct --parsable2, the State may contain spaces (e.g. CANCELLED by 1234)
+    tasks.to_csv(task_file, sep='|', columns=['stageName', 'StepID', 'NodeList', 'ReqMem', 'MaxRSS', 'AveRSS', 'Elapsed', 'State'],
+                 index=False)
+
+    ## 3. find the task of max usage in each stage
+    stages = list(dict.fromkeys(stageNames))
+    max_rows = tasks.loc[tasks.groupby('stageName')['MaxRSS_bytes'].idxmax()].set_index('stageName')
+    max_rows = max_rows.reindex([x for x in stages if x in max_rows.index])
     sum_row = [['JobSeq', 'stageName', 'JobID_arrayNo', 'ReqMem', 'MaxRSS', 'AveRSS', 'Elapsed']]
-
-    # loop over jobs
-    for job_seq, jobID in enumerate(jobIDs):
-        job_seq += 1
-        ## 1. Run sacct command to print details
-        sacctfile = os.path.normpath(f'{mem_dir}/{job_seq}_{jobID}_sacct.txt')
-        shortfile = os.path.normpath(f'{mem_dir}/{job_seq}_{jobID}.txt')
-        os.system(f'sacct -j {jobID} --format=JobID%20,NodeList,ReqMem,MaxRSS,MaxVMSize,AveRSS,AveVMSize,Elapsed,State%12 > {sacctfile}')
-        # + https://www.hpc.caltech.edu/documentation/slurm-commands
-        # + https://srcc.stanford.edu/sites/g/files/sbiybj25536/files/media/file/sherlock_onboarding-11-2022.pdf
-
-        ## 2. Read sacct output and condense it
-        res = shorter_sacct_output(sacctfile, shortfile)
-
-        ## 3. find the jobID of max usage in the whole job
-        max_idx = np.argsort(res[1:,-1].astype(float))[-1]+1   # sort based on size_bytes
-        sum_row.append([job_seq, stageNames[job_seq-1], res[max_idx,0], res[max_idx,2], res[max_idx,3], res[max_idx,5], res[max_idx,7]])
+    for stage, row in max_rows.iterrows():
+        sum_row.append([stages.index(stage)+1, stage, row['StepID'], row['ReqMem'], row['MaxRSS'], row['AveRSS'], row['Elapsed']])
 
     # save the summary to max_mem_usage.txt
     with open(mem_file, 'w') as ofile:
         fmt = '%7s %32s %20s %10s %10s %10s %12s'
         ofile.write('# Maximum memory usage for each stage in the processing\n')
         np.savetxt(ofile, np.array(sum_row), fmt=fmt)
-    return
+    return tasks
+
+
+def call_analyse_pair_mem(tasks, ledger_dir='./disk_usage/', out_dir='./mem_usage/pair_maxrss/'):
+    '''
+    Write the MaxRSS of each pair/date of each step, to split the steps into memory classes (`nclass`) in the next run
+    with write_slurmJobs.py --mem-hist mem_usage/pair_maxrss/
+    + tasks: per-task table of call_analyse_max_mem_use
+    + the lines run by each array task are read from the disk-usage ledger (the lines that succeeded);
+      the lines of a packed task all get its MaxRSS
+    + one table of "pair/date MaxRSS" per step: out_dir/<step>.txt, the max over the tasks of a pair/date (e.g. resubmitted)
+    '''
+    files = sorted(glob.glob(ledger_dir + '*.txt'))
+    if not files:
+        print(f'no ledger files in {ledger_dir}, skip the MaxRSS of each pair/date')
+        return None
+
+    rows = []
+    for ledger_file in files:
+        with open(ledger_file) as f:
+            for line in f:
+                # Step, Step number, Job ID, Task ID, Bytes, Command (with spaces)
+                tokens = line.split(None, 5)
+                if len(tokens) == 6:
+                    rows.append([tokens[0], f'{tokens[2]}_{tokens[3]}', line_key(tokens[5])])
+    lines = pd.DataFrame(rows, columns=['Step', 'Task', 'Pair']).dropna()
+    lines = lines.merge(tasks[['Task', 'MaxRSS_bytes']], on='Task')
+    pair_mem = lines.groupby(['Step', 'Pair'])['MaxRSS_bytes'].max()
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for step, df in pair_mem.groupby(level='Step'):
+        with open(out_dir + f'{step}.txt', 'w') as f:
+            f.write(f'# MaxRSS of the array task running each pair/date of {step}\n')
+            for (_, pair), maxrss in df.items():
+                f.write(f'{pair:<20s} {convert_size(float(maxrss))[0]}\n')
+    print(f'write the MaxRSS of each pair/date of {len(pair_mem.index.unique("Step"))} steps to {out_dir}')
+    return pair_mem
+
+
+def call_analyse_stragglers(tasks, out_dir='./mem_usage/', straggler_file='stragglers.txt', node_file='node_slowdown.txt'):
+    '''
+    Flag the array tasks taking much longer or much more memory than the others of their step (robust z-scores),
+    and relate the slow tasks to their host nodes
+    + tasks: per-task table of call_analyse_max_mem_use
+    + writes the outliers to straggler_file, the per-node slowdown to node_file,
+      and prints the --exclude option for the slow nodes in the next submission
+    '''
+    tasks = tasks[tasks['State'] == 'COMPLETED'].copy()
+    tasks['Elapsed_sec'] = pd.to_timedelta(tasks['Elapsed'].str.replace('-', ' days ', regex=False)).dt.total_seconds()
+    tasks['Slowdown'] = tasks['Elapsed_sec'] / tasks.groupby('stageName')['Elapsed_sec'].transform('median')
+    tasks['Z_elapsed'] = robust_zscore(tasks['Elapsed_sec'], tasks['stageName'])
+    tasks['Z_MaxRSS'] = robust_zscore(tasks['MaxRSS_bytes'], tasks['stageName'])
+    tasks['Straggler'] = tasks['Z_elapsed'] > ROBUST_Z
+    tasks['Mem outlier'] = tasks['Z_MaxRSS'] > ROBUST_Z
+
+    outliers = tasks[tasks['Straggler'] | tasks['Mem outlier']]
+    with open(out_dir + straggler_file, 'w') as f:
+        f.write(f'# Array tasks with a robust z-score > {ROBUST_Z} in elapsed time or MaxRSS within their step\n')
+        if len(outliers) > 0:
+            outliers.to_string(f, columns=['stageName', 'StepID', 'NodeList', 'Elapsed', 'Slowdown', 'Z_elapsed',
+                                           'MaxRSS', 'Z_MaxRSS'], index=False, float_format='{:.2f}'.format)
+            f.write('\n')
+
+    # slowdown of the tasks on each node
+    nodes = tasks.groupby('NodeList').agg(**{
+        'Tasks'             :   ('Slowdown',    'size'),
+        'Median slowdown'   :   ('Slowdown',    'median'),
+        'Max slowdown'      :   ('Slowdown',    'max'),
+        'Stragglers'        :   ('Straggler',   'sum'),
+        'Mem outliers'      :   ('Mem outlier', 'sum'),
+    }).sort_values('Median slowdown', ascending=False)
+    nodes['Straggler rate'] = nodes['Stragglers'] / nodes['Tasks']
+    with open(out_dir + node_file, 'w') as f:
+        f.write('# Slowdown (elapsed / median elapsed of the step) of the array tasks on each node\n')
+        nodes.to_string(f, float_format='{:.2f}'.format)
+        f.write('\n')
+
+    slow_nodes = nodes[(nodes['Median slowdown'] > SLOW_NODE_RATIO) & (nodes['Tasks'] >= MIN_NODE_TASKS)].index
+    print(f'# {len(outliers)} outlier tasks in {out_dir + straggler_file}, per-node slowdown in {out_dir + node_file}')
+    if len(slow_nodes) > 0:
+        print(f'# Slow nodes (median slowdown > {SLOW_NODE_RATIO}), add to the sbatch options of the next submission:')
+        print(f'#SBATCH --exclude={",".join(slow_nodes)}')
+    return tasks, nodes
+
+
+def concurrency_timeline(start, end):
+    '''Number of tasks running over time, from their start and end times (datetime64 arrays)
+    Return the times of the changes and the num of tasks running after each of them
+    '''
+    times = np.concatenate([start, end])
+    delta = np.concatenate([np.ones(len(start), dtype=int), -np.ones(len(end), dtype=int)])
+    order = np.lexsort((delta, times))     # at the same time, the ends go first
+    return times[order], np.cumsum(delta[order])
+
+
+def call_analyse_queue_wait(jobIDs, stageNames, rsc_file='resources.cfg', out_dir='./mem_usage/',
+                            wait_file='queue_wait.txt', pic_file='concurrency_timeline.pdf', fused={}):
+    '''
+    Decompose the time of each array task into dependency wait (Submit -> Eligible), queue wait (Eligible -> Start)
+    and run time (Start -> End), from sacct
+    + per-step distributions of the queue wait, and the concurrency (num of tasks running at once) of each step
+    + a step whose tasks wait while its concurrency is at the throttle (`batch` in rsc_file) is limited by the
+      throttle, otherwise by the cluster (free nodes, fair share); fused steps take the batch of their job
+    + plots the concurrency timeline of the steps
+    '''
+    job_stage = dict(zip([str(x) for x in jobIDs], stageNames))
+    df = query_sacct(list(job_stage.keys()), fields=QUEUE_FIELDS)
+    # array tasks started (not the job steps, nor the pending tasks)
+    df = df[(df['JobStep'] == '') & df['Task'].str.match(r'^\d+_\d+$')].copy()
+    for col in ['Submit', 'Eligible', 'Start', 'End']:
+        df[col] = pd.to_datetime(df[col], format='%Y-%m-%dT%H:%M:%S', errors='coerce')
+    df = df.dropna(subset=['Start', 'End'])
+    df['stageName'] = df['ArrayJob'].map(job_stage)
+    df['Dependency wait'] = (df['Eligible'] - df['Submit']).dt.total_seconds()
+    df['Queue wait'] = (df['Start'] - df['Eligible']).dt.total_seconds()
+    df['Run'] = (df['End'] - df['Start']).dt.total_seconds()
+
+    # per-step distributions of the queue wait
+    stages = [x for x in dict.fromkeys(stageNames) if x in set(df['stageName'])]
+    wait_df = df.groupby('stageName').agg(**{
+        'Tasks'             :   ('Queue wait', 'size'),
+        'Wait median'       :   ('Queue wait', 'median'),
+        'Wait p90'          :   ('Queue wait', lambda x: x.quantile(0.9)),
+        'Wait max'          :   ('Queue wait', 'max'),
+        'Dep wait median'   :   ('Dependency wait', 'median'),
+        'Run mean'          :   ('Run', 'mean'),
+        'Run sum'           :   ('Run', 'sum'),
+        'First start'       :   ('Start', 'min'),
+        'Last end'          :   ('End', 'max'),
+    }).reindex(stages).rename_axis('Step')
+
+    # effective (mean) and max concurrency of each step
+    span = (wait_df['Last end'] - wait_df['First start']).dt.total_seconds()
+    wait_df['Mean running'] = wait_df['Run sum'] / span.where(span > 0)
+    wait_df['Max running'] = [concurrency_timeline(x['Start'].to_numpy(), x['End'].to_numpy())[1].max()
+                              for x in [df[df['stageName'] == stage] for stage in stages]]
+
+    # what the waiting tasks are waiting for
+    if os.path.exists(rsc_file):
+        rsc_df = pd.read_table(rsc_file, header=0, sep=r'\s+').rename(columns=lambda x: x.replace('#', ''))
+        rsc_df = add_fused_rows(rsc_df, fused)
+        wait_df['Throttle'] = wait_df.index.map(rsc_step).map(rsc_df.set_index('Step')['batch'])
+    else:
+        wait_df['Throttle'] = np.nan
+    wait_df['Limited by'] = np.where(wait_df['Wait median'] < 60, '-',
+                                     np.where(wait_df['Max running'] >= 0.9 * wait_df['Throttle'], 'throttle', 'cluster'))
+
+    with open(out_dir + wait_file, 'w') as f:
+        f.write('# Queue wait (Eligible -> Start, sec) and concurrency of the array tasks of each step\n')
+        f.write('# Limited by: throttle if the tasks waited with the step at its throttle, cluster otherwise\n')
+        wait_df.drop(columns=['Run sum', 'First start', 'Last end']).to_string(f, float_format='{:.1f}'.format)
+        f.write('\n')
+    print(f'# queue wait and concurrency of each step in {out_dir + wait_file}')
+
+    # concurrency timeline
+    fig, ax = plt.subplots(figsize=[10, 4])
+    times, running = concurrency_timeline(df['Start'].to_numpy(), df['End'].to_numpy())
+    ax.step(times, running, where='post', color='k', lw=1, label='all')
+    for stage in stages:
+        x = df[df['stageName'] == stage]
+        times, running = concurrency_timeline(x['Start'].to_numpy(), x['End'].to_numpy())
+        ax.step(times, running, where='post', lw=0.8, label=stage)
+    ax.set_ylabel('Tasks running')
+    ax.legend(fontsize=6, ncol=2, loc='upper right')
+    fig.autofmt_xdate()
+    plt.tight_layout()
+    plt.savefig(out_dir + pic_file)
+    plt.close(fig)
+    return df, wait_df
+
+
+def write_synthetic_time_unix(outfile, num_rows=100000, num_steps=30, seed=0):
+    '''
+    Write a synthetic time_unix.txt with num_rows array elements over num_steps stages, for benchmarking
+    '''
+    rng = np.random.default_rng(seed)
+    sub_time = 1700000000
+    step = np.sort(rng.integers(0, num_steps, num_rows))
+    task = np.arange(num_rows) - np.searchsorted(step, step) + 1
+    start = sub_time + step * 3600 + rng.integers(0, 3000, num_rows)
+    elapsed = rng.integers(60, 1200, num_rows)
+    table = pd.DataFrame({'Step': [f'step_{i:02d}' for i in step], 'Job ID': 1000 + step, 'Slurm array': task,
+                          'Start': start, 'Finish': start + elapsed, 'Elapsed': elapsed})
+    with open(outfile, 'w') as f:
+        f.write(f'# Job submitted at: {sub_time}\n')
+        table.to_csv(f, sep=' ', header=False, index=False)
+    return outfile
+
+
+def bench_time_summary(num_rows=100000, num_steps=30, repeat=3):
+    '''
+    Benchmark the timing summary (read_time_unix and the formatting of call_analyse_time) on a synthetic time_unix.txt
+    Return the best time in seconds
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        infile = write_synthetic_time_unix(os.path.join(tmp_dir, 'time_unix.txt'), num_rows, num_steps)
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            summary_df, _ = read_time_unix(infile)
+            summary_df['Array mean'] = format_timedelta_series(summary_df['Array mean'])
+            summary_df['Array std']  = format_timedelta_series(summary_df['Array std'])
+            times.append(time.perf_counter() - t0)
+    if summary_df['Num jobs'].sum() != num_rows or len(summary_df) != num_steps:
+        raise Exception(f'wrong summary of the synthetic table: {summary_df["Num jobs"].sum()} rows, {len(summary_df)} steps')
+    print(f'timing summary of {num_rows} array elements in {num_steps} steps: {min(times):.3f} sec (best of {repeat})')
+    return min(times)
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Analyse the timings and memory usage of the topsStack jobs (run under run_files/ after run_atTheEnd.sh)'
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--bench', dest='bench', type=int, nargs='?', const=100000, default=None,
+                        help = 'benchmark the timing summary on a synthetic time_unix.txt of BENCH rows (default: 100000)\n'
+                               'instead of analysing the run')
+    return parser
 
 
 #######################################################################################
-def main():
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    if inps.bench:
+        bench_time_summary(inps.bench)
+        return
+
     # Paths
     base_dir  = './'
     #--------------- for timings ---------------------------
@@ -430,18 +676,31 @@ def main():
     rsc_file  = base_dir + 'resources.cfg'
     pic_file  = base_dir + 'cpu_wall_time.pdf'
     time_file = base_dir + 'formatted_summary_timings.txt'
+    fuse_file = base_dir + 'log_files/' + FUSE_FILE
     #--------------- for memory ----------------------------
     mem_dir   = base_dir + 'mem_usage/'
 
+    # member steps of the fused steps, to find their resources
+    fused = read_fused_steps(fuse_file)
+
     ## Step 1:
-    summary_df = call_analyse_time(infile, rsc_file, pic_file, time_file)
-    jobIDs, stages = summary_df['Job ID'], summary_df['Step']
+    call_analyse_time(infile, rsc_file, pic_file, time_file, fused)
+    # all the jobs of each step (split into parts / memory classes / resubmitted)
+    jobs = read_time_table(infile)[['Step', 'Job ID']].drop_duplicates()
+    jobIDs, stages = jobs['Job ID'], jobs['Step']
 
     ## Step 2:
-    call_analyse_max_mem_use(jobIDs, stages, mem_dir=mem_dir)
+    tasks = call_analyse_max_mem_use(jobIDs, stages, mem_dir=mem_dir)
+
+    ## Step 3:
+    call_analyse_stragglers(tasks, out_dir=mem_dir)
+    call_analyse_pair_mem(tasks, ledger_dir=base_dir + 'disk_usage/', out_dir=mem_dir + 'pair_maxrss/')
+
+    ## Step 4:
+    call_analyse_queue_wait(jobIDs, stages, rsc_file, out_dir=mem_dir, fused=fused)
 
 #######################################################################################
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
     print('Normal end of script~')
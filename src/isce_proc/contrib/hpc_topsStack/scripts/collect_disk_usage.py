@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+############################################################
+# Sum the disk-usage ledger of the topsStack jobs per step
+#
+# This script is executed under run_files/ (called by run_atTheEnd.sh)
+############################################################
+# + Each array task of the job scripts appends, for each line it ran, the bytes of the outputs declared
+#   in the line's config (see task_io.py size) to its own file under disk_usage/
+#       - only the files written since the task started, each file once per task (e.g. a shared output dir)
+# + Columns of the ledger files: Step, Step number, Job ID, Task ID, Bytes, Command
+# + Output total_file_sizes.txt: per-step bytes created, and the running total over the steps
+#       NB: files deleted by clean_topsStack_files.sh are not subtracted from the running total
+
+import argparse
+import glob
+import os
+import sys
+import pandas as pd
+
+from analyse_time_resource import convert_size
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Sum the disk-usage ledger of the topsStack jobs per step into total_file_sizes.txt'
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-d', '--dir', dest='ledger_dir', type=str, default='disk_usage',
+                        help = 'dir of the per-task ledger files (default: %(default)s)')
+    parser.add_argument('-o', '--out', dest='out_file', type=str, default='total_file_sizes.txt',
+                        help = 'output table (default: %(default)s)')
+    return parser
+
+
+#########################################################################################
+
+def read_disk_usage(ledger_dir='disk_usage'):
+    """Read the per-task ledger files, one row per run-file line
+    """
+    files = sorted(glob.glob(os.path.join(ledger_dir, '*.txt')))
+    names = ['Step', 'Step number', 'Job ID', 'Task ID', 'Bytes']
+    if not files:
+        return pd.DataFrame(columns=names)
+    # the command (last column) may contain spaces, only read the first columns
+    df = pd.concat([pd.read_table(f, names=names, usecols=range(5), sep=r'\s+', header=None,
+                                  dtype={'Step number': str}) for f in files])
+    return df
+
+
+def collect_disk_usage(ledger_dir='disk_usage', out_file='total_file_sizes.txt'):
+    """Write the per-step bytes created and their running total
+    """
+    df = read_disk_usage(ledger_dir)
+    if len(df) == 0:
+        print(f'no ledger files in {ledger_dir}/, skip {out_file}')
+        return None
+
+    sizeDf = df.groupby(['Step number', 'Step'], sort=True).agg(Lines=('Bytes', 'size'), Bytes=('Bytes', 'sum'))
+    sizeDf = sizeDf.reset_index()
+    sizeDf['Total'] = sizeDf['Bytes'].cumsum()
+
+    fmt = '{:<35s}{:<12s}{:<12s}{:<14s}{:<14s}\n'
+    with open(out_file, 'w') as f:
+        f.write(fmt.format('Step', 'Step number', 'Lines', 'Created', 'Total size'))
+        for _, row in sizeDf.iterrows():
+            f.write(fmt.format(row['Step'], row['Step number'], str(row['Lines']),
+                               convert_size(float(row['Bytes']))[0], convert_size(float(row['Total']))[0]))
+    print(f'create {out_file} from the ledger in {ledger_dir}/')
+    return sizeDf
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    collect_disk_usage(inps.ledger_dir, inps.out_file)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+############################################################
+# Merge the per-task records of the topsStack jobs into the timing tables and the central logfile
+#
+# This script is executed under run_files/ (called by run_atTheEnd.sh)
+############################################################
+# + Each array task of the job scripts writes its own files under task_records/, named after the job and task IDs:
+#       - <run file>_<job ID>_<task ID>.time:  one line of Step, Job ID, Array ID, Start, Finish, Elapsed (unix sec)
+#       - <run file>_<job ID>_<task ID>.log:   the header and commands of the task
+#   so that no file is shared (appended) by the tasks during the run
+# + submit_chained_dependencies.sh appends the submission time to task_records/submitted_at.txt
+# + Outputs, in one pass over the records:
+#       - time_unix.txt:    the table read by analyse_time_resource.py, in unix time
+#       - timings.txt:      the same table in local clock time, for quick inspection
+#       - the logs of all the tasks, appended to the latest cmd_runall_*.log in order of start time
+
+import argparse
+import glob
+import os
+import sys
+from datetime import datetime
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Merge the per-task records of the topsStack jobs into time_unix.txt, timings.txt and the cmd_runall log'
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-d', '--dir', dest='record_dir', type=str, default='task_records',
+                        help = 'dir of the per-task record files (default: %(default)s)')
+    parser.add_argument('--time-unix', dest='time_unix', type=str, default='time_unix.txt',
+                        help = 'output timing table in unix time (default: %(default)s)')
+    parser.add_argument('--timings', dest='timings', type=str, default='timings.txt',
+                        help = 'output timing table in clock time (default: %(default)s)')
+    parser.add_argument('-l', '--logfile', dest='logfile', type=str, default=None,
+                        help = 'logfile to append the task logs to (default: the latest cmd_runall_*.log)')
+    return parser
+
+
+#########################################################################################
+
+def read_task_records(record_dir='task_records'):
+    """Read the timing records of the array tasks
+    Return:
+        sub_time:   first submission time (unix sec), None if not recorded
+        records:    list of (step, job ID, task ID, start, finish, elapsed, record name), sorted by start time
+    """
+    sub_time = None
+    sub_file = os.path.join(record_dir, 'submitted_at.txt')
+    if os.path.isfile(sub_file):
+        with open(sub_file) as f:
+            times = [int(x) for x in f.read().split()]
+        sub_time = min(times) if times else None
+
+    records = []
+    for time_file in glob.glob(os.path.join(record_dir, '*.time')):
+        with open(time_file) as f:
+            tokens = f.read().split()
+        if len(tokens) != 6:
+            print(f' skip incomplete record {time_file}')
+            continue
+        step, job_id, task_id = tokens[:3]
+        start, finish, elapsed = [int(x) for x in tokens[3:]]
+        records.append((step, job_id, task_id, start, finish, elapsed, time_file[:-5]))
+    records.sort(key=lambda x: (x[3], x[0], int(x[2])))
+    return sub_time, records
+
+
+def write_time_tables(sub_time, records, time_unix='time_unix.txt', timings='timings.txt'):
+    """Write the timing tables, in unix time and in local clock time
+    """
+    if sub_time is None:
+        sub_time = min(x[3] for x in records)
+    fmt = '{:<34s} {:<12s}{:<12s}{:<12s}{:<12s}{:<12s}\n'
+    clock = lambda t: datetime.fromtimestamp(t).strftime('%H:%M:%S')
+    with open(time_unix, 'w') as f_unix, open(timings, 'w') as f_clock:
+        f_unix.write(f'# Job submitted at: {sub_time}\n')
+        f_unix.write(fmt.format('# Stage', 'Job ID', 'Array ID', 'Start (s)', 'Finish (s)', 'Elapsed (s)'))
+        f_clock.write(f'# Job submitted at: {datetime.fromtimestamp(sub_time).strftime("%Y-%m-%d %H:%M:%S")}\n')
+        f_clock.write(fmt.format('# Stage', 'Job ID', 'Array ID', 'Start', 'Finish', 'Elapsed'))
+        for step, job_id, task_id, start, finish, elapsed, _ in records:
+            f_unix.write(fmt.format(step, job_id, task_id, str(start), str(finish), str(elapsed)))
+            hms = f'{elapsed // 3600}hrs {(elapsed // 60) % 60}min {elapsed % 60}sec'
+            f_clock.write(fmt.format(step, job_id, task_id, clock(start), clock(finish), hms))
+    print(f'create {time_unix} and {timings} from {len(records)} task records')
+
+
+def append_task_logs(records, record_dir='task_records', logfile=None):
+    """Append the logs of the array tasks to the central logfile, the tasks that did not finish last
+    """
+    if not logfile:
+        logfiles = sorted(glob.glob('cmd_runall_*.log'), key=os.path.getmtime)
+        logfile = logfiles[-1] if logfiles else 'cmd_runall.log'
+    log_files = [x[-1] + '.log' for x in records]
+    unfinished = sorted(set(glob.glob(os.path.join(record_dir, '*.log'))) - set(log_files), key=os.path.getmtime)
+    with open(logfile, 'a') as f:
+        for log_file in log_files + unfinished:
+            if os.path.isfile(log_file):
+                with open(log_file) as f_task:
+                    f.write(f_task.read())
+    print(f'append {len(log_files) + len(unfinished)} task logs to {logfile}')
+
+
+def collect_task_records(record_dir='task_records', time_unix='time_unix.txt', timings='timings.txt', logfile=None):
+    """Merge the per-task records into the timing tables and the central logfile
+    """
+    sub_time, records = read_task_records(record_dir)
+    if not records:
+        print(f'no task records in {record_dir}/, skip {time_unix} and {timings}')
+        return records
+    write_time_tables(sub_time, records, time_unix, timings)
+    append_task_logs(records, record_dir, logfile)
+    return records
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    collect_task_records(inps.record_dir, inps.time_unix, inps.timings, inps.logfile)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
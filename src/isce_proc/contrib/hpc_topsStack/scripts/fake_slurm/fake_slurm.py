@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+############################################################
+# Stand-in slurm commands (squeue, scontrol, sacct, sbatch, scancel) to try adapt_throttle.py, monitor_chain.py
+# and resubmit_jobs.py without a cluster, through their --slurm-bin option:
+#   python adapt_throttle.py --slurm-bin ./fake_slurm -j 1001 1002 --interval 1 --iterations 10 --probe-dir .
+############################################################
+# + The commands in this dir call this script, with the name of the command as first argument
+# + A chain of job arrays is simulated in real time, its state is kept in a small json file (FAKE_SLURM_STATE)
+#       - the jobs are added the first time a command asks for them, each one depending on the one before (afterok)
+#       - each job has FAKE_SLURM_TASKS tasks of FAKE_SLURM_TASK_SEC seconds, run ArrayTaskThrottle at a time
+#         (FAKE_SLURM_THROTTLE at first, then as set by scontrol update)
+#       - the tasks in FAKE_SLURM_FAIL (e.g. 1001_3,1001_7) fail, the jobs after them never start
+#         (pending with DependencyNeverSatisfied)
+#       - sbatch adds a job with the tasks of --array and the jobs of --dependency=afterok:ID:ID, the job script
+#         is not run; scancel cancels the tasks of a job (only the pending ones with --state=PENDING)
+# + Remove the state file to start over
+# + Supported calls, as in the scripts:
+#       squeue -h -r -j <ids> -o '%i %T'
+#       scontrol show job <id>
+#       scontrol update JobId=<id> ArrayTaskThrottle=<n>
+#       sacct -X -n -P -o <fields> -j <ids>     (JobID, State, Start, End, Reason; the other fields are empty)
+#       sbatch --parsable --array=<ids>[%n] [--dependency=afterok:<id>:<id>] [other options] <job file>
+#       scancel [--state=PENDING] <id>
+
+import json
+import os
+import re
+import sys
+import time
+
+
+STATE_FILE = os.environ.get('FAKE_SLURM_STATE', 'fake_slurm_state.json')
+NUM_TASKS  = int(os.environ.get('FAKE_SLURM_TASKS', 20))
+TASK_SEC   = float(os.environ.get('FAKE_SLURM_TASK_SEC', 2))
+THROTTLE   = int(os.environ.get('FAKE_SLURM_THROTTLE', 4))
+FAIL_TASKS = [x for x in os.environ.get('FAKE_SLURM_FAIL', '').split(',') if x]
+
+# states of the tasks that will not change anymore
+END_STATES = ['COMPLETED', 'FAILED', 'CANCELLED']
+
+
+#########################################################################################
+
+def read_state():
+    """Jobs in submission order:
+        {job ID: {'throttle': n, 'after': [job IDs], 'submit': sec, 'clock': sec,
+                  'tasks': {task ID: [state, start, end]}}}
+    """
+    if not os.path.isfile(STATE_FILE):
+        return {}
+    with open(STATE_FILE) as f:
+        return json.load(f)
+
+
+def write_state(jobs):
+    with open(STATE_FILE, 'w') as f:
+        json.dump(jobs, f)
+
+
+def add_job(jobs, job_id, task_ids, throttle, after, now):
+    tasks = {str(i): ['PENDING', None, None] for i in task_ids}
+    jobs[job_id] = {'throttle': throttle, 'after': after, 'submit': now, 'clock': now, 'tasks': tasks}
+
+
+def add_jobs(jobs, job_ids, now):
+    """Add the jobs seen for the first time, each one after the last known job
+    """
+    for job_id in job_ids:
+        if job_id not in jobs:
+            after = [list(jobs.keys())[-1]] if jobs else []
+            add_job(jobs, job_id, range(1, NUM_TASKS + 1), THROTTLE, after, now)
+
+
+def dependency_state(jobs, job):
+    """'ok' when the jobs it depends on are completed, 'wait' while they run, 'never' if one of them failed
+    """
+    states = [x[0] for dep in job['after'] if dep in jobs for x in jobs[dep]['tasks'].values()]
+    if any(x in END_STATES and x != 'COMPLETED' for x in states):
+        return 'never'
+    if any(x not in END_STATES for x in states):
+        return 'wait'
+    return 'ok'
+
+
+def run_job(job_id, job, start, now):
+    """Run the tasks of a job from the last simulated time (or its start time) until now, throttle at a time
+    """
+    tasks = job['tasks']
+    t = max(start, job['clock'])
+    while True:
+        running = [x for x in tasks.values() if x[0] == 'RUNNING']
+        pending = [i for i, x in tasks.items() if x[0] == 'PENDING']
+        for i in pending[:max(job['throttle'] - len(running), 0)]:
+            tasks[i] = ['RUNNING', t, None]
+        ends = [x[1] + TASK_SEC for x in tasks.values() if x[0] == 'RUNNING']
+        if not ends or min(ends) > now:
+            job['clock'] = now
+            return
+        t = min(ends)
+        for i, x in tasks.items():
+            if x[0] == 'RUNNING' and x[1] + TASK_SEC <= t:
+                tasks[i] = ['FAILED' if f'{job_id}_{i}' in FAIL_TASKS else 'COMPLETED', x[1], t]
+
+
+def advance(jobs, now):
+    """Bring the jobs up to now, each one starting once the jobs it depends on are completed
+    """
+    for job_id, job in jobs.items():
+        if dependency_state(jobs, job) != 'ok':
+            continue
+        ends = [x[2] for dep in job['after'] if dep in jobs for x in jobs[dep]['tasks'].values() if x[2]]
+        run_job(job_id, job, max([job['submit']] + ends), now)
+
+
+def job_reason(jobs, job_id):
+    """Pending reason of the tasks of a job
+    """
+    return {'never': 'DependencyNeverSatisfied', 'wait': 'Dependency',
+            'ok': 'JobArrayTaskLimit'}[dependency_state(jobs, jobs[job_id])]
+
+
+def opt_value(args, *names):
+    """Value of an option given as `-o value`, `--format value` or `--format=value`
+    """
+    for i, arg in enumerate(args):
+        for name in names:
+            if arg == name and i + 1 < len(args):
+                return args[i + 1]
+            if name.startswith('--') and arg.startswith(name + '='):
+                return arg.split('=', 1)[1]
+    return None
+
+
+def expand_ids(ids):
+    """Task IDs of an array option, e.g. 1-3,7 -> [1, 2, 3, 7]
+    """
+    task_ids = []
+    for part in ids.split(','):
+        first, _, last = part.partition('-')
+        task_ids += list(range(int(first), int(last or first) + 1))
+    return task_ids
+
+
+def compress_ids(task_ids):
+    """Task IDs to an array range, e.g. [1, 2, 3, 7] -> 1-3,7
+    """
+    ranges = []
+    for i in sorted(task_ids):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(f'{a}' if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def time_str(sec):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(sec)) if sec else 'Unknown'
+
+
+#########################################################################################
+
+def squeue(jobs, args, now):
+    """The running and pending tasks of the jobs, one per line: '<job>_<task> <state>'
+    """
+    for job_id in opt_value(args, '-j', '--jobs').split(','):
+        for i, x in jobs[job_id]['tasks'].items():
+            if x[0] in ['RUNNING', 'PENDING']:
+                print(f'{job_id}_{i} {x[0]}')
+
+
+def scontrol(jobs, args, now):
+    if args[0] == 'show':
+        job_id = args[2]
+        add_jobs(jobs, [job_id], now)
+        print(f'JobId={job_id} ArrayJobId={job_id} ArrayTaskThrottle={jobs[job_id]["throttle"]}')
+    elif args[0] == 'update':
+        opts = dict(x.split('=', 1) for x in args[1:])
+        add_jobs(jobs, [opts['JobId']], now)
+        jobs[opts['JobId']]['throttle'] = int(opts['ArrayTaskThrottle'])
+
+
+def sacct(jobs, args, now):
+    """One line per started task, and one line for the pending tasks of each job (e.g. 1001_[5-20%4])
+    """
+    fields = opt_value(args, '-o', '--format').split(',')
+    for job_id in opt_value(args, '-j', '--jobs').split(','):
+        job = jobs[job_id]
+        rows = []
+        for i, x in job['tasks'].items():
+            if x[0] != 'PENDING':
+                rows.append({'JobID': f'{job_id}_{i}', 'State': x[0], 'Start': time_str(x[1]),
+                             'End': time_str(x[2]), 'Reason': 'None'})
+        pending = [int(i) for i, x in job['tasks'].items() if x[0] == 'PENDING']
+        if pending:
+            rows.append({'JobID': f'{job_id}_[{compress_ids(pending)}%{job["throttle"]}]', 'State': 'PENDING',
+                         'Start': 'Unknown', 'End': 'Unknown', 'Reason': job_reason(jobs, job_id)})
+        for row in rows:
+            print('|'.join(row.get(x, '') for x in fields))
+
+
+def sbatch(jobs, args, now):
+    """Add a job array, print its ID (--parsable)
+    """
+    array, _, throttle = opt_value(args, '--array', '-a').partition('%')
+    dependency = opt_value(args, '--dependency', '-d') or ''
+    after = re.findall(r'\d+', dependency.partition(':')[2])
+    job_id = str(max([int(x) for x in jobs] + [1000]) + 1)
+    add_job(jobs, job_id, expand_ids(array), int(throttle) if throttle else THROTTLE, after, now)
+    print(job_id)
+
+
+def scancel(jobs, args, now):
+    """Cancel the running and pending tasks of a job, or only the pending ones (--state=PENDING)
+    """
+    states = (opt_value(args, '--state', '-t') or 'RUNNING,PENDING').split(',')
+    job_id = [x for x in args if not x.startswith('-') and x.isdigit()][-1]
+    for i, x in jobs[job_id]['tasks'].items():
+        if x[0] in states:
+            jobs[job_id]['tasks'][i] = ['CANCELLED', x[1], now if x[1] else None]
+
+
+#################################################################
+def main(args):
+    cmd, args = args[0], args[1:]
+    now = time.time()
+    jobs = read_state()
+    job_ids = opt_value(args, '-j', '--jobs') if cmd in ['squeue', 'sacct'] else None
+    if job_ids:
+        add_jobs(jobs, job_ids.split(','), now)
+    advance(jobs, now)
+    {'squeue': squeue, 'scontrol': scontrol, 'sacct': sacct, 'sbatch': sbatch, 'scancel': scancel}[cmd](jobs, args, now)
+    write_state(jobs)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+############################################################
+# Fit per-step resource models from previous topsStack runs
+# and write a resources.cfg for a new track
+#
+# This script is executed under run_files/
+############################################################
+# + Walltime: a high quantile of the elapsed times of one run-file line (from log_files/time_unix.txt), i.e. the `Time`
+#             of resources.cfg. Packed array tasks are divided by the lines they ran one after another, and fused
+#             jobs among their member steps, with the resources.cfg and fused_steps.txt of that run (see read_cmd_time)
+# + Memory:   the max MaxRSS of each step (from mem_usage/max_mem_usage.txt, see analyse_time_resource.py);
+#             the member steps of a fused job get its MaxRSS
+# + Both are modelled against a workload size you define per track (e.g. num of bursts, num of pairs, image lines)
+#       - one history track:        scaled proportionally to the new workload size
+#       - two or more sizes:        linear fit y = a + b * size
+# + Safety margins are applied on top of the prediction
+
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from analyse_time_resource import convert_size
+from write_slurmJobs import (read_resources, write_resources, read_cmd_time, read_fused_steps, sec2timestr, timestr2sec,
+                             mb2memstr, TIME_PAD, MIN_PRED_TIME, FUSE_FILE)
+
+
+# do not go below these requests, whatever the fit says (walltime: MIN_PRED_TIME of write_slurmJobs.py)
+MIN_MEM_MB   = 500
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Fit walltime and memory models from finished tracks and write resources.cfg for a new track'
+
+    EXAMPLE = f"""Examples:
+        # scale from one finished track (44 bursts) to a new track with 60 bursts
+        {os.path.basename(__file__)} --hist ../../a087/run_files 44 --size 60
+
+        # fit from several finished tracks, more conservative margins
+        {os.path.basename(__file__)} --hist ../../a087/run_files 44 --hist ../../d123/run_files 30 --size 60 --time-margin 2
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('--hist', dest='hist', nargs=2, action='append', metavar=('RUN_DIR', 'SIZE'), required=True,
+                        help = 'run_files/ dir of a finished track and its workload size (e.g. num of bursts)')
+    parser.add_argument('--size', dest='size', type=float, required=True,
+                        help = 'workload size of the new track, same unit as in --hist')
+    parser.add_argument('-r', '--rsc', dest='rsc_file', type=str, default='resources.cfg',
+                        help = 'resources config table used as template for the non-fitted columns (default: %(default)s)')
+    parser.add_argument('-o', '--out', dest='out_file', type=str, default='resources_fit.cfg',
+                        help = 'output resources config table (default: %(default)s)')
+    parser.add_argument('-q', '--quantile', dest='quantile', type=float, default=0.99,
+                        help = 'quantile of the array elapsed times used as walltime (default: %(default)s)')
+    parser.add_argument('--time-margin', dest='time_margin', type=float, default=TIME_PAD,
+                        help = 'safety factor multiplied to the predicted walltime (default: %(default)s)')
+    parser.add_argument('--mem-margin', dest='mem_margin', type=float, default=1.25,
+                        help = 'safety factor multiplied to the predicted memory (default: %(default)s)')
+
+    if len(sys.argv) <= 1:
+        print('')
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return parser
+
+
+#########################################################################################
+
+def read_history(run_dir, quantile=0.99, rscDf=None):
+    """Read the per-step walltime quantile of one run-file line and max memory of one finished track
+    rscDf: resources table to use if the run_files/ of the track has no resources.cfg
+    Return:
+        hist_df:    DataFrame with columns [Step, Time_sec, MaxRSS_mb]
+    """
+    time_file = os.path.join(run_dir, 'log_files', 'time_unix.txt')
+    mem_file  = os.path.join(run_dir, 'mem_usage', 'max_mem_usage.txt')
+    fused = read_fused_steps(os.path.join(run_dir, 'log_files', FUSE_FILE))
+    for name, members in fused.items():
+        print(f' {run_dir}: fused job {name} mapped to {", ".join(members)}')
+
+    cmd_times = read_cmd_time(time_file, quantile, rscDf)
+    hist_df = pd.DataFrame({'Step': list(cmd_times.keys()), 'Time_sec': list(cmd_times.values())})
+
+    if os.path.exists(mem_file):
+        mem_df = pd.read_table(mem_file, sep=r'\s+', comment='#')
+        mem_df['MaxRSS_mb'] = [convert_size(x)[1] / 1024**2 if convert_size(x)[1] else np.nan for x in mem_df['MaxRSS']]
+        mem_df = mem_df.groupby('stageName')['MaxRSS_mb'].max().to_dict()
+        for name, members in fused.items():
+            for member in members:
+                if name in mem_df:
+                    mem_df.setdefault(member, mem_df[name])
+        hist_df['MaxRSS_mb'] = hist_df['Step'].map(mem_df)
+    else:
+        print(f' no {mem_file}, only fit walltime for {run_dir}')
+        hist_df['MaxRSS_mb'] = np.nan
+    return hist_df
+
+
+def predict(sizes, values, size):
+    """Predict the value at a new workload size
+        - proportional scaling if only one workload size is available
+        - linear fit otherwise, fall back to proportional scaling from the largest size if the fit goes negative
+    """
+    sizes, values = np.asarray(sizes, dtype=float), np.asarray(values, dtype=float)
+    flag = ~np.isnan(values)
+    sizes, values = sizes[flag], values[flag]
+    if len(values) == 0:
+        return np.nan
+
+    if len(np.unique(sizes)) >= 2:
+        b, a = np.polyfit(sizes, values, 1)
+        value = a + b * size
+        if value > 0:
+            return value
+
+    i = np.argmax(sizes)
+    return values[i] * size / sizes[i]
+
+
+def fit_resources(rscDf, hist_list, size, time_margin=TIME_PAD, mem_margin=1.25, quantile=0.99):
+    """Update Time and Mem_per_cpu columns of the resource table with the fitted models
+    Steps without any history keep the values of the template table
+    """
+    hist = pd.concat([read_history(run_dir, quantile, rscDf).assign(Size=float(hsize)) for run_dir, hsize in hist_list])
+
+    rscDf = rscDf.copy()
+    print(f'{"Step":<32s}{"Time":>12s}{"Mem_per_cpu":>14s}')
+    for index, row in rscDf.iterrows():
+        step_hist = hist[hist['Step']==row['Step']]
+        if len(step_hist) == 0:
+            print(f'{row["Step"]:<32s}{"(no history, keep template)":>26s}')
+            continue
+
+        # walltime of one run-file line, rounded up to minutes
+        time_sec = predict(step_hist['Size'], step_hist['Time_sec'], size) * time_margin
+        time_sec = max(time_sec, timestr2sec(MIN_PRED_TIME)[0])
+        rscDf.loc[index, 'Time'] = sec2timestr(np.ceil(time_sec / 60) * 60)
+
+        # memory is requested per cpu
+        mem_mb = predict(step_hist['Size'], step_hist['MaxRSS_mb'], size) * mem_margin
+        if not np.isnan(mem_mb):
+            mem_mb = max(mem_mb, MIN_MEM_MB) / int(row['Ncpus_per_task'])
+            rscDf.loc[index, 'Mem_per_cpu'] = mb2memstr(mem_mb)
+
+        print(f'{row["Step"]:<32s}{rscDf.loc[index, "Time"]:>12s}{rscDf.loc[index, "Mem_per_cpu"]:>14s}'
+              f'   (template: {row["Time"]}, {row["Mem_per_cpu"]})')
+    return rscDf
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    rscDf = read_resources(inps.rsc_file)
+    rscDf = fit_resources(rscDf, inps.hist, inps.size,
+                          time_margin=inps.time_margin,
+                          mem_margin=inps.mem_margin,
+                          quantile=inps.quantile)
+    write_resources(rscDf, inps.out_file)
+    print(f'Fitted resources written to {inps.out_file}, check it and use it with write_slurmJobs.py -r {inps.out_file}')
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
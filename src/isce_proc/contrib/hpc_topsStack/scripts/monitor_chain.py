@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+############################################################
+# Live progress of a submitted chain of topsStack jobs: task counts, throughput and ETA of each job
+#
+# This script is executed under run_files/, e.g. on the login node after submit_chained_dependencies.sh:
+#   nohup python monitor_chain.py > monitor_chain.log 2>&1 &
+############################################################
+# + The jobs are read from the job_id_logfile written by submit_chained_dependencies.sh (resubmitted jobs included,
+#   their tasks replace the failed ones of the same job name, see resubmit_jobs.py), again at each poll so the jobs
+#   resubmitted while it runs are followed too
+# + One sacct call per poll for all the jobs (-X, array tasks only), at a modest interval. The jobs with no task
+#   left running or pending are not queried again, so the polls get cheaper as the chain goes on
+# + For each job:
+#       - done (COMPLETED), running, pending and failed (RESUBMIT_STATES) tasks
+#       - throughput: tasks done per hour, since the first task started
+#       - ETA: the remaining work (pending tasks and the rest of the running ones, from the median task duration)
+#         over the tasks that can run at once: the pending and running ones, up to the array throttle (%N of the
+#         pending tasks in sacct, or of the job script). Jobs with no finished task yet have no ETA
+# + Chain ETA: the jobs are combined along job_dependencies.txt (written by write_slurmJobs.py): a job waiting for
+#   others (afterok) finishes its ETA after the last of them; per-task (aftercorr) jobs overlap the job they follow,
+#   finishing one task after it at the earliest; jobs side by side (.pN parts, .cN classes) take the longest one
+# + The poll stops when the jobs left can never start (pending with DependencyNeverSatisfied, after a failed job)
+# + The slurm commands can be taken from another dir (--slurm-bin), e.g. stand-in scripts for testing
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from adapt_throttle import slurm_cmd
+from resubmit_jobs import (read_job_log, read_dependencies, read_dependency_types, read_sbatch_opts, expand_ids,
+                           RESUBMIT_STATES)
+from write_slurmJobs import sec2timestr
+
+
+# states of the tasks that will not change anymore
+END_STATES = ['COMPLETED', 'PREEMPTED'] + RESUBMIT_STATES
+
+# pending reason of the jobs that will never start, e.g. depending on a failed job (afterok)
+NEVER_REASON = 'DependencyNeverSatisfied'
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Monitor a submitted chain of topsStack jobs: task counts, throughput and ETA of each job'
+
+    EXAMPLE = f"""Examples:
+        # the jobs of the latest job_id_logfile_*.txt, every 5 min until the chain is done
+        {os.path.basename(__file__)}
+
+        # one look only
+        {os.path.basename(__file__)} -i job_id_logfile_2025-05-01.txt --iterations 1
+
+        # test against the stand-in sacct of scripts/fake_slurm/
+        {os.path.basename(__file__)} --slurm-bin path/to/scripts/fake_slurm --interval 1 --iterations 3
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('-i', '--id-log', dest='id_logfile', type=str, default=None,
+                        help = 'job_id_logfile of the submitted jobs (default: the latest job_id_logfile_*.txt)')
+    parser.add_argument('--interval', dest='interval', type=float, default=300,
+                        help = 'seconds between two polls, keep it long to spare the slurm controller (default: %(default)s)')
+    parser.add_argument('--iterations', dest='iterations', type=int, default=0,
+                        help = 'stop after this many polls, 0 to run until the chain is done (default: %(default)s)')
+    parser.add_argument('--all', dest='show_all', action='store_true',
+                        help = 'show the finished jobs too (default: only the jobs with tasks left)')
+    parser.add_argument('--dep-file', dest='dep_file', type=str, default='job_dependencies.txt',
+                        help = 'job dependencies written by write_slurmJobs.py, for the chain ETA (default: %(default)s)')
+    parser.add_argument('--slurm-bin', dest='slurm_bin', type=str, default='',
+                        help = 'dir of the slurm command sacct (default: from $PATH)')
+    return parser
+
+
+#########################################################################################
+
+def sacct_time(value):
+    """sacct time (e.g. 2025-05-01T12:34:56) to unix seconds, None if not set (Unknown, None)
+    """
+    try:
+        return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def query_task_times(job_ids, slurm_bin=''):
+    """State, start and end time and pending reason of each array task, with one sacct call
+    Return:
+        tasks:      dict of {job ID: {task ID: (state, start, end, reason)}}
+        throttles:  dict of {job ID: array throttle}, for the jobs with pending tasks and a throttle
+    """
+    out = slurm_cmd(['sacct', '-X', '-n', '-P', '-o', 'JobID,State,Start,End,Reason', '-j', ','.join(job_ids)], slurm_bin)
+    tasks, throttles = {}, {}
+    for line in out.splitlines():
+        tokens = line.split('|')
+        if len(tokens) != 5:
+            continue
+        job_id, _, task = tokens[0].partition('_')
+        # e.g. "CANCELLED by 1234"
+        state = tokens[1].split()[0] if tokens[1].strip() else ''
+        if task.isdigit():
+            ids = [int(task)]
+        elif task.startswith('['):
+            # pending tasks, e.g. 1234_[2-3,5%200]
+            array, _, throttle = task.strip('[]').partition('%')
+            ids = expand_ids(array)
+            if throttle.isdigit():
+                throttles[job_id] = int(throttle)
+        else:
+            continue
+        for i in ids:
+            tasks.setdefault(job_id, {})[i] = (state, sacct_time(tokens[2]), sacct_time(tokens[3]), tokens[4].strip())
+    return tasks, throttles
+
+
+def script_throttle(job_name):
+    """Array throttle (%N) in the job script of a job, None if not found
+    """
+    job_file = f'{job_name}.job'
+    if not os.path.isfile(job_file):
+        return None
+    throttle = read_sbatch_opts(job_file).get('array', '').partition('%')[2]
+    return int(throttle) if throttle.isdigit() else None
+
+
+def job_progress(tasks, now, throttle=None):
+    """Counts, throughput (tasks/hour), median task duration and ETA (sec) of a job from the states and times of its tasks
+    The tasks left run `throttle` at a time at most
+    """
+    done     = [x for x in tasks.values() if x[0] == 'COMPLETED']
+    running  = [x for x in tasks.values() if x[0] == 'RUNNING']
+    pending  = [x for x in tasks.values() if x[0] == 'PENDING']
+    failed   = [x for x in tasks.values() if x[0] in RESUBMIT_STATES]
+    durations = [x[2] - x[1] for x in done if x[1] and x[2]]
+    starts = [x[1] for x in tasks.values() if x[1] and x[1] <= now]
+
+    rate = len(done) / (now - min(starts)) * 3600 if done and starts and now > min(starts) else None
+    duration = statistics.median(durations) if durations else None
+    eta = None
+    if duration is not None and (running or pending):
+        work = len(pending) * duration + sum(max(duration - (now - x[1]), 0) for x in running if x[1])
+        eta = work / min(throttle or len(tasks), len(running) + len(pending))
+    elif not (running or pending):
+        eta = 0
+    return {'done': len(done), 'running': len(running), 'pending': len(pending), 'failed': len(failed),
+            'total': len(tasks), 'rate': rate, 'duration': duration, 'eta': eta}
+
+
+def chain_finish(names, progs, deps, dtypes):
+    """Time (sec from now) when each job of the chain is done, combining their ETAs along the dependencies
+        + afterok (or none):    ETA after the last of the jobs it depends on; jobs side by side take the longest
+        + aftercorr:            overlapping the job it follows, done one task after it at the earliest
+    Return:
+        finish:     dict of {job name: sec}, None if unknown (no ETA for the job or one it depends on)
+    """
+    finish = {}
+    for name in names:
+        eta = progs[name]['eta']
+        after = [finish[x] for x in deps.get(name, []) if x in finish]
+        if eta is None or None in after:
+            finish[name] = None
+        elif dtypes.get(name) == 'aftercorr':
+            finish[name] = max([eta] + [x + (progs[name]['duration'] or 0) for x in after])
+        else:
+            finish[name] = max(after, default=0) + eta
+    return finish
+
+
+def run_monitor(inps):
+    """Poll the jobs of the chain and print their progress until no task is left running or pending
+    """
+    id_logfile, jobs = read_job_log(inps.id_logfile)
+    deps, dtypes = read_dependencies(inps.dep_file, jobs), read_dependency_types(inps.dep_file)
+    tasks = {}      # job ID -> {task ID: (state, start, end, reason)}
+    throttles = {}  # job ID -> array throttle
+    active = [job_id for _, job_id in jobs]
+    fmt = '{:<35s}{:<12s}{:>7s}{:>9s}{:>9s}{:>8s}{:>8s}{:>10s}{:>12s}'
+
+    iteration = 0
+    while True:
+        iteration += 1
+        if iteration > 1:
+            # the jobs appended to the log since the last poll, e.g. by resubmit_jobs.py
+            _, jobs = read_job_log(id_logfile, print_msg=False)
+            deps = read_dependencies(inps.dep_file, jobs)
+            new_ids = [job_id for _, job_id in jobs if job_id not in tasks and job_id not in active]
+            if new_ids:
+                print(f'\n# {len(new_ids)} new jobs in {id_logfile}: {" ".join(new_ids)}')
+                active += new_ids
+        now = time.time()
+        if active:
+            active_tasks, active_throttles = query_task_times(active, inps.slurm_bin)
+            tasks.update(active_tasks)
+            throttles.update(active_throttles)
+        # a job is not queried anymore once sacct lists it with all its tasks ended
+        active = [job_id for job_id in active
+                  if job_id not in tasks or any(x[0] not in END_STATES for x in tasks[job_id].values())]
+
+        # the tasks of a resubmitted job replace those of the previous job IDs with the same name
+        names = list(dict.fromkeys(name for name, _ in jobs))
+        merged = {name: {} for name in names}
+        for name, job_id in jobs:
+            merged[name].update(tasks.get(job_id, {}))
+
+        print(f'\n# {time.strftime("%Y-%m-%d %H:%M:%S")}  {id_logfile}  ({len(active)} jobs with tasks left)')
+        print(fmt.format('Job', 'Job ID', 'Done', 'Running', 'Pending', 'Failed', 'Total', 'Tasks/h', 'ETA'))
+        progs = {}
+        for name in names:
+            job_id = [x for n, x in jobs if n == name][-1]
+            prog = progs[name] = job_progress(merged[name], now, throttles.get(job_id, script_throttle(name)))
+            left = prog['running'] + prog['pending']
+            if left or inps.show_all:
+                print(fmt.format(name, job_id, str(prog['done']), str(prog['running']), str(prog['pending']),
+                                 str(prog['failed']), str(prog['total']),
+                                 f'{prog["rate"]:.1f}' if prog['rate'] is not None else '-',
+                                 sec2timestr(prog['eta']) if prog['eta'] is not None else '-'))
+        if active:
+            # the ETA of the jobs that have not started, and of the jobs after them, is unknown
+            finish = chain_finish(names, progs, deps, dtypes)
+            known = [x for x in finish.values() if x is not None]
+            unknown = len(finish) - len(known)
+            print(f'# chain ETA: {sec2timestr(max(known, default=0))}' + (f' + {unknown} jobs without ETA' if unknown else ''))
+        sys.stdout.flush()
+
+        if not active:
+            print('no task left running or pending, stop.')
+            break
+        # jobs with tasks left, all of them pending for a dependency that failed
+        never = [job_id for job_id in active if job_id in tasks
+                 and all(x[0] in END_STATES or (x[0] == 'PENDING' and x[3] == NEVER_REASON) for x in tasks[job_id].values())]
+        if len(never) == len(active):
+            print(f'{len(never)} jobs left pending with {NEVER_REASON} (a job they depend on failed), stop.')
+            print('resubmit the failed tasks with resubmit_jobs.py, or cancel the jobs left with scancel.')
+            break
+        if inps.iterations and iteration >= inps.iterations:
+            break
+        time.sleep(inps.interval)
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    run_monitor(inps)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
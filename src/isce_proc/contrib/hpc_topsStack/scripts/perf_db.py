@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+############################################################
+# Cross-track performance database of the topsStack jobs (SQLite)
+#
+# This script is executed under run_files/ of a finished run (after run_atTheEnd.sh and analyse_time_resource.py)
+############################################################
+# + import: load the records of one track into the database, replacing the previous import of the same track
+#       - runs:     track, workload size (e.g. num of bursts), run_files dir, import time
+#       - tasks:    one row per array task: step, job/task IDs, start/finish/elapsed (log_files/time_unix.txt),
+#                   MaxRSS/AveRSS/node/state (mem_usage/sacct_tasks.txt), time/CPU/memory efficiency
+#                   (log_files/reportseff_all.txt)
+#       - lines:    one row per run-file line: step, job/task IDs, pair/date and bytes of its outputs (disk_usage/)
+# + stats:  per-track walltime quantile, max memory and output size of each step, with the workload size
+#   e.g. to fit resource models (fit_resources.py), predict walltimes or check a new run against the previous ones
+# + sql:    any query, printed as a table
+# The missing files of a run are skipped (e.g. no reportseff installed)
+
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import sys
+import time
+import pandas as pd
+
+from analyse_time_resource import read_time_table, convert_size
+from write_slurmJobs import line_key
+
+
+# default database, shared by the tracks
+PERF_DB = os.path.expanduser('~/topsStack_perf.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs  (track TEXT PRIMARY KEY, size REAL, run_dir TEXT, imported TEXT);
+CREATE TABLE IF NOT EXISTS tasks (track TEXT, step TEXT, job_id TEXT, task_id INTEGER,
+                                  start INTEGER, finish INTEGER, elapsed REAL,
+                                  max_rss_mb REAL, ave_rss_mb REAL, req_mem TEXT, node TEXT, state TEXT,
+                                  time_eff REAL, cpu_eff REAL, mem_eff REAL);
+CREATE TABLE IF NOT EXISTS lines (track TEXT, step TEXT, job_id TEXT, task_id INTEGER, pair TEXT, bytes REAL);
+CREATE INDEX IF NOT EXISTS tasks_step ON tasks (step, track);
+CREATE INDEX IF NOT EXISTS lines_pair ON lines (pair, track);
+"""
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Cross-track performance database of the topsStack jobs: import a finished run, query the records'
+
+    EXAMPLE = f"""Examples:
+        # import this track (44 bursts)
+        {os.path.basename(__file__)} import --track a087 --size 44
+
+        # walltime p99, max memory and output size of each step for all the tracks
+        {os.path.basename(__file__)} stats
+
+        # the unwrap tasks of a pair in all the tracks
+        {os.path.basename(__file__)} sql "SELECT t.track, l.pair, t.elapsed, t.max_rss_mb FROM lines l
+            JOIN tasks t USING (track, step, job_id, task_id) WHERE l.step = 'unwrap' AND l.pair = '20200101_20200113'"
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('action', choices=['import', 'stats', 'sql'],
+                        help = 'import: load the records of a finished run\n'
+                               'stats: per-track summary of each step\n'
+                               'sql: run a query')
+    parser.add_argument('query', nargs='?', default=None,
+                        help = 'SQL query for `sql`')
+    parser.add_argument('--db', dest='db_file', type=str, default=PERF_DB,
+                        help = 'SQLite database (default: %(default)s)')
+    parser.add_argument('--track', dest='track', type=str, default=None,
+                        help = 'track name, for `import` (default: name of the processing dir); filter for `stats`')
+    parser.add_argument('--size', dest='size', type=float, default=None,
+                        help = 'workload size of the track for `import`, e.g. num of bursts')
+    parser.add_argument('--run-dir', dest='run_dir', type=str, default='.',
+                        help = 'run_files/ dir of the track to import (default: %(default)s)')
+    parser.add_argument('--step', dest='step', type=str, default=None,
+                        help = 'step filter for `stats`')
+    parser.add_argument('-q', '--quantile', dest='quantile', type=float, default=0.99,
+                        help = 'quantile of the elapsed times for `stats` (default: %(default)s)')
+
+    if len(sys.argv) <= 1:
+        print('')
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return parser
+
+
+#########################################################################################
+
+def connect(db_file=PERF_DB):
+    """Open the database, creating the tables if needed
+    """
+    con = sqlite3.connect(db_file)
+    con.executescript(SCHEMA)
+    return con
+
+
+def read_task_table(run_dir):
+    """Array tasks of a finished run: timings, with the memory (sacct) and efficiency (reportseff) if available
+    """
+    df = read_time_table(os.path.join(run_dir, 'log_files', 'time_unix.txt'))
+    tasks = pd.DataFrame({
+        'step'      :   df['Step'],
+        'job_id'    :   df['Job ID'].astype(str),
+        'task_id'   :   df['Slurm array'].astype(int),
+        'start'     :   df['Start'].astype('int64') // 10**9,
+        'finish'    :   df['Finish'].astype('int64') // 10**9,
+        'elapsed'   :   df['Elapsed'].dt.total_seconds(),
+    })
+    tasks['key'] = tasks['job_id'] + '_' + tasks['task_id'].astype(str)
+
+    # memory of each task, from analyse_time_resource.py
+    mem_file = os.path.join(run_dir, 'mem_usage', 'sacct_tasks.txt')
+    if os.path.isfile(mem_file):
+        mem = pd.read_table(mem_file, sep='|', dtype=str)
+        mem['key'] = mem['StepID'].str.partition('.')[0]
+        mem = mem.drop_duplicates('key', keep='last').set_index('key')
+        to_mb = lambda x: convert_size(x)[1] / 1024**2 if convert_size(x)[1] is not None else None
+        tasks['max_rss_mb'] = tasks['key'].map(mem['MaxRSS'].map(to_mb))
+        tasks['ave_rss_mb'] = tasks['key'].map(mem['AveRSS'].map(to_mb))
+        for col, name in [('ReqMem', 'req_mem'), ('NodeList', 'node'), ('State', 'state')]:
+            tasks[name] = tasks['key'].map(mem[col])
+    else:
+        print(f' no {mem_file}, skip the memory of the tasks')
+
+    # efficiency of each task
+    eff_file = os.path.join(run_dir, 'log_files', 'reportseff_all.txt')
+    if os.path.isfile(eff_file):
+        eff = read_reportseff(eff_file)
+        for col in ['time_eff', 'cpu_eff', 'mem_eff']:
+            tasks[col] = tasks['key'].map(eff[col])
+    else:
+        print(f' no {eff_file}, skip the efficiency of the tasks')
+    return tasks.drop(columns='key')
+
+
+def read_reportseff(eff_file):
+    """Read the output of `reportseff --no-color`: time/CPU/memory efficiency (%) of each array task
+    Return:
+        eff:    DataFrame indexed by JOBID_TASKID, with columns time_eff, cpu_eff, mem_eff
+    """
+    rows = []
+    with open(eff_file) as f:
+        for line in f:
+            tokens = line.split()
+            match = re.search(r'(\d+)_(\d+)', tokens[0]) if tokens else None
+            if not match or len(tokens) < 6:
+                continue
+            effs = [pd.to_numeric(x.rstrip('%'), errors='coerce') for x in tokens[-3:]]
+            rows.append([match.group(0)] + effs)
+    return pd.DataFrame(rows, columns=['key', 'time_eff', 'cpu_eff', 'mem_eff']).drop_duplicates('key').set_index('key')
+
+
+def read_line_table(run_dir):
+    """Run-file lines of a finished run, with their pair/date and output bytes, from the disk-usage ledger
+    """
+    ledger_dir = os.path.join(run_dir, 'disk_usage')
+    files = sorted(glob.glob(os.path.join(ledger_dir, '*.txt')))
+    if not files:
+        print(f' no ledger in {ledger_dir}/, skip the lines')
+        return None
+    rows = []
+    for ledger_file in files:
+        with open(ledger_file) as f:
+            for line in f:
+                # Step, Step number, Job ID, Task ID, Bytes, Command (with spaces)
+                tokens = line.split(None, 5)
+                if len(tokens) == 6:
+                    rows.append([tokens[0], tokens[2], int(tokens[3]), line_key(tokens[5]), float(tokens[4])])
+    return pd.DataFrame(rows, columns=['step', 'job_id', 'task_id', 'pair', 'bytes'])
+
+
+def import_run(con, track, size=None, run_dir='.'):
+    """Load the records of a finished run, replacing the previous import of the same track
+    """
+    tasks = read_task_table(run_dir)
+    lines = read_line_table(run_dir)
+    with con:
+        for table in ['runs', 'tasks', 'lines']:
+            con.execute(f'DELETE FROM {table} WHERE track = ?', (track,))
+        con.execute('INSERT INTO runs VALUES (?, ?, ?, ?)',
+                    (track, size, os.path.abspath(run_dir), time.strftime('%Y-%m-%d %H:%M:%S')))
+        tasks.assign(track=track).to_sql('tasks', con, if_exists='append', index=False)
+        if lines is not None:
+            lines.assign(track=track).to_sql('lines', con, if_exists='append', index=False)
+    print(f'import {track}: {len(tasks)} tasks, {0 if lines is None else len(lines)} lines')
+
+
+def query(con, sql, params=()):
+    """Run a query, return a DataFrame
+    """
+    return pd.read_sql_query(sql, con, params=params)
+
+
+def step_stats(con, quantile=0.99, track=None, step=None):
+    """Per track and step: workload size, num of tasks, elapsed quantile (sec), max MaxRSS (MB) and output bytes
+    """
+    where, params = [], []
+    for col, value in [('t.track', track), ('t.step', step)]:
+        if value:
+            where.append(f'{col} = ?')
+            params.append(value)
+    sql = ('SELECT t.track, r.size, t.step, t.elapsed, t.max_rss_mb FROM tasks t JOIN runs r USING (track)'
+           + (' WHERE ' + ' AND '.join(where) if where else ''))
+    tasks = query(con, sql, params)
+    stats = tasks.groupby(['track', 'step'], sort=False).agg(
+        size        =   ('size',       'first'),
+        tasks       =   ('elapsed',    'size'),
+        elapsed_q   =   ('elapsed',    lambda x: x.quantile(quantile)),
+        max_rss_mb  =   ('max_rss_mb', 'max'),
+    )
+    sizes = query(con, 'SELECT track, step, SUM(bytes) AS bytes FROM lines GROUP BY track, step').set_index(['track', 'step'])
+    stats['bytes'] = sizes['bytes'].reindex(stats.index).to_numpy()
+    return stats.reset_index()
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    # the query may come after the options
+    inps = parser.parse_intermixed_args(args=iargs)
+
+    con = connect(inps.db_file)
+    if inps.action == 'import':
+        track = inps.track or os.path.basename(os.path.dirname(os.path.abspath(inps.run_dir)))
+        import_run(con, track, inps.size, inps.run_dir)
+
+    elif inps.action == 'stats':
+        print(step_stats(con, inps.quantile, inps.track, inps.step).to_string(index=False))
+
+    else:
+        if not inps.query:
+            raise Exception('`sql` needs a query')
+        print(query(con, inps.query).to_string(index=False))
+    con.close()
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+############################################################
+# Recommend the CPUs, memory and GPU use of each step for the lowest cost under a target walltime
+#
+# This script is executed under run_files/ of a finished run (after run_atTheEnd.sh)
+############################################################
+# + Measured CPU efficiency of each array task: TotalCPU / (Elapsed * AllocCPUS) from sacct,
+#   or the CPU efficiency of reportseff (log_files/reportseff_all.txt) for the tasks sacct no longer has
+# + Parallel fraction p of a step from its median efficiency e with n CPUs (Amdahl's law):
+#       e = 1 / (n * ((1-p) + p/n))   ->   p = (1 - 1/(e*n)) / (1 - 1/n)
+#       - p >= SCALE_FRAC: the step scales with CPUs (e.g. subband_and_resamp)
+#       - p <  SERIAL_FRAC: more CPUs are wasted (e.g. unwrap)
+# + For each step, the CPUs from 1 to CPUS_PER_NODE_LIM are tried: the walltime quantile of one run-file line scales
+#   with Amdahl's law, the cost as in analyse_time_resource.py ((CPUs + GPU_UNITS * GPUs) * hours * COST_RATE).
+#   The cheapest number of CPUs whose walltime (times --time-margin) fits the target is recommended
+#       - the times and the target are per line, as the `Time` of resources.cfg: packed array tasks are divided by
+#         the lines they ran one after another (read_line_time), and their cost counts the whole task
+#       - fused jobs (fused_steps.txt) get a row with the combined resources of their member steps; it is printed,
+#         not written to the output table, apply it to the member steps by hand
+# + Memory: the max MaxRSS of the step times --mem-margin, divided over the recommended CPUs (Mem_per_cpu)
+# + GPU steps: the CPU efficiency says nothing about the GPU. Give the task time of the CPU version of the step
+#   (--cpu-time STEP=SEC, e.g. from an earlier run in perf_db.py) to compare the costs, otherwise the break-even
+#   CPU time above which the GPU is cheaper is printed
+# + Steps run with 1 CPU have no measured scaling, they keep their CPUs
+
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from analyse_time_resource import query_sacct, mem2bytes, COST_RATE, GPU_UNITS
+from write_slurmJobs import (read_resources, write_resources, read_line_time, read_fused_steps, add_fused_rows,
+                             timestr2sec, sec2timestr, mb2memstr, CPUS_PER_NODE_LIM, TOPO_STEP, FUSE_FILE)
+from fit_resources import MIN_MEM_MB
+from perf_db import read_reportseff
+from simulate_makespan import parse_overrides
+
+
+# parallel fractions to label a step as scaling with CPUs or not
+SCALE_FRAC  = 0.8
+SERIAL_FRAC = 0.5
+
+# sacct fields for the CPU efficiency and memory of the array tasks
+EFF_FIELDS = ['JobID', 'AllocCPUS', 'TotalCPU', 'Elapsed', 'MaxRSS', 'State']
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Recommend the CPUs, memory and GPU use of each step for the lowest cost under a target walltime'
+
+    EXAMPLE = f"""Examples:
+        # targets: the walltimes of resources.cfg
+        {os.path.basename(__file__)} -o resources_rec.cfg
+
+        # at most 1 hour per run-file line for all the steps, 3 hours for unwrap
+        {os.path.basename(__file__)} --walltime 1:00:00 unwrap=3:00:00
+
+        # compare the GPU version of geo2rdr with its CPU version (1500 sec per task in an earlier run)
+        {os.path.basename(__file__)} --cpu-time geo2rdr=1500
+
+        # no sacct query (purged records): efficiency from reportseff, memory from mem_usage/max_mem_usage.txt
+        {os.path.basename(__file__)} --no-sacct
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('-t', '--time', dest='time_file', type=str, default='log_files/time_unix.txt',
+                        help = 'time_unix.txt of the finished run (default: %(default)s)')
+    parser.add_argument('-r', '--rsc', dest='rsc_file', type=str, default='resources.cfg',
+                        help = 'resources config table of the finished run (default: %(default)s)')
+    parser.add_argument('-e', '--eff', dest='eff_file', type=str, default='log_files/reportseff_all.txt',
+                        help = 'reportseff output of the finished run (default: %(default)s)')
+    parser.add_argument('-m', '--mem', dest='mem_file', type=str, default='mem_usage/max_mem_usage.txt',
+                        help = 'max memory of each step, with --no-sacct (default: %(default)s)')
+    parser.add_argument('--no-sacct', dest='sacct', action='store_false',
+                        help = 'do not query sacct, use the reportseff and mem_usage files only')
+    parser.add_argument('--walltime', dest='walltime', type=str, nargs='+', default=[],
+                        help = 'target walltime of a run-file line, VALUE for all steps or STEP=VALUE\n'
+                               '(default: Time of the step in resources.cfg)')
+    parser.add_argument('--cpu-time', dest='cpu_time', type=str, nargs='+', default=[],
+                        help = 'task time (sec) of the CPU version of a GPU step, STEP=SEC')
+    parser.add_argument('--cpu-max', dest='cpu_max', type=int, default=CPUS_PER_NODE_LIM,
+                        help = 'max CPUs per command to consider (default: %(default)s)')
+    parser.add_argument('-q', '--quantile', dest='quantile', type=float, default=0.99,
+                        help = 'quantile of the line times to fit in the target (default: %(default)s)')
+    parser.add_argument('--time-margin', dest='time_margin', type=float, default=1.2,
+                        help = 'safety factor on the predicted walltime (default: %(default)s)')
+    parser.add_argument('--mem-margin', dest='mem_margin', type=float, default=1.25,
+                        help = 'safety factor on the max memory (default: %(default)s)')
+    parser.add_argument('-o', '--out', dest='out_file', type=str, default=None,
+                        help = 'write the resources config table with the recommended CPUs and memory')
+    return parser
+
+
+#########################################################################################
+
+def duration2sec(series):
+    """sacct durations ([DD-][HH:]MM:SS[.mmm], e.g. TotalCPU, Elapsed) to seconds, over a Series; NaN if empty
+    """
+    parts = series.astype(str).str.extract(r'^(?:(\d+)-)?(?:(\d+):)?(\d+):([\d.]+)$').astype(float).fillna(0)
+    sec = 86400 * parts[0] + 3600 * parts[1] + 60 * parts[2] + parts[3]
+    return sec.where(series.astype(str).str.contains(':'))
+
+
+def read_task_efficiency(time_df, eff_file=None, sacct=True):
+    """CPU efficiency and max memory of each array task
+    time_df: time table of read_line_time, Elapsed in seconds per run-file line
+    Return:
+        tasks:  DataFrame indexed by JOBID_TASKID, with columns Step, Elapsed (sec per line), CPU eff (%), MaxRSS_mb
+    """
+    tasks = pd.DataFrame({
+        'Step'      :   time_df['Step'].to_numpy(),
+        'Elapsed'   :   time_df['Elapsed'].to_numpy(),
+    }, index=time_df['Job ID'].astype(str) + '_' + time_df['Slurm array'].astype(str))
+    tasks['CPU eff'] = np.nan
+    tasks['MaxRSS_mb'] = np.nan
+
+    if sacct:
+        df = query_sacct(time_df['Job ID'].astype(str).unique(), fields=EFF_FIELDS)
+        alloc = df[df['JobStep'] == ''].drop_duplicates('Task', keep='last').set_index('Task')
+        used = duration2sec(alloc['TotalCPU'])
+        alloc_sec = duration2sec(alloc['Elapsed']) * pd.to_numeric(alloc['AllocCPUS'], errors='coerce')
+        tasks['CPU eff'] = (100 * used / alloc_sec.where(alloc_sec > 0)).reindex(tasks.index)
+        tasks['MaxRSS_mb'] = (mem2bytes(df['MaxRSS']).groupby(df['Task']).max() / 1024**2).reindex(tasks.index)
+
+    # reportseff for the tasks without sacct records
+    if eff_file and os.path.isfile(eff_file):
+        eff = read_reportseff(eff_file)
+        tasks['CPU eff'] = tasks['CPU eff'].fillna(tasks.index.to_series().map(eff['cpu_eff']))
+    elif not sacct:
+        raise Exception(f'No sacct query and no {eff_file}, no CPU efficiency to use')
+    return tasks
+
+
+def read_step_mem(mem_file):
+    """Max MaxRSS (MB) of each step from mem_usage/max_mem_usage.txt (see analyse_time_resource.py)
+    """
+    if not os.path.isfile(mem_file):
+        print(f' no {mem_file}, keep the memory of resources.cfg')
+        return pd.Series(dtype=float)
+    mem_df = pd.read_table(mem_file, sep=r'\s+', comment='#', names=['JobSeq', 'stageName', 'JobID_arrayNo', 'ReqMem',
+                                                                     'MaxRSS', 'AveRSS', 'Elapsed'])
+    mem_df = mem_df[mem_df['JobSeq'] != 'JobSeq']
+    return (mem2bytes(mem_df['MaxRSS']) / 1024**2).groupby(mem_df['stageName']).max()
+
+
+def par_fraction(eff, ncpus):
+    """Parallel fraction (Amdahl's law) from the CPU efficiency (%) with ncpus CPUs; NaN with 1 CPU
+    """
+    if ncpus <= 1 or np.isnan(eff) or eff <= 0:
+        return np.nan
+    p = (1 - 100 / (eff * ncpus)) / (1 - 1 / ncpus)
+    return float(np.clip(p, 0, 1))
+
+
+def amdahl_time(time0, p, n0, n):
+    """Time with n CPUs of a command taking time0 with n0 CPUs, parallel fraction p
+    """
+    return time0 * ((1 - p) + p / n) / ((1 - p) + p / n0)
+
+
+def recommend_step(step_tasks, row, target_sec, max_mem_mb=np.nan, cpu_time=None, cpu_max=CPUS_PER_NODE_LIM,
+                   quantile=0.99, time_margin=1.2, mem_margin=1.25, pack=(1, 1)):
+    """Recommendation for one step
+    step_tasks: its array tasks, Elapsed in seconds per run-file line
+    pack:       (lines per task, lines at once) of the step in the finished run
+    Return:
+        rec:    dict of the measured scaling, and the recommended CPUs, walltime (per line), memory, GPU use and costs
+    """
+    n0 = int(row['Ncpus_per_task'])
+    gpus = int(row['Gres']) if 'Gres' in row.index else 0
+    procs = pack[1]
+    seq = np.ceil(pack[0] / pack[1])    # lines run one after another in a task
+    num_task = len(step_tasks)
+    time_q = step_tasks['Elapsed'].quantile(quantile)
+    time_mean = step_tasks['Elapsed'].mean()
+    eff = step_tasks['CPU eff'].dropna().median()
+    p = par_fraction(eff, n0)
+
+    # cost of a step: num of tasks * mean task hours (line hours * lines in sequence) * (CPUs + GPU units) of the task * rate
+    cost = lambda n, t, g: num_task * t * seq / 3600 * (n * procs + GPU_UNITS * g) * COST_RATE
+    rec = {
+        'Step'          :   row['Step'],
+        'Tasks'         :   num_task,
+        'CPUs'          :   n0,
+        'CPU eff (%)'   :   eff,
+        'Par frac'      :   p,
+        'Scaling'       :   '-' if np.isnan(p) else ('scales' if p >= SCALE_FRAC else ('serial' if p < SERIAL_FRAC else 'partly')),
+        'Time'          :   sec2timestr(time_q),
+        'Target'        :   sec2timestr(target_sec),
+        'Rec CPUs'      :   n0,
+        'Rec time'      :   sec2timestr(time_q * time_margin),
+        'Cost ($)'      :   cost(n0, time_mean, gpus),
+        'Rec cost ($)'  :   cost(n0, time_mean, gpus),
+        'Rec Mem_per_cpu':  row['Mem_per_cpu'],
+        'GPU'           :   '-',
+    }
+
+    # cheapest CPUs under the target
+    if not np.isnan(p):
+        options = []
+        for n in range(1, cpu_max + 1):
+            time_n = amdahl_time(time_q, p, n0, n) * time_margin
+            options.append((time_n > target_sec, cost(n, amdahl_time(time_mean, p, n0, n), gpus), time_n, n))
+        # fits the target first, then the cost; the fastest one if none fits
+        fits = [x for x in options if not x[0]]
+        _, rec_cost, rec_time, rec_n = min(fits) if fits else min(options, key=lambda x: x[2])
+        rec.update({'Rec CPUs': rec_n, 'Rec time': sec2timestr(rec_time), 'Rec cost ($)': rec_cost})
+        if not fits:
+            rec['Rec time'] += ' (over target)'
+
+    # memory over the recommended CPUs
+    if not np.isnan(max_mem_mb):
+        rec['Rec Mem_per_cpu'] = mb2memstr(max(max_mem_mb * mem_margin, MIN_MEM_MB) / rec['Rec CPUs'])
+
+    # GPU or CPU version
+    if gpus:
+        if cpu_time:
+            cpu_cost = cost(rec['Rec CPUs'], float(cpu_time) / seq, 0)
+            rec['GPU'] = 'keep' if rec['Rec cost ($)'] <= cpu_cost else f'use CPUs (${cpu_cost:.2f})'
+        else:
+            # same cost: cpu_sec * n = gpu_sec * (n + GPU_UNITS * gpus)
+            rec['GPU'] = f'keep if CPU version > {sec2timestr(time_mean * (n0 + GPU_UNITS * gpus) / n0)}'
+    return rec
+
+
+def recommend_resources(rscDf, tasks, step_mem, walltime=[], cpu_time=[], cpu_max=CPUS_PER_NODE_LIM,
+                        quantile=0.99, time_margin=1.2, mem_margin=1.25, packs={}):
+    """Recommendations of the steps of resources.cfg found in the finished run
+    rscDf:  with the rows of the fused jobs (add_fused_rows)
+    packs:  dict of {step name: (lines per task, lines at once)} in the finished run, from read_line_time
+    Return:
+        rec_df:     DataFrame of the recommendations, one row per step
+    """
+    walltime, cpu_time = parse_overrides(walltime), parse_overrides(cpu_time)
+    unknown = [x for x in tasks['Step'].unique() if x not in rscDf['Step'].values]
+    if unknown:
+        print(f' no row in resources.cfg for {", ".join(unknown)}, skip them')
+    recs = []
+    for _, row in rscDf.iterrows():
+        step = row['Step']
+        step_tasks = tasks[tasks['Step'] == step]
+        # CPUs of the topo step are set from its num of processes (write_slurmJobs.py --topo-threads)
+        if len(step_tasks) == 0 or step == TOPO_STEP:
+            continue
+        target = walltime.get(step, walltime.get('*', row['Time']))
+        max_mem_mb = step_tasks['MaxRSS_mb'].max()
+        if np.isnan(max_mem_mb):
+            max_mem_mb = step_mem.get(step, np.nan)
+        recs.append(recommend_step(step_tasks, row, timestr2sec(target)[0], max_mem_mb, cpu_time.get(step),
+                                   cpu_max, quantile, time_margin, mem_margin, packs.get(step, (1, 1))))
+    return pd.DataFrame(recs)
+
+
+def update_resources(rscDf, rec_df):
+    """Resources config table with the recommended CPUs and memory per CPU
+    """
+    rscDf = rscDf.copy()
+    rec = rec_df.set_index('Step')
+    flag = rscDf['Step'].isin(rec.index)
+    rscDf.loc[flag, 'Ncpus_per_task'] = rscDf.loc[flag, 'Step'].map(rec['Rec CPUs']).astype(int)
+    rscDf.loc[flag, 'Mem_per_cpu'] = rscDf.loc[flag, 'Step'].map(rec['Rec Mem_per_cpu'])
+    return rscDf
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    # fused jobs of the finished run, with the resources of their job
+    rscDf = read_resources(inps.rsc_file)
+    fused = read_fused_steps(os.path.join(os.path.dirname(inps.time_file), FUSE_FILE))
+    time_df, packs = read_line_time(inps.time_file, add_fused_rows(rscDf, fused), fused)
+    tasks = read_task_efficiency(time_df, inps.eff_file, inps.sacct)
+    step_mem = read_step_mem(inps.mem_file) if not inps.sacct else pd.Series(dtype=float)
+
+    rec_df = recommend_resources(add_fused_rows(rscDf, fused), tasks, step_mem, inps.walltime, inps.cpu_time,
+                                 inps.cpu_max, inps.quantile, inps.time_margin, inps.mem_margin, packs)
+    print(rec_df.to_string(index=False, float_format='{:.2f}'.format))
+    print(f'# Cost: ${rec_df["Cost ($)"].sum():.2f} as run, ${rec_df["Rec cost ($)"].sum():.2f} with the recommended CPUs')
+    for name in [x for x in fused if x in rec_df['Step'].values]:
+        print(f'# {name}: fused job of {", ".join(fused[name])}, apply its recommendation to these steps by hand')
+
+    if inps.out_file:
+        write_resources(update_resources(rscDf, rec_df), inps.out_file)
+        print(f'Recommended resources written to {inps.out_file}, check it and use it with write_slurmJobs.py -r {inps.out_file}')
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
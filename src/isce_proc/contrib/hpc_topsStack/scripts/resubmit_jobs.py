@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+############################################################
+# Find the array tasks of the topsStack jobs that failed or timed out, resubmit them
+# and rebuild the rest of the chain on top of them
+#
+# This script is executed under run_files/
+############################################################
+# + The jobs are read from the job_id_logfile written by submit_chained_dependencies.sh,
+#   their dependencies from job_dependencies.txt (or the previous step if not available)
+# + The states of their array tasks are queried with one sacct call
+# + Each job with tasks in RESUBMIT_STATES is resubmitted from its .job script, for the task IDs not completed
+#   only (sbatch --array=3,17,250). The task IDs select the same lines of the run file. Resources are scaled up:
+#       - TIMEOUT:          walltime x --time-factor
+#       - OUT_OF_MEMORY:    memory x --mem-factor
+# + The jobs depending on them (directly or not) never start (DependencyNeverSatisfied), their pending tasks are
+#   cancelled and resubmitted with `afterok` on the new jobs
+# + The new job IDs are appended to the job_id_logfile
+# + Run it when no task of these jobs is running anymore
+
+import argparse
+import glob
+import os
+import re
+import sys
+
+from adapt_throttle import slurm_cmd
+from write_slurmJobs import timestr2sec, sec2timestr, memstr2mb, mb2memstr
+
+
+# array task states to resubmit
+# (a failing command cancels its own task with scancel in the job script, so CANCELLED is also a failure)
+RESUBMIT_STATES = ['TIMEOUT', 'OUT_OF_MEMORY', 'FAILED', 'CANCELLED', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE']
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Resubmit the failed/timed-out array tasks of the topsStack jobs and rebuild the chain after them'
+
+    EXAMPLE = f"""Examples:
+        # check the jobs of the latest job_id_logfile_*.txt, print what would be resubmitted
+        {os.path.basename(__file__)} --dry-run
+
+        # resubmit with 3x the walltime for the timeouts, 2x the memory for out-of-memory tasks
+        {os.path.basename(__file__)} -i job_id_logfile_2025-05-01.txt --time-factor 3 --mem-factor 2
+
+        # only the timeouts
+        {os.path.basename(__file__)} --states TIMEOUT
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('-i', '--id-log', dest='id_logfile', type=str, default=None,
+                        help = 'job_id_logfile of the submitted jobs (default: the latest job_id_logfile_*.txt)')
+    parser.add_argument('--dep-file', dest='dep_file', type=str, default='job_dependencies.txt',
+                        help = 'job dependency table written by write_slurmJobs.py (default: %(default)s)')
+    parser.add_argument('--states', dest='states', type=str, nargs='+', default=RESUBMIT_STATES,
+                        help = 'array task states to resubmit (default: %(default)s)')
+    parser.add_argument('--time-factor', dest='time_factor', type=float, default=2.0,
+                        help = 'factor on the walltime of the job script, for TIMEOUT tasks (default: %(default)s)')
+    parser.add_argument('--mem-factor', dest='mem_factor', type=float, default=2.0,
+                        help = 'factor on the memory of the job script, for OUT_OF_MEMORY tasks (default: %(default)s)')
+    parser.add_argument('--slurm-bin', dest='slurm_bin', type=str, default='',
+                        help = 'dir of the slurm commands sacct/sbatch (default: from $PATH)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help = 'print the sbatch commands instead of running them')
+    return parser
+
+
+#########################################################################################
+
+def read_job_log(id_logfile=None, print_msg=True):
+    """Read the job names and IDs from the job_id_logfile written by submit_chained_dependencies.sh
+    Return:
+        id_logfile: the file read
+        jobs:       list of (job name, job ID), in submission order; a resubmitted job name appears again
+    """
+    if not id_logfile:
+        id_logfiles = sorted(glob.glob('job_id_logfile_*.txt'), key=os.path.getmtime)
+        if not id_logfiles:
+            raise Exception('No job_id_logfile_*.txt found, give it with -i')
+        id_logfile = id_logfiles[-1]
+    jobs = []
+    with open(id_logfile) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) == 2 and tokens[1].isdigit():
+                jobs.append((tokens[0], tokens[1]))
+    if print_msg:
+        print(f'read {len(jobs)} jobs from {id_logfile}')
+    return id_logfile, jobs
+
+
+def read_dependencies(dep_file, jobs):
+    """Read the job dependencies written by write_slurmJobs.py
+    Without the file, each job depends on all the jobs of the previous step, as in submit_chained_dependencies.sh
+    Return:
+        deps:   dict of {job name: list of job names after}
+    """
+    if os.path.isfile(dep_file):
+        deps = {}
+        with open(dep_file) as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) < 3 or tokens[0].startswith('#'):
+                    continue
+                deps[tokens[0]] = [] if tokens[2] == '-' else tokens[2].split(',')
+        return deps
+
+    step_num = lambda name: re.match(r'run_?(\d+)', name).group(1)
+    names = list(dict.fromkeys(name for name, _ in jobs))
+    deps, prev, step = {}, [], []
+    for i, name in enumerate(names):
+        if i > 0 and step_num(name) != step_num(names[i-1]):
+            prev, step = step, []
+        deps[name] = list(prev)
+        step.append(name)
+    return deps
+
+
+def read_dependency_types(dep_file):
+    """Read the dependency type (none, afterok, aftercorr) of each job written by write_slurmJobs.py
+    Return:
+        dtypes: dict of {job name: dependency type}; empty without the file (afterok on the previous step)
+    """
+    dtypes = {}
+    if os.path.isfile(dep_file):
+        with open(dep_file) as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) >= 3 and not tokens[0].startswith('#'):
+                    dtypes[tokens[0]] = tokens[1]
+    return dtypes
+
+
+def query_task_states(job_ids, slurm_bin=''):
+    """State of each array task, with one sacct call
+    Return:
+        states:     dict of {job ID: {task ID: state}}
+        pending:    set of job IDs with pending tasks
+    """
+    out = slurm_cmd(['sacct', '-X', '-n', '-P', '-o', 'JobID,State', '-j', ','.join(job_ids)], slurm_bin)
+    states, pending = {}, set()
+    for line in out.splitlines():
+        job, _, state = line.partition('|')
+        job_id, _, task = job.partition('_')
+        # e.g. "CANCELLED by 1234"
+        state = state.split()[0] if state.strip() else ''
+        if task.isdigit():
+            tasks = [int(task)]
+        elif task.startswith('['):
+            # pending tasks, e.g. 1234_[2-3,5%200]
+            tasks = expand_ids(task.strip('[]').partition('%')[0])
+        else:
+            continue
+        if state == 'PENDING':
+            pending.add(job_id)
+        for i in tasks:
+            states.setdefault(job_id, {})[i] = state
+    return states, pending
+
+
+def read_sbatch_opts(job_file):
+    """Read the #SBATCH options of a job script
+    Return:
+        opts:   dict of {option: value}, e.g. {'time': '3:00:00', 'array': '1-300%200'}
+    """
+    opts = {}
+    with open(job_file) as f:
+        for line in f:
+            match = re.match(r'#SBATCH\s+--([\w-]+)=(\S+)', line)
+            if match:
+                opts[match.group(1)] = match.group(2)
+    return opts
+
+
+def expand_ids(array):
+    """Task IDs of a slurm --array list, e.g. '1-3,7' -> [1,2,3,7]
+    """
+    ids = []
+    for part in array.split(','):
+        start, _, end = part.partition('-')
+        ids += list(range(int(start), int(end or start)+1))
+    return ids
+
+
+def compress_ids(ids):
+    """Task IDs as a slurm --array list, with ranges, e.g. [1,2,3,7] -> '1-3,7'
+    """
+    ids = sorted(ids)
+    ranges = []
+    start = prev = ids[0]
+    for i in ids[1:] + [None]:
+        if i is not None and i == prev + 1:
+            prev = i
+            continue
+        ranges.append(f'{start}' if start == prev else f'{start}-{prev}')
+        if i is not None:
+            start = prev = i
+    return ','.join(ranges)
+
+
+def resubmit_tasks(job_name, task_ids, inps, task_states=(), dependency=None):
+    """Resubmit some array tasks of a job script, with resources scaled up for their failure states
+    Return:
+        job_id:     the new job ID
+    """
+    job_file = f'{job_name}.job'
+    opts = read_sbatch_opts(job_file)
+    throttle = opts.get('array', '').partition('%')[2]
+    array = compress_ids(task_ids) + (f'%{throttle}' if throttle else '')
+
+    logfiles = sorted(glob.glob('cmd_runall_*.log'), key=os.path.getmtime)
+    logfile = logfiles[-1] if logfiles else 'cmd_runall_resubmit.log'
+
+    args = ['sbatch', '--parsable', f'--array={array}']
+    msg = f' {job_name}: resubmit {len(task_ids)} tasks'
+    if 'TIMEOUT' in task_states:
+        time = sec2timestr(timestr2sec(opts['time'])[0] * inps.time_factor)
+        args.append(f'--time={time}')
+        msg += f', walltime {opts["time"]} -> {time}'
+    if 'OUT_OF_MEMORY' in task_states:
+        mem = mb2memstr(memstr2mb(opts['mem-per-cpu']) * inps.mem_factor)
+        args.append(f'--mem-per-cpu={mem}')
+        msg += f', mem-per-cpu {opts["mem-per-cpu"]} -> {mem}'
+    if dependency:
+        args.append(f'--dependency={dependency}')
+        msg += f', {dependency}'
+    args += [f'--export=ALL,logfile={logfile}', job_file]
+
+    print(msg)
+    if inps.dry_run:
+        print(' (dry-run) ' + ' '.join(args))
+        return f'<{job_name}>'
+    return slurm_cmd(args, inps.slurm_bin).strip()
+
+
+def cancel_pending(job_id, inps):
+    """Cancel the pending tasks of a job, which would never start
+    """
+    args = ['scancel', '--state=PENDING', job_id]
+    if inps.dry_run:
+        print(' (dry-run) ' + ' '.join(args))
+    else:
+        slurm_cmd(args, inps.slurm_bin)
+
+
+def resubmit_jobs(inps):
+    """Resubmit the tasks of each job in inps.states, and the not-completed tasks of the jobs after them
+    """
+    id_logfile, jobs = read_job_log(inps.id_logfile)
+    deps = read_dependencies(inps.dep_file, jobs)
+
+    # all the submissions of each job (resubmitted tasks count as done once completed), and its latest ID
+    job_ids = {}
+    for job_name, job_id in jobs:
+        job_ids.setdefault(job_name, []).append(job_id)
+    latest = {job_name: ids[-1] for job_name, ids in job_ids.items()}
+    states, pending = query_task_states([job_id for ids in job_ids.values() for job_id in ids], inps.slurm_bin)
+
+    new_jobs = []
+    rebuilt = set()
+    for job_name, ids in job_ids.items():
+        # latest state of each task over the submissions
+        task_states = {}
+        for job_id in ids:
+            task_states.update(states.get(job_id, {}))
+        failed = {task: state for task, state in task_states.items() if state in inps.states}
+        after = deps.get(job_name, [])
+        upstream = [x for x in after if x in rebuilt]
+        if not failed and not upstream:
+            continue
+
+        if any(state == 'RUNNING' for state in task_states.values()):
+            raise Exception(f'{job_name} still has running tasks, run this again when they are done')
+
+        # tasks not completed yet
+        num_task = int(re.match(r'\d+-(\d+)', read_sbatch_opts(f'{job_name}.job')['array']).group(1))
+        task_ids = [i for i in range(1, num_task+1) if task_states.get(i) != 'COMPLETED']
+        if not task_ids:
+            continue
+        if latest[job_name] in pending:
+            cancel_pending(latest[job_name], inps)
+
+        # afterok on the latest jobs it depends on (aftercorr no longer matches the task IDs)
+        dependency = None
+        if upstream:
+            dependency = 'afterok:' + ':'.join(latest[x] for x in after if x in latest)
+        new_id = resubmit_tasks(job_name, task_ids, inps, set(failed.values()), dependency)
+        latest[job_name] = new_id
+        rebuilt.add(job_name)
+        new_jobs.append((job_name, new_id))
+
+    if not new_jobs:
+        print(f'no task to resubmit ({", ".join(inps.states)})')
+        return new_jobs
+
+    if not inps.dry_run:
+        with open(id_logfile, 'a') as f:
+            f.write(f'# resubmitted by {os.path.basename(__file__)}\n')
+            for job_name, job_id in new_jobs:
+                f.write(f'{job_name:<47s} {job_id:<12s}\n')
+        print(f'append the new job IDs to {id_logfile}')
+    return new_jobs
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    resubmit_jobs(inps)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
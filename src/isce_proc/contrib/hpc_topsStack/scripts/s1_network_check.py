@@ -9,6 +9,7 @@ import sys
 import glob
 import argparse
 import numpy as np
+from scipy import sparse
 import matplotlib.pyplot as plt
 from mintpy.utils import ptime
 from mintpy.utils import plot as pp
@@ -50,6 +51,8 @@ def cmdLineParse():
             help = 'Name of the ifg stack. (E.g. unw, ion, ... default: %(default)s)')
     parser.add_argument('--spread', dest='spread', type=float, default=0.,
             help = 'Random spread of the starting ranges (meter in y-axis) for visualization. (default: %(default)s)')
+    parser.add_argument('--suggest', dest='num_suggest', type=int, default=1,
+            help = 'Number of extra pairs to suggest across each bridge pair. (default: %(default)s)')
 
     inps = parser.parse_args()
     if len(sys.argv)<1:
@@ -106,37 +109,93 @@ def print_gaps(date_list, lack_ref, lack_sec):
     return
 
 
+def design_matrix(date12_list, date_list):
+    """
+    Sparse design matrix of the network, same as ifgramStack.get_design_matrix4timeseries(refDate='no')
+    without the dense (num_ifgs, num_dates) array
+    Return:
+        A:          Design matrix (num_ifgs, num_dates), scipy.sparse CSR: -1 at the reference date, 1 at the secondary
+    """
+    date_idx = {date: i for i, date in enumerate(date_list)}
+    pairs = np.array([[date_idx[d] for d in date12.split('_')] for date12 in date12_list], dtype=int).reshape(-1, 2)
+    num_ifg = len(pairs)
+    rows = np.repeat(np.arange(num_ifg), 2)
+    vals = np.tile([-1, 1], num_ifg)
+    return sparse.csr_matrix((vals, (rows, pairs.ravel())), shape=(num_ifg, len(date_list)))
+
+
+def pair_index(A):
+    """
+    Reference and secondary date index of each pair from the design matrix A
+    """
+    A = sparse.coo_matrix(A)
+    ref = np.zeros(A.shape[0], dtype=int)
+    sec = np.zeros(A.shape[0], dtype=int)
+    ref[A.row[A.data < 0]] = A.col[A.data < 0]
+    sec[A.row[A.data > 0]] = A.col[A.data > 0]
+    return ref, sec
+
+
 def find_npair(A):
     """
     Find the gap from a design matrix A
     Input:
-        A:          Design matrix (num_ifgs, num_dates)
+        A:          Design matrix (num_ifgs, num_dates), dense or sparse
     Return:
         num_pair:   num of pairs for each column (date)
     """
-    num_pair = []
-    for j in range(A.shape[1]):
-        num_r = sum(A[:,j]==1)
-        num_s = sum(A[:,j]==-1)
-        num_pair.append(num_r + num_s)
-    num_pair = np.array(num_pair)
-    return num_pair
+    return sparse.csc_matrix(A).getnnz(axis=0)
+
+
+def connected_components(num_date, ref, sec):
+    """
+    Connected components of the network, with a union-find over the pairs
+    (path halving and union by size, no recursion)
+    Return:
+        labels:     component label of each date, 0 to num_comp-1
+        num_comp:   num of components
+    """
+    parent = np.arange(num_date)
+    size = np.ones(num_date, dtype=int)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(ref, sec):
+        ri, rj = find(i), find(j)
+        if ri == rj:
+            continue
+        if size[ri] < size[rj]:
+            ri, rj = rj, ri
+        parent[rj] = ri
+        size[ri] += size[rj]
+
+    roots = np.array([find(i) for i in range(num_date)], dtype=int)
+    labels = np.unique(roots, return_inverse=True)[1]
+    return labels, labels.max()+1 if num_date else 0
 
 
 def check_rank(date_list, A):
-    rk = np.linalg.matrix_rank(A)
+    # rank of the design matrix (without reference date) = num of dates - num of connected networks
+    ref, sec = pair_index(A)
+    num_comp = connected_components(A.shape[1], ref, sec)[1]
+    rk = A.shape[1] - num_comp
     if rk < A.shape[1]-1:
         print('\nRank deficient. The network is disconnected.')
         print('Rank = {}; Num of coloumns (numDate-1) = {}'.format(rk, A.shape[1]-1))
     else:
         print('Full rank. The network is fully connected')
-    lack_ref = []
-    lack_sec = []
-    for j in range(A.shape[1]):
-        if (-1 not in A[:,j]) and (j != A.shape[1]-1):
-            lack_ref.append(j)
-        if ( 1 not in A[:,j]) and (j != 0):
-            lack_sec.append(j)
+
+    # dates never used as reference (except the last one) / as secondary (except the first one)
+    A = sparse.csc_matrix(A)
+    num_ref = np.asarray((A < 0).sum(axis=0)).ravel()
+    num_sec = np.asarray((A > 0).sum(axis=0)).ravel()
+    j = np.arange(A.shape[1])
+    lack_ref = list(np.flatnonzero((num_ref == 0) & (j != A.shape[1]-1)))
+    lack_sec = list(np.flatnonzero((num_sec == 0) & (j != 0)))
 
     print_gaps(date_list, lack_ref, lack_sec)
     mark_dates = []
@@ -146,54 +205,12 @@ def check_rank(date_list, A):
     return mark_dates
 
 
-def networking(friends, sortbylen=True):
-    # person's friendship circle (network) is a person themselves
-    # plus friendship circles of all their direct friends
-    # minus already seen people
-    # https://stackoverflow.com/questions/15331877/creating-dictionaries-of-friends-that-know-other-friends-in-python
-    def friends_graph(people_all, friends):
-        # graph of friends (adjacency lists representation)
-        G = {p: [] for p in people_all} # person -> direct friends list
-        for friend in friends:
-            for p in friend:
-                f_list = list(friend)
-                f_list.remove(p)
-                G[p].extend(f_list)
-        return G
-
-    def friendship_circle(person): # a.k.a. connected component
-        seen.add(person)
-        yield person
-        for friend in direct_friends[person]:
-            if friend not in seen:
-                yield from friendship_circle(friend)
-
-    people_all = list(set(sum(friends, [])))
-    direct_friends = friends_graph(people_all, friends)
-    seen = set() # already seen people
-
-    # group people into friendship circles
-    circs = (friendship_circle(p) for p in people_all if p not in seen)
-
-    # convert generator to a list with sublist(s)
-    circ_lists = []
-    for circ in circs:
-        member = sorted(list(circ))
-        circ_lists.append(member)
-
-    if sortbylen:
-        circ_lists.sort(key=len, reverse=True)
-
-    return circ_lists
-
-
 def find_networks(A, date_list, date12_list, s1_dict=None):
-    pairs = []
-    for row in A:
-        date12_idx = list(np.nonzero(row)[0])
-        pairs.append(date12_idx)
-
-    nets = networking(pairs)
+    # connected networks as lists of date indices, largest first
+    ref, sec = pair_index(A)
+    labels, num_comp = connected_components(A.shape[1], ref, sec)
+    nets = [list(np.flatnonzero(labels == k)) for k in range(num_comp)]
+    nets.sort(key=len, reverse=True)
     print('\nNumber of networks found: {}\n'.format(len(nets)))
 
     date_groups = []
@@ -206,13 +223,151 @@ def find_networks(A, date_list, date12_list, s1_dict=None):
             for date in dates:
                 print('{}\t{}'.format(date, s1_dict[date][2]))
         date_groups.append(dates)
-        date12_groups.append([])
-        for date12 in date12_list:
-            if bool(set(date12.split('_')) & set(dates)):
-                date12_groups[i].append(date12)
+        # pairs of the network, i.e. with their reference date in it
+        in_net = np.isin(ref, date_id)
+        date12_groups.append(list(np.array(date12_list)[in_net]))
     return nets, date_groups, date12_groups
 
 
+def find_bridges(num_date, ref, sec, return_dfs=False):
+    """
+    Bridge pairs and articulation dates of the network, with an iterative Tarjan DFS (linear time, no recursion)
+        - bridge pair:          its loss splits a network in two
+        - articulation date:    its loss (all its pairs) splits a network
+    Repeated pairs count as parallel edges (never a bridge).
+    Return:
+        is_bridge:  bool array, for each pair
+        is_art:     bool array, for each date
+        disc, last: DFS discovery time of each date and the last one in its DFS subtree (if return_dfs),
+                    the dates cut off by a bridge are the subtree of its later-discovered date
+    """
+    # adjacency lists of the dates as CSR arrays: neighbor date and pair index
+    ends  = np.concatenate([ref, sec])
+    nbrs  = np.concatenate([sec, ref])
+    eids  = np.tile(np.arange(len(ref)), 2)
+    order = np.argsort(ends, kind='stable')
+    nbrs, eids = nbrs[order].tolist(), eids[order].tolist()
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=num_date))]).tolist()
+
+    disc = [-1] * num_date      # discovery time
+    low  = [0] * num_date       # lowest discovery time reachable with one back edge
+    last = [0] * num_date       # last discovery time in the DFS subtree
+    is_bridge = np.zeros(len(ref), dtype=bool)
+    is_art    = np.zeros(num_date, dtype=bool)
+    timer = 0
+    for root in range(num_date):
+        if disc[root] >= 0:
+            continue
+        disc[root] = low[root] = last[root] = timer
+        timer += 1
+        num_child = 0
+        stack = [[root, -1, indptr[root]]]     # date, pair to its parent, next adjacency pointer
+        while stack:
+            item = stack[-1]
+            u, pe, ptr = item
+            if ptr < indptr[u+1]:
+                item[2] += 1
+                v, e = nbrs[ptr], eids[ptr]
+                if e == pe:
+                    continue
+                if disc[v] < 0:
+                    disc[v] = low[v] = last[v] = timer
+                    timer += 1
+                    stack.append([v, e, indptr[v]])
+                    num_child += (u == root)
+                else:
+                    low[u] = min(low[u], disc[v])
+            else:
+                stack.pop()
+                if stack:
+                    p = stack[-1][0]
+                    low[p] = min(low[p], low[u])
+                    last[p] = max(last[p], last[u])
+                    if low[u] > disc[p]:
+                        is_bridge[pe] = True
+                    if p != root and low[u] >= disc[p]:
+                        is_art[p] = True
+        is_art[root] = num_child > 1
+    if return_dfs:
+        return is_bridge, is_art, np.array(disc), np.array(last)
+    return is_bridge, is_art
+
+
+def suggest_pairs(date_list, date12_list, ref, sec, num=1):
+    """
+    Extra pairs to add across each bridge: the pairs with the shortest temporal baseline between the two sides
+    of the bridge, not in the network yet. Any of them closes a loop over the bridge.
+    Return:
+        suggest:    dict of {bridge date12: [suggested date12]}
+    """
+    is_bridge, _, disc, last = find_bridges(len(date_list), ref, sec, return_dfs=True)
+    labels = connected_components(len(date_list), ref, sec)[0]
+    days = np.array(['{}-{}-{}'.format(d[:4], d[4:6], d[6:8]) for d in date_list], dtype='datetime64[D]').astype(int)
+    existing = set(date12_list)
+
+    suggest = {}
+    for e in np.flatnonzero(is_bridge):
+        # the side cut off by the bridge is the DFS subtree of its later-discovered date
+        c = ref[e] if disc[ref[e]] > disc[sec[e]] else sec[e]
+        side1 = (disc >= disc[c]) & (disc <= last[c])
+        side2 = np.flatnonzero((labels == labels[c]) & ~side1)
+        side1 = np.flatnonzero(side1)
+        # for each date of a side, its nearest dates before/after on the other side (dates are sorted in time)
+        i, j = [], []
+        for a, b in [(side1, side2), (side2, side1)]:
+            pos = np.searchsorted(b, a)
+            i += [a, a]
+            j += [b[np.maximum(pos-1, 0)], b[np.minimum(pos, len(b)-1)]]
+        i, j = np.concatenate(i), np.concatenate(j)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        cands = []
+        for k in np.argsort(days[j] - days[i], kind='stable'):
+            date12 = '{}_{}'.format(date_list[i[k]], date_list[j[k]])
+            if date12 not in existing and date12 not in cands:
+                cands.append(date12)
+                if len(cands) >= num:
+                    break
+        suggest[date12_list[e]] = cands
+    return suggest
+
+
+def check_robustness(date_list, date12_list, A, num_suggest=1, out_file=None):
+    """
+    Bridge pairs, articulation dates and redundant pairs of each date, with the extra pairs to add across the bridges
+        - redundant pairs of a date: its pairs on a loop of the network (not bridges), any one of them can be lost
+          without cutting the date off through that pair
+    """
+    ref, sec = pair_index(A)
+    is_bridge, is_art = find_bridges(A.shape[1], ref, sec)
+    num_pair = find_npair(A)
+    num_bridge = np.bincount(np.concatenate([ref[is_bridge], sec[is_bridge]]), minlength=A.shape[1])
+    num_redund = num_pair - num_bridge
+
+    print('\nNumber of bridge pairs (the loss of one splits the network): {}'.format(is_bridge.sum()))
+    print('Number of articulation dates (the loss of one splits the network): {}'.format(is_art.sum()))
+    if is_art.any():
+        print('Articulation dates: {}'.format(np.array(date_list)[is_art]))
+    if (num_redund == 0).any():
+        print('Dates with no redundant pair: {}'.format(np.array(date_list)[num_redund == 0]))
+
+    suggest = suggest_pairs(date_list, date12_list, ref, sec, num_suggest)
+    if suggest:
+        print('Bridge pair		Suggested extra pair(s)')
+        for date12, cands in suggest.items():
+            print('{}	{}'.format(date12, ' '.join(cands) if cands else '(none possible)'))
+
+    if out_file:
+        with open(out_file, 'w') as f:
+            f.write('# Date      Num_pairs  Redundant_pairs  Bridge_pairs  Articulation\n')
+            for i, date in enumerate(date_list):
+                f.write('{:<12s}{:>9d}{:>17d}{:>14d}{:>14d}\n'.format(date, num_pair[i], num_redund[i], num_bridge[i],
+                                                                     int(is_art[i])))
+            for date12, cands in suggest.items():
+                f.write('# bridge {}: add {}\n'.format(date12, ' '.join(cands) if cands else '(none possible)'))
+        print('Robustness of each date written to {}'.format(out_file))
+    return is_bridge, is_art, num_redund, suggest
+
+
 def read_s1_version(file):
     ddict = dict()
     with open(file) as f:
@@ -251,7 +406,7 @@ def readfromDir(dir_list, sep):
         mDates.append(mdate)
         sDates.append(sdate)
     date_list = sorted(list(set(mDates + sDates)))
-    A = ifgramStack.get_design_matrix4timeseries(date12_list, refDate='no')[0]
+    A = design_matrix(date12_list, date_list)
     return A, date12_list ,date_list
 
 
@@ -271,7 +426,7 @@ def readListFile(listfile, sep='_', prestr=None):
             mDates.append(mdate)
             sDates.append(sdate)
         date_list = sorted(list(set(mDates + sDates)))
-    A = ifgramStack.get_design_matrix4timeseries(date12_list, refDate='no')[0]
+    A = design_matrix(date12_list, date_list)
     return A, date12_list ,date_list
 
 
@@ -280,7 +435,7 @@ def readStackHDF5(ifgfile):
     date12_list = obj.get_date12_list(dropIfgram=False)
     date_list   = obj.get_date_list(dropIfgram=False)
     # get the design matrix of the network
-    A = obj.get_design_matrix4timeseries(date12_list, refDate='no')[0]    # , refDate='no'
+    A = design_matrix(date12_list, date_list)
     return A, date12_list, date_list
 
 
@@ -622,6 +777,10 @@ def main(inps):
     nets, date_groups, date12_groups = find_networks(A, date_list, date12_list, s1_dict=None)
 
 
+    ## Find the weak spots: pairs and dates whose loss would split the network, and the pairs to add against it
+    check_robustness(date_list, date12_list, A, inps.num_suggest, 'networkRobustness_{}.txt'.format(inps.name))
+
+
     ## Plot the network
     call_plot_networks(nets, npairs, date_list, date_groups, date12_groups, s1_dict, inps.spread, inps.name, mark_dates)
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+############################################################
+# What-if simulator of the makespan, core-hours and cost of a topsStack run, replayed from its recorded timings
+#
+# This script is executed under run_files/ of a finished run (after run_atTheEnd.sh)
+############################################################
+# + The duration of each line of the run files comes from time_unix.txt (elapsed time of each array task, divided
+#   among the lines it ran if packed), the settings of the recorded run from its resources.cfg
+# + The workflow is replayed under other settings, for all steps or for some of them (STEP=VALUE):
+#       - batch:    array throttle, at most this many tasks of a step run at once
+#       - cpus:     Ncpus_per_task; the durations scale with Amdahl's law, parallel fraction --par-frac
+#       - pack:     `K` or `KxP` lines per array task, each task pays --task-overhead (scheduling, start-up) once
+#       - dep:      `step`, each step waits for the whole previous step (afterok), plus --step-wait;
+#                   `task`, task i waits for task i of the previous step (aftercorr), between PIPELINE_STEPS
+#                   with the same number of tasks, as write_slurmJobs.py does
+# + Each array task starts at the earliest free throttle slot after its dependency, in array order (list scheduling)
+# + Core-hours and cost as in analyse_time_resource.py (COST_RATE per CPU hour, GPU_UNITS per GPU hour)
+# + Not modelled: the wait for free nodes in the partition, file-system contention at high throttles
+
+import argparse
+import heapq
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from analyse_time_resource import read_time_table, COST_RATE, GPU_UNITS
+from write_slurmJobs import (read_resources, parse_pack, sec2timestr, read_fused_steps, add_fused_rows,
+                             rsc_row, read_line_time, FUSE_FILE, PIPELINE_STEPS, SLURM_MAX_ARRAY_SIZE)
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Replay a finished topsStack run under other throttles/CPUs/packing/dependencies: makespan, core-hours, cost'
+
+    EXAMPLE = f"""Examples:
+        # the recorded settings, to compare the simulated makespan with the measured one
+        {os.path.basename(__file__)} -t log_files/time_unix.txt
+
+        # throttle 400 for all steps, 8 CPUs for unwrap
+        {os.path.basename(__file__)} -t log_files/time_unix.txt --batch 400 --cpus unwrap=8
+
+        # pack 4 lines per task for the ionosphere steps, whole-step dependencies
+        {os.path.basename(__file__)} -t log_files/time_unix.txt --pack look_ion=4 computeIon=4 filtIon=4 --dep step
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('-t', '--time', dest='time_file', type=str, default='log_files/time_unix.txt',
+                        help = 'time_unix.txt of the recorded run (default: %(default)s)')
+    parser.add_argument('-r', '--rsc', dest='rsc_file', type=str, default='resources.cfg',
+                        help = 'resources config table of the recorded run (default: %(default)s)')
+    parser.add_argument('--batch', dest='batch', type=str, nargs='+', default=[],
+                        help = 'array throttle, VALUE for all steps or STEP=VALUE')
+    parser.add_argument('--cpus', dest='cpus', type=str, nargs='+', default=[],
+                        help = 'CPUs per command, VALUE for all steps or STEP=VALUE')
+    parser.add_argument('--pack', dest='pack', type=str, nargs='+', default=[],
+                        help = 'lines per array task as K or KxP, VALUE for all steps or STEP=VALUE')
+    parser.add_argument('--dep', dest='dep', type=str, choices=['step', 'task'], default='task',
+                        help = 'dependency mode: step (afterok) or task (aftercorr between PIPELINE_STEPS) (default: %(default)s)')
+    parser.add_argument('--par-frac', dest='par_frac', type=float, default=0.8,
+                        help = 'parallel fraction of the commands, for the Amdahl scaling with --cpus (default: %(default)s)')
+    parser.add_argument('--task-overhead', dest='task_overhead', type=float, default=30,
+                        help = 'seconds of scheduling/start-up per array task (default: %(default)s)')
+    parser.add_argument('--step-wait', dest='step_wait', type=float, default=0,
+                        help = 'seconds of queue wait before a step starts after the previous one (afterok) (default: %(default)s)')
+    parser.add_argument('-o', '--out', dest='out_file', type=str, default=None,
+                        help = 'write the per-step table of the scenario to this file')
+
+    if len(sys.argv) <= 1:
+        print('')
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return parser
+
+
+#########################################################################################
+
+def parse_overrides(values):
+    """Parse the STEP=VALUE / VALUE settings of the command line
+    Return:
+        overrides:  dict of {step name or '*': value}
+    """
+    overrides = {}
+    for value in values:
+        step, sep, val = value.rpartition('=')
+        overrides[step if sep else '*'] = val
+    return overrides
+
+
+def read_line_times(time_file, rscDf, fused={}):
+    """Duration of each line of the run files in the recorded run, in the order of the arrays
+    Return:
+        line_times: dict of {step name: array of seconds}, in the order of the steps
+        packs:      dict of {step name: (lines per task, lines at once)} in the recorded run
+    """
+    df, packs = read_line_time(time_file, rscDf, fused)
+    df = df.sort_values(['Start', 'Job ID', 'Slurm array'], kind='stable')
+
+    line_times = {}
+    for step, step_df in df.groupby('Step', sort=False):
+        step_df = step_df.sort_values(['Job ID', 'Slurm array'])
+        line_times[step] = np.repeat(step_df['Elapsed'].to_numpy(), packs[step][0])
+    return line_times, packs
+
+
+def step_settings(rscDf, step, rec_pack, inps=None, fused={}):
+    """Settings of a step: recorded ones from resources.cfg (and the recorded packing), updated by the command-line overrides
+    Return:
+        settings:   dict of cpus, gres, batch, pack, pack_procs, cpus0 (recorded CPUs), and names (member steps if fused)
+    """
+    row = rsc_row(rscDf, step)
+    cpus  = int(row['Ncpus_per_task']) if row is not None else 1
+    gres  = int(row['Gres']) if row is not None else 0
+    batch = int(row['batch']) if row is not None else SLURM_MAX_ARRAY_SIZE
+    settings = dict(cpus=cpus, cpus0=cpus, gres=gres, batch=batch, pack=rec_pack[0], pack_procs=rec_pack[1],
+                    names=fused.get(step, [step]))
+
+    if inps is not None:
+        for key, values in [('batch', inps.batch), ('cpus', inps.cpus), ('pack', inps.pack)]:
+            overrides = parse_overrides(values)
+            value = overrides.get(step, overrides.get('*'))
+            if value is None:
+                continue
+            if key == 'pack':
+                settings['pack'], settings['pack_procs'] = parse_pack(value)
+                if settings['pack'] == 'auto':
+                    raise Exception(f'--pack {value}: give the lines per task, `auto` depends on the run')
+            else:
+                settings[key] = int(value)
+    return settings
+
+
+def simulate(line_times, settings, dep='task', par_frac=0.8, task_overhead=30, step_wait=0):
+    """Replay the steps with list scheduling
+    Return:
+        sim_df:     per-step table of Tasks, Start, Finish (sec from the first submission), Core hours, CPU units, Cost ($)
+    """
+    rows = []
+    prev_step, prev_finish = None, np.zeros(0)
+    for step, times in line_times.items():
+        s = settings[step]
+        pack, procs = s['pack'], s['pack_procs']
+
+        # Amdahl's law for the CPUs of each command
+        times = times * ((1 - par_frac) + par_frac * s['cpus0'] / s['cpus'])
+
+        # packed tasks: `procs` lanes, each running its lines one after another
+        durations = np.array([max(times[j:j+pack][lane::procs].sum() for lane in range(procs)) + task_overhead
+                              for j in range(0, len(times), pack)])
+
+        # dependency on the previous step
+        per_task = (dep == 'task' and prev_step is not None and len(prev_finish) == len(durations)
+                    and all(name in PIPELINE_STEPS for name in settings[prev_step]['names'] + s['names']))
+        if per_task:
+            ready = prev_finish
+        else:
+            ready = np.full(len(durations), prev_finish.max() + step_wait if len(prev_finish) else 0.)
+
+        # at most `batch` tasks at once, in array order
+        slots = [0.] * max(min(s['batch'], len(durations)), 1)
+        finish = np.zeros(len(durations))
+        for i, duration in enumerate(durations):
+            start = max(ready[i], heapq.heappop(slots))
+            finish[i] = start + duration
+            heapq.heappush(slots, finish[i])
+
+        cpus = s['cpus'] * procs
+        hours = durations.sum() / 3600
+        units = (cpus + s['gres'] * GPU_UNITS) * hours
+        rows.append([step, len(durations), s['batch'], cpus, f'{pack}x{procs}',
+                     (finish - durations).min(), finish.max(), cpus * hours, units, units * COST_RATE])
+        prev_step, prev_finish = step, finish
+
+    columns = ['Step', 'Tasks', 'Batch', 'CPUs', 'Pack', 'Start', 'Finish', 'Core hours', 'CPU units', 'Cost ($)']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def print_summary(name, sim_df):
+    """Print the makespan, core-hours and cost of a simulated scenario
+    """
+    makespan = sim_df['Finish'].max()
+    print(f'# {name:<24s} makespan {sec2timestr(makespan):>12s}   core-hours {sim_df["Core hours"].sum():10.1f}   '
+          f'cost ${sim_df["Cost ($)"].sum():.2f}')
+    return makespan
+
+
+def run_simulation(inps):
+    """Simulate the recorded settings and the scenario of the command line
+    """
+    # fused steps of the recorded run, with the resources of their job
+    fused = read_fused_steps(os.path.join(os.path.dirname(inps.time_file), FUSE_FILE))
+    rscDf = add_fused_rows(read_resources(inps.rsc_file), fused)
+    line_times, packs = read_line_times(inps.time_file, rscDf, fused)
+
+    # the measured makespan, to check the simulation of the recorded settings
+    df = read_time_table(inps.time_file)
+    measured = (df['Finish'].max() - df['Start'].min()).total_seconds()
+
+    recorded = {step: step_settings(rscDf, step, packs[step], fused=fused) for step in line_times}
+    scenario = {step: step_settings(rscDf, step, packs[step], inps, fused) for step in line_times}
+    kwargs = dict(par_frac=inps.par_frac, task_overhead=inps.task_overhead, step_wait=inps.step_wait)
+    base_df = simulate(line_times, recorded, dep='task', **kwargs)
+    sim_df  = simulate(line_times, scenario, dep=inps.dep, **kwargs)
+
+    # steps on the critical path: the time each one adds to the makespan
+    sim_df['Adds'] = sim_df['Finish'] - sim_df['Finish'].shift(fill_value=0).cummax()
+    sim_df['Adds'] = sim_df['Adds'].clip(lower=0)
+    table = sim_df.copy()
+    for col in ['Start', 'Finish', 'Adds']:
+        table[col] = [sec2timestr(x) for x in table[col]]
+    print(table.to_string(index=False, float_format='{:.2f}'.format))
+    print('#####################################################')
+    print(f'# {"measured":<24s} makespan {sec2timestr(measured):>12s}   (first start to last finish in {inps.time_file})')
+    print_summary('recorded settings', base_df)
+    print_summary('scenario', sim_df)
+    print('#####################################################')
+
+    if inps.out_file:
+        with open(inps.out_file, 'w') as f:
+            table.to_string(f, index=False, float_format='{:.2f}'.format)
+        print(f'write the scenario to {inps.out_file}')
+    return sim_df
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+
+    run_simulation(inps)
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -147,7 +147,8 @@ now=$(date '+%Y-%m-%d %T')
 echo "$now"
 printf -v date '%(%Y-%m-%d)T' -1 # Store this command in $date for file naming
 # Explanation of the printf command: https://stackoverflow.com/questions/30098992/what-does-printf-v-do
-# TODO not sure if writing every array element to this log is helpful, probably slows things down quite a lot - consider removing
+# The array tasks do not write to this log (nor to the timing files) while running, each of them keeps its own records
+# under task_records/, merged into them by collect_task_records.py after the run
 logfile="cmd_runall_${date}.log"
 
 if [ -f "${logfile}" ] ; then
@@ -160,46 +161,75 @@ printf "    Submitting all jobs at: %s \n" "$(date)" >> "${logfile}"
 printf "####=========================================####\n" >> "${logfile}"
 printf "####=========================================####\n\n\n\n" >> "${logfile}"
 
-## Create files specifically for logging timings
-# One is in an easy format for quick inspection, the other in unix format for further processing
-# TODO add date to timings file - need to pass the name to sbatch
-fmt="%-35s%-12s%-12s%-12s%-12s%-12s\n" # Need to modify this in write_sbatch_files.py as well
-# printf -v date '%(%Y-%m-%d)T' -1 # Store this command in $date for file naming and start/ending times
-printf "# Job submitted at: %s\n" "$now" >> timings.txt
-printf "$fmt" "# Stage" "Job ID" "Array ID" "Start" "Finish" "Elapsed" >> timings.txt # Create a file to write all timings to, which is then written to by each stage
-# Write a file with unix times for later processing
-now_unix=$(date "+%s")
-printf "# Job submitted at: %s\n" "$now_unix" >> time_unix.txt
-printf "$fmt" "# Stage" "Job ID" "Array ID" "Start (s)" "Finish (s)" "Elapsed (s)" >> time_unix.txt # Create a file to write all timings to, which is then written to by each stage
+## Record the submission time, for the timing tables written by collect_task_records.py
+# (time_unix.txt in unix format for further processing, timings.txt for quick inspection)
+mkdir -p task_records
+printf "%s\n" "$(date "+%s")" >> task_records/submitted_at.txt
 
 ### SUBMIT JOBS
-# Submit the first job
-sbatch_file_to_submit=${sbatch_files[0]} # This is now the relative path
-run_file=$(basename "${sbatch_file_to_submit}" | cut -d. -f1)
-
-# Pass the logfile as an argument
-# Need 'ALL' so we get other environment variables
-# Add -q debug to use debug queue (will hit job threshold when using slurm arrays)
-ID=$(sbatch --parsable --export=ALL,logfile="${logfile}" "${sbatch_file_to_submit}")
-echo "Submitted 1/${num_file} ${sbatch_file_to_submit} - $ID"
+# Jobs of the same step (split into .pN.job parts or .cN.job memory classes) are submitted side by side,
+# each of them depending on all the jobs of the previous step (afterok).
+# If write_slurmJobs.py wrote job_dependencies.txt, follow it instead, e.g. task-by-task (aftercorr) dependencies
+# between index-aligned arrays. Fall back to the previous step when the jobs it lists are not submitted here.
+dep_file="job_dependencies.txt"
+declare -A dep_type=()  # job name -> dependency type (none, afterok, aftercorr)
+declare -A dep_after=() # job name -> comma-separated job names it depends on
+declare -A job_ids=()   # job name -> submitted job ID
+if [ -f "${dep_file}" ]; then
+    while read -r job dtype after; do
+        if [[ -z "${job}" || "${job}" == \#* ]]; then continue; fi
+        dep_type[$job]=${dtype}
+        dep_after[$job]=${after}
+    done < "${dep_file}"
+fi
+
 # Write a logfile with the ID of each stage
 id_logfile="job_id_logfile_${date}.txt"
 echo "IDs of Jobs submitted at: $now" >> "${id_logfile}"
-fmt_id="%-35s%-12s\\n"
+fmt_id="%-47s %-12s\\n"
 printf "$fmt_id" "Stage" "Job ID" >> "${id_logfile}"
-printf "$fmt_id" "${run_file}" "$ID" >> "${id_logfile}"
-# echo $ID >> $id_logfile
 
-# Loop over remaining scripts and submit them
-last_job_id="$ID" # Initialize with the first job's ID
-for ((i=1;i<${num_file};i++)); do
+prev_step=""    # step number of the previous job
+prev_ids=""     # IDs of the jobs in the previous step, as :id1:id2
+step_ids=""     # IDs of the jobs in the current step, as :id1:id2
+for ((i=0;i<${num_file};i++)); do
     sbatch_file_to_submit=${sbatch_files[i]}
-    run_file=$(basename "${sbatch_file_to_submit}" | cut -d. -f1)
+    job_name=$(basename "${sbatch_file_to_submit}" .job)
+    step_num=$(get_step_num "${sbatch_file_to_submit}")
+    if [ "${step_num}" != "${prev_step}" ]; then
+        prev_ids="${step_ids}"
+        step_ids=""
+        prev_step="${step_num}"
+    fi
+
+    # Dependency from job_dependencies.txt, if all the jobs it depends on are submitted here
+    dependency=""
+    dtype=${dep_type[$job_name]:-}
+    # A job deleting files (active clean_topsStack_files.sh line) must wait for the whole previous step
+    if [ "${dtype}" == "aftercorr" ] && grep -q '^[^#]*clean_topsStack_files.sh' "${sbatch_file_to_submit}"; then
+        dtype=""
+    fi
+    if [ -n "${dtype}" ] && [ "${dtype}" != "none" ]; then
+        ids=""
+        for after in ${dep_after[$job_name]//,/ }; do
+            if [ -z "${job_ids[$after]:-}" ]; then ids=""; break; fi
+            ids="${ids}:${job_ids[$after]}"
+        done
+        if [ -n "${ids}" ]; then dependency="--dependency=${dtype}${ids}"; fi
+    fi
+    # Otherwise, wait for all the jobs of the previous step
+    if [ -z "${dependency}" ] && [ -n "${prev_ids}" ]; then
+        dependency="--dependency=afterok${prev_ids}"
+    fi
 
-    ID=$(sbatch --parsable --dependency=afterok:"${last_job_id}" --export=ALL,logfile="${logfile}" "${sbatch_file_to_submit}")
-    printf "$fmt_id" "${run_file}" "$ID" >> "${id_logfile}"
+    # Pass the logfile as an argument
+    # Need 'ALL' so we get other environment variables
+    # Add -q debug to use debug queue (will hit job threshold when using slurm arrays)
+    ID=$(sbatch --parsable ${dependency} --export=ALL,logfile="${logfile}" "${sbatch_file_to_submit}")
+    step_ids="${step_ids}:${ID}"
+    job_ids[$job_name]=${ID}
+    printf "$fmt_id" "${job_name}" "$ID" >> "${id_logfile}"
     echo "Submitted $((i+1))/${num_file} ${sbatch_file_to_submit} - $ID"
-    last_job_id="$ID" # Update the dependency ID for the next iteration
 done
 
 # Note - if one job fails, all the rest will stay in the queue. Can kill all of your jobs by doing scancel -u <username>
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+############################################################
+# Stage the inputs/outputs of one run-file line on node-local scratch
+#
+# This script is executed under run_files/, by the job scripts of steps with `stage` = 1 in resources.cfg
+############################################################
+# + stage-in:   copy the inputs declared in the command's config file to the scratch dir ($TMPDIR),
+#               write a copy of the config pointing to the scratch dir, and print the command to run instead
+#               If the files to stage take more than STAGE_FREE_FRAC of the free space of the scratch dir,
+#               nothing is staged and the command runs in place (printed unchanged)
+# + stage-out:  move the files written in the scratch dir (new, or changed from the staged copy) back to the shared
+#               file system. Each file is copied next to its destination under a temporary name and renamed
+#               (os.replace), so other tasks never see a partially written output
+# + Inputs and outputs are the absolute paths in the config file:
+#       - outputs:  the values of OUTPUT_KEYS (staged in too if they exist, for the commands updating them in place)
+#       - inputs:   any other value that is an existing file or directory (with its .xml/.vrt/.hdr sidecars)
+# + size:       print the bytes of the outputs, for the disk-usage ledger of the job scripts (see collect_disk_usage.py)
+#               With --lines-file, one count per line of the file, to size all the lines of an array task at once
+#               Only the files created or modified since --since (the task start) count, each file once per call:
+#               a shared output dir is not counted again for every line. Its files written by other tasks running
+#               at the same time are still counted by each of them
+# + prefetch:   read the inputs into the page cache, while the previous command computes (GPU packed mode)
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+
+from write_slurmJobs import cmd_config, read_cmd_config
+
+
+# config keys naming the output file/dir of a topsStack command
+OUTPUT_KEYS = ['interferogram', 'output', 'outfile', 'outdir', 'outputDir', 'unw', 'filt']
+
+# max fraction of the free space of the scratch dir to stage in for one line
+# the PACK_PROCS lines of a task, and other jobs on the node, share the same local disk
+STAGE_FREE_FRAC = 0.5
+
+
+def cmdLineParse():
+    '''
+    Command line parsers
+    '''
+    description = 'Stage the inputs/outputs of a run-file line on node-local scratch'
+
+    EXAMPLE = f"""Examples:
+        cmd=$({os.path.basename(__file__)} stage-in  --scratch $TMPDIR/task -- SentinelWrapper.py -c ../configs/config_generateIgram_ion_20200101-20200113)
+        srun $cmd
+        {os.path.basename(__file__)} stage-out --scratch $TMPDIR/task -- SentinelWrapper.py -c ../configs/config_generateIgram_ion_20200101-20200113
+        {os.path.basename(__file__)} size --since 1746100000 --lines-file disk_usage/run_16_unwrap_1234_5.lines
+    """
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+
+    parser.add_argument('action', choices=['stage-in', 'stage-out', 'size', 'prefetch', 'list'],
+                        help = 'stage-in: copy inputs to scratch and print the staged command\n'
+                               'stage-out: move the files written on scratch back\n'
+                               'size: print the total bytes of the outputs\n'
+                               'prefetch: read the inputs into the page cache\n'
+                               'list: print the inputs and outputs found in the config')
+    parser.add_argument('cmd', nargs='*',
+                        help = 'the run-file line (put it after --)')
+    parser.add_argument('--lines-file', dest='lines_file', type=str, default=None,
+                        help = 'size: the run-file lines to size, one count per line (instead of cmd)')
+    parser.add_argument('--since', dest='since', type=float, default=0,
+                        help = 'size: only count the files modified since this unix time, e.g. the task start (default: all)')
+    parser.add_argument('--scratch', dest='scratch', type=str, default=os.environ.get('TMPDIR', '/tmp'),
+                        help = 'node-local scratch dir of this task (default: $TMPDIR)')
+    parser.add_argument('--out-keys', dest='out_keys', type=str, nargs='+', default=OUTPUT_KEYS,
+                        help = 'config keys of the outputs (default: %(default)s)')
+    parser.add_argument('--free-frac', dest='free_frac', type=float, default=STAGE_FREE_FRAC,
+                        help = 'stage-in: run in place if the files to stage take more than this fraction\n'
+                               'of the free space of the scratch dir (default: %(default)s)')
+
+    if len(sys.argv) <= 1:
+        print('')
+        parser.print_help()
+        sys.exit(1)
+    else:
+        return parser
+
+
+#########################################################################################
+
+def parse_task_io(line, out_keys=OUTPUT_KEYS):
+    """Find the inputs and outputs of a run-file line from its config file
+    Return:
+        inputs:     list of existing absolute paths read by the command
+        outputs:    list of absolute paths written by the command
+    """
+    inputs, outputs = [], []
+    for key, value in read_cmd_config(line):
+        for path in value.split(','):
+            path = path.strip()
+            if not os.path.isabs(path):
+                continue
+            if key in out_keys:
+                outputs.append(path)
+            elif os.path.exists(path):
+                inputs.append(path)
+    return inputs, outputs
+
+
+def scratch_path(path, scratch):
+    """Mirror of an absolute path under the scratch dir
+    """
+    return os.path.join(scratch, os.path.abspath(path).lstrip(os.sep))
+
+
+def copy_path(src, dst):
+    """Copy a file or a dir tree
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+
+
+def move_atomic(src, dst):
+    """Move a file or a dir tree to the shared file system, one file at a time with an atomic rename
+    """
+    if os.path.isdir(src):
+        for root, _, files in os.walk(src):
+            for fname in files:
+                fsrc = os.path.join(root, fname)
+                move_atomic(fsrc, os.path.join(dst, os.path.relpath(fsrc, src)))
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.stage-{os.getpid()}')
+    shutil.copy2(src, tmp, follow_symlinks=False)
+    os.replace(tmp, dst)
+    os.remove(src)
+
+
+def tree_bytes(path):
+    """Total bytes of a file or a dir tree, without following symlinks
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        return sum(os.lstat(os.path.join(root, fname)).st_size for root, _, files in os.walk(path) for fname in files)
+    return os.lstat(path).st_size
+
+
+def new_files(path, since=0):
+    """Files of an output (a file or a dir tree, and its sidecars path.*) modified at or after `since` (unix sec),
+    without following symlinks
+    Return:
+        list of (file, bytes)
+    """
+    srcs = ([path] if os.path.lexists(path) else []) + glob.glob(glob.escape(path) + '.*')
+    files = []
+    for src in srcs:
+        if os.path.isdir(src) and not os.path.islink(src):
+            files += [os.path.join(root, fname) for root, _, fnames in os.walk(src) for fname in fnames]
+        else:
+            files.append(src)
+    stats = [(fname, os.lstat(fname)) for fname in files]
+    return [(fname, st.st_size) for fname, st in stats if st.st_mtime >= since]
+
+
+def output_bytes(line, out_keys=OUTPUT_KEYS, since=0, seen=None):
+    """Bytes of the output files of a run-file line (of all its commands for fused steps, `cmd1 && cmd2`),
+    created or modified at or after `since` (unix sec)
+    seen: set of the files counted for the other lines of the task, updated with the files of this line
+    """
+    seen = set() if seen is None else seen
+    outputs = [path for cmd in line.split('&&') for path in parse_task_io(cmd, out_keys)[1]]
+    size = 0
+    for path in set(outputs):
+        for fname, fsize in new_files(path, since):
+            if fname not in seen:
+                seen.add(fname)
+                size += fsize
+    return size
+
+
+def prefetch(line, out_keys=OUTPUT_KEYS, chunk=16*1024**2):
+    """Read the inputs of a run-file line (files, dirs and their sidecars) to have them in the page cache
+    """
+    inputs = [path for cmd in line.split('&&') for path in parse_task_io(cmd, out_keys)[0]]
+    for path in set(inputs):
+        for src in glob.glob(glob.escape(path) + '*'):
+            files = [src] if not os.path.isdir(src) else [os.path.join(root, fname)
+                                                          for root, _, fnames in os.walk(src) for fname in fnames]
+            for fname in files:
+                with open(fname, 'rb') as f:
+                    while f.read(chunk):
+                        pass
+
+
+def stage_in(line, scratch, out_keys=OUTPUT_KEYS, free_frac=STAGE_FREE_FRAC):
+    """Copy the inputs to scratch, write the staged config and return the staged command
+    Return the command unchanged (run in place) if the files to copy take more than free_frac of the free space
+    """
+    config = cmd_config(line)
+    inputs, outputs = parse_task_io(line, out_keys)
+
+    # ISCE images come with .xml/.vrt/.hdr sidecar files; outputs updated in place need the existing content
+    srcs = [src for path in inputs for src in [path] + sorted(glob.glob(f'{path}.*'))]
+    srcs += [path for path in outputs if os.path.exists(path)]
+    os.makedirs(scratch, exist_ok=True)
+    stage_bytes, free_bytes = sum(tree_bytes(src) for src in srcs), shutil.disk_usage(scratch).free
+    if stage_bytes > free_frac * free_bytes:
+        print(f'stage-in: {stage_bytes} bytes to stage > {free_frac} x {free_bytes} bytes free in {scratch}, '
+              'run in place', file=sys.stderr)
+        return line
+
+    for src in srcs:
+        copy_path(src, scratch_path(src, scratch))
+    for path in outputs:
+        os.makedirs(os.path.dirname(scratch_path(path, scratch)), exist_ok=True)
+
+    # replace the paths in the config, longest first to keep sub-paths right
+    with open(config) as f:
+        text = f.read()
+    for path in sorted(set(inputs + outputs), key=len, reverse=True):
+        text = text.replace(path, scratch_path(path, scratch))
+    staged_config = os.path.join(scratch, 'configs', os.path.basename(config))
+    os.makedirs(os.path.dirname(staged_config), exist_ok=True)
+    with open(staged_config, 'w') as f:
+        f.write(text)
+
+    return line.replace(config, staged_config)
+
+
+def stage_out(scratch):
+    """Move the files written on scratch back to the shared file system
+    Only the files that are new or differ (size, mtime) from their shared copy are moved, not the staged inputs
+    """
+    for root, dirs, files in os.walk(scratch):
+        if root == scratch and 'configs' in dirs:
+            dirs.remove('configs')
+        for fname in files:
+            src = os.path.join(root, fname)
+            dst = os.sep + os.path.relpath(src, scratch)
+            if os.path.lexists(dst):
+                src_stat, dst_stat = os.lstat(src), os.lstat(dst)
+                if src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+                    continue
+            move_atomic(src, dst)
+
+
+#################################################################
+def main(iargs=None):
+    # parser
+    parser = cmdLineParse()
+    inps = parser.parse_args(args=iargs)
+    if not inps.cmd and not (inps.action == 'size' and inps.lines_file):
+        parser.error('the run-file line is required (put it after --)')
+    line = ' '.join(inps.cmd)
+
+    if inps.action == 'stage-in':
+        print(stage_in(line, inps.scratch, inps.out_keys, inps.free_frac))
+
+    elif inps.action == 'stage-out':
+        stage_out(inps.scratch)
+
+    elif inps.action == 'prefetch':
+        prefetch(line, inps.out_keys)
+
+    elif inps.action == 'size' and inps.lines_file:
+        seen = set()
+        with open(inps.lines_file) as f:
+            for line in f.read().splitlines():
+                print(output_bytes(line, inps.out_keys, inps.since, seen))
+
+    elif inps.action == 'size':
+        print(output_bytes(line, inps.out_keys, inps.since))
+
+    else:
+        inputs, outputs = parse_task_io(line, inps.out_keys)
+        for path in inputs:
+            print(f'in   {path}')
+        for path in outputs:
+            print(f'out  {path}')
+
+
+#################################################################
+if __name__ == '__main__':
+    main(sys.argv[1:])
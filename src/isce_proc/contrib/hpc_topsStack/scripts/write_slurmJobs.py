@@ -5,6 +5,7 @@
 
 import argparse
 import os
+import re
 import sys
 from pathlib import Path
 import numpy as np
@@ -36,6 +37,61 @@ max_task = 32 # This will be overwritten by the `batch` column defined in your r
               # 32 is a very conservative number
               # i like 200 though sometimes it got stuck, especially when competing with others on the same node
 
+# command packing (`pack` column in resource.cfg): run K lines of a run file in one array task, as `K` or `KxP`
+#   K:  number of run-file lines per array task (`auto` to pack up to MIN_TASK_TIME per task)
+#   P:  number of these lines running at the same time in the task (a local pool, each using Ncpus_per_task)
+MIN_TASK_TIME = '10:00'   # minimum duration of an array task with `auto` packing; scheduler overhead is ~secs to mins per task
+# the walltime of a packed task (`Time` x ceil(K/P)) is kept within the time limit of its partition, by packing less lines
+# check with: sinfo -o '%P %l'
+PARTITION_TIME_LIM = {'expansion': '7-00:00:00', 'gpu': '7-00:00:00'}
+# GPU packed mode (`Gres` > 0 and `pack` > 1): the lines of a task share the GPU of the allocation (srun --overlap),
+# P of them at a time with `KxP`, and the inputs of the next line are prefetched while the current one computes.
+# Fewer GPU allocations, and the GPU is not idle during the I/O and launch of each short geo2rdr command
+
+# walltime prediction (--predict-time): the `Time` of a step is replaced by a high quantile of the elapsed times of its lines
+# in a previous run (--time-hist; a packed task time over the lines it ran one after another), scaled by the workload
+# ratio and padded; `Time` is kept for steps without history
+TIME_PAD      = 1.5       # padding factor on top of the predicted walltime
+MIN_PRED_TIME = '5:00'    # shortest predicted walltime
+
+# memory classes (`nclass` column in resource.cfg): split a step into arrays with different --mem-per-cpu
+#   lines are ranked by predicted memory relative to the largest one; Mem_per_cpu is for the largest one
+#   class edges are at 1/2, 1/4, 1/8, ... of the largest predicted memory
+#   the memory of each line is taken from the per-step `pair MaxRSS` tables of a previous run (--mem-hist, written
+#   to mem_usage/pair_maxrss/ by analyse_time_resource.py), or else from the size of its input files
+
+# step fusion (`fuse` column in resource.cfg): consecutive steps with the same label (`-` for none) are fused into one
+# array job, each task running the commands of the same pair/date of these steps one after another (`cmd1 && cmd2`).
+# Saves the queue wait between short steps. Resources: max CPUs/memory and summed walltime of the fused steps.
+# With --auto-fuse, consecutive PIPELINE_STEPS shorter than --min-task-time (from --time-hist) are fused as well
+# The fused step is named fuseNN_LABEL (NN: number of its first step) in the job and task records; its member steps
+# are listed in FUSE_FILE, to map these records back to the rows of resource.cfg (e.g. --time-hist, cost estimate)
+FUSE_FILE = 'fused_steps.txt'
+
+# merge phase: lines of a run file calling these commands must run after all its other lines, e.g. merging the
+# sub-swath ionosphere of the pairs with different starting ranges (mergeSwathIon.py after all computeIon.py).
+# They are split into a second array job (`.merge`), with `afterok` on the first one (`.compute`)
+MERGE_CMDS = ['mergeSwathIon.py']
+
+# command index: byte offset of each line of a command file, in fixed-width records of a .idx file
+# each array task seeks its lines instead of scanning the run file (sed) on the shared file system
+IDX_WIDTH = 16
+
+# node-local staging (`stage` column in resource.cfg): with `1`, each line copies the inputs declared in its config
+# to $TMPDIR, runs there and moves its outputs back (see task_io.py); for steps heavy on small/random I/O
+# The inputs are whole dirs (e.g. SLC dates), a line runs in place if they do not fit in the free space of $TMPDIR
+
+# topo (run_01_unpack_topo_reference): a pool of numProcess (--num_proc4topo, set by prep_stack to the number of
+# reference bursts) processes, each with OMP threads. Its CPUs are numProcess x TOPO_THREADS on one node
+TOPO_STEP    = 'unpack_topo_reference'
+TOPO_THREADS = 4          # OMP_NUM_THREADS of each topo process; 1 or 6 seems to slow down
+
+# per-task dependencies: consecutive steps in this list, whose arrays run the same pairs/dates in the same order,
+# are chained with `aftercorr` (task i starts when task i of the previous step is done) instead of `afterok`
+# (the whole previous step is done). Only list steps that need nothing but the same pair/date from the previous step.
+PIPELINE_STEPS = ['generate_burst_igram', 'merge_burst_igram', 'filter_coherence', 'unwrap',
+                  'generateIgram_ion', 'mergeBurstsIon', 'unwrap_ion', 'look_ion', 'computeIon', 'filtIon']
+
 ######################## --------------------  ########################
 ########################  YOUR HPC CAPABILITY  ########################
 ######################## --------------------  ########################
@@ -59,6 +115,31 @@ def cmdLineParse():
                         help = 'resources configuration table for all topsStack stages')
     parser.add_argument('-j', '--job', dest='job_template', type=str, default='../inputs/slurm.job',
                         help = 'slurm script template')
+    parser.add_argument('--time-hist', dest='time_hist', type=str, default=None,
+                        help = 'time_unix.txt from a previous run, to estimate the duration of each command for `auto` packing\n'
+                               'and for --predict-time')
+    parser.add_argument('--predict-time', dest='predict_time', action='store_true',
+                        help = 'set the walltime of each step from --time-hist instead of the `Time` column:\n'
+                               'QUANTILE of the elapsed times x SIZE_RATIO x TIME_PAD')
+    parser.add_argument('--time-quantile', dest='time_quantile', type=float, default=0.99,
+                        help = 'quantile of the elapsed times for --predict-time (default: %(default)s)')
+    parser.add_argument('--time-pad', dest='time_pad', type=float, default=TIME_PAD,
+                        help = 'padding factor on the predicted walltime (default: %(default)s)')
+    parser.add_argument('--size-ratio', dest='size_ratio', type=float, default=1.0,
+                        help = 'workload of one command in this run relative to the --time-hist run\n'
+                               '(e.g. ratio of num of bursts, or of image lines; default: %(default)s)')
+    parser.add_argument('--min-task-time', dest='min_task_time', type=str, default=MIN_TASK_TIME,
+                        help = 'minimum duration of an array task with `auto` packing (default: %(default)s)')
+    parser.add_argument('--no-pipeline', dest='pipeline', action='store_false',
+                        help = 'always wait for the whole previous step (afterok), no per-task (aftercorr) dependencies')
+    parser.add_argument('--auto-fuse', dest='auto_fuse', action='store_true',
+                        help = 'fuse consecutive PIPELINE_STEPS whose commands take less than --min-task-time in --time-hist')
+    parser.add_argument('--topo-threads', dest='topo_threads', type=int, default=TOPO_THREADS,
+                        help = 'OMP threads of each topo process in run_01, its CPUs are numProcess x this (default: %(default)s)')
+    parser.add_argument('--mem-hist', dest='mem_hist', type=str, default=None,
+                        help = 'table of "pair/date MaxRSS" from a previous run, to predict the memory of each line for `nclass` > 1,\n'
+                               'or a dir of one table per step (mem_usage/pair_maxrss/ written by analyse_time_resource.py)\n'
+                               '(default: use the size of the input files found in the config of each line)')
 
     if len(sys.argv) <= 1:
         print('')
@@ -79,9 +160,10 @@ def check_resources(rscDf):
         nodes           = row['Nodes']
         ntasks          = row['Ntasks']
         ncpus_per_task  = row['Ncpus_per_task']
+        pack_procs      = parse_pack(row.get('pack', 1))[1]
 
         # Check resource limits
-        cpus_per_node   = ntasks * ncpus_per_task / nodes
+        cpus_per_node   = ntasks * ncpus_per_task * pack_procs / nodes
         if cpus_per_node > CPUS_PER_NODE_LIM:
             raise Exception(f'Do not exceed {CPUS_PER_NODE_LIM} cpus per node')
         if step_name == 'unwrap':
@@ -133,6 +215,583 @@ def timestr2sec(time_str):
     return dt, fmt
 
 
+def parse_pack(pack_str):
+    """Parse the `pack` column of resource.cfg: `K`, `KxP`, `auto` or `autoxP`
+    Return:
+        pack:       number of lines per array task, or 'auto'
+        pack_procs: number of lines running at the same time within an array task
+    """
+    pack_str = str(pack_str).strip().lower()
+    if pack_str in ['', 'nan']:
+        return 1, 1
+    pack, _, pack_procs = pack_str.partition('x')
+    pack = pack if pack == 'auto' else int(pack)
+    pack_procs = int(pack_procs) if pack_procs else 1
+    if pack != 'auto' and pack_procs > pack:
+        raise Exception(f'Pack {pack_str}: cannot run more lines at once than the lines per task')
+    return pack, pack_procs
+
+
+def auto_pack(cmd_num, batch, cmd_time=None, min_task_time=MIN_TASK_TIME, pack_procs=1):
+    """Choose the num of run-file lines per array task
+        + at least enough to last `min_task_time` when the duration of a command (one line) is known,
+          with pack_procs of them running at the same time
+        + at least enough to fit the whole step in one slurm array (no .pN.job splitting)
+        + at most leaving `batch` array tasks to run at once
+    """
+    pack = np.ceil(cmd_num / SLURM_MAX_ARRAY_SIZE)
+    if cmd_time:
+        pack = max(pack, pack_procs * np.ceil(timestr2sec(min_task_time)[0] / cmd_time))
+    pack = min(pack, max(np.ceil(cmd_num / batch), 1))
+    return int(max(pack, 1))
+
+
+def hist_run_dir(time_file):
+    """The run_files/ dir of a time_unix.txt, in run_files/ or in run_files/log_files/ (after run_atTheEnd.sh)
+    """
+    time_dir = os.path.dirname(os.path.abspath(time_file))
+    return os.path.dirname(time_dir) if os.path.basename(time_dir) == 'log_files' else time_dir
+
+
+def rsc_step(step):
+    """Step name in resources.cfg of a recorded step: STEP for its merge phase STEP_merge (see split_phases)
+    """
+    return step.rsplit('_merge', 1)[0] if step.endswith('_merge') else step
+
+
+def rsc_row(rscDf, step):
+    """Row of resources.cfg for a step, the merge phase (STEP_merge) and fused steps (see add_fused_rows) included
+    Return None for unknown steps
+    """
+    rows = rscDf[rscDf['Step'] == rsc_step(step)]
+    return rows.iloc[0] if len(rows) > 0 else None
+
+
+def recorded_pack(rscDf, step, num_task, fused={}, run_dir='.'):
+    """Lines per array task and lines at once of a step in a recorded run
+    `auto` packing is recovered from the line count of its run file in run_dir (of the first member of a fused step)
+    """
+    row = rsc_row(rscDf, step) if rscDf is not None else None
+    if row is None or 'pack' not in row.index:
+        return 1, 1
+    pack, pack_procs = parse_pack(row['pack'])
+    if pack == 'auto':
+        name = fused.get(step, [step])[0]
+        run_files = [x for x in os.listdir(run_dir) if x.startswith('run_') and x.endswith(name) and '.' not in x]
+        pack = 1
+        if run_files:
+            num_line = len(open(os.path.join(run_dir, run_files[0])).read().splitlines())
+            pack = int(np.ceil(num_line / num_task))
+        pack_procs = min(pack_procs, pack)
+    return pack, pack_procs
+
+
+def read_line_time(time_file, rscDf=None, fused={}):
+    """Elapsed seconds of a run-file line in each array task of a recorded run (time_unix.txt)
+    A packed task ran its lines ceil(pack / pack_procs) after one another, with the `pack` of the recorded run in rscDf
+    Return:
+        df:     the time table, with Elapsed in seconds per line
+        packs:  dict of {step name: (lines per task, lines at once)} in the recorded run
+    """
+    from analyse_time_resource import read_time_table
+    df = read_time_table(time_file)
+    df['Elapsed'] = df['Elapsed'].dt.total_seconds()
+    run_dir = hist_run_dir(time_file)
+    packs = {}
+    for step, step_df in df.groupby('Step', sort=False):
+        packs[step] = recorded_pack(rscDf, step, len(step_df), fused, run_dir)
+        df.loc[step_df.index, 'Elapsed'] = step_df['Elapsed'] / np.ceil(packs[step][0] / packs[step][1])
+    return df, packs
+
+
+def read_cmd_time(time_file, quantile=0.5, rscDf=None):
+    """Quantile (default: median) of the elapsed seconds of a run-file line for each step in a previous run (time_unix.txt)
+    The elapsed times of packed array tasks are divided by the lines they ran one after another (read_line_time),
+    with the resources.cfg of that run in its run_files/ (rscDf if not found)
+    The time of a fused step is also divided among its member steps (FUSE_FILE next to time_file),
+    in proportion to their `Time` in resources.cfg (equally without it)
+    """
+    rsc_file = os.path.join(hist_run_dir(time_file), 'resources.cfg')
+    rscDf = read_resources(rsc_file) if os.path.isfile(rsc_file) else rscDf
+    fused = read_fused_steps(os.path.join(os.path.dirname(time_file), FUSE_FILE))
+    df, _ = read_line_time(time_file, add_fused_rows(rscDf, fused) if rscDf is not None else None, fused)
+    cmd_times = df.groupby('Step')['Elapsed'].quantile(quantile).to_dict()
+
+    for name, members in fused.items():
+        if name not in cmd_times:
+            continue
+        weights = np.ones(len(members))
+        if rscDf is not None:
+            rows = rscDf.set_index('Step').reindex(members)['Time']
+            weights = np.array([timestr2sec(x)[0] if isinstance(x, str) else np.nan for x in rows])
+            weights = np.ones(len(members)) if np.any(np.isnan(weights)) else weights
+        for member, weight in zip(members, weights):
+            cmd_times.setdefault(member, cmd_times[name] * weight / weights.sum())
+    return cmd_times
+
+
+def predict_walltime(hist_time, size_ratio=1.0, time_pad=TIME_PAD):
+    """Walltime of a run-file line from its elapsed time in a previous run, rounded up to minutes
+    """
+    seconds = max(hist_time * size_ratio * time_pad, timestr2sec(MIN_PRED_TIME)[0])
+    return sec2timestr(np.ceil(seconds / 60) * 60)
+
+
+def cmd_config(line):
+    """The config file of a run-file line (the file after -c)
+    """
+    tokens = line.split()
+    return tokens[tokens.index('-c')+1] if '-c' in tokens[:-1] else tokens[-1]
+
+
+def read_cmd_config(line):
+    """Read the `key : value` pairs in the config file of a run-file line (the file after -c)
+    Return:
+        items:  list of (key, value), in the order of the config file; empty if the config does not exist
+    """
+    config = cmd_config(line)
+    items = []
+    if os.path.isfile(config):
+        with open(config) as f:
+            for cfg_line in f:
+                key, sep, value = cfg_line.partition(':')
+                if sep and value.strip():
+                    items.append((key.strip(), value.strip()))
+    return items
+
+
+def line_key(line):
+    """Find the pair (YYYYMMDD_YYYYMMDD) or date (YYYYMMDD) that a run-file line processes, from its config name
+    """
+    config = line.split()[-1]
+    dates = re.findall(r'(?<!\d)\d{8}(?!\d)', os.path.basename(config))
+    return '_'.join(dates[:2]) if dates else None
+
+
+def line_input_size(line):
+    """Total bytes of the existing files (or directories) given in the config file of a run-file line
+    """
+    size = 0
+    for key, value in read_cmd_config(line):
+        for path in value.replace(',', ' ').split():
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+            elif os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def read_mem_hist(mem_file, step_name=None):
+    """Read a table of pair/date and MaxRSS (e.g. 20141116_20141128 16.9G) into a dict of MB
+    If mem_file is a dir, read the table of the step (<step_name>.txt), None if the step has none
+    """
+    if os.path.isdir(mem_file):
+        mem_file = os.path.join(mem_file, f'{step_name}.txt')
+        if not os.path.isfile(mem_file):
+            return None
+    mem_hist = {}
+    with open(mem_file) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                key, maxrss = line.split()[:2]
+                mem_hist[key.replace('-', '_')] = memstr2mb(maxrss)
+    return mem_hist
+
+
+def split_mem_classes(step_script, nclass, mem, mem_hist=None):
+    """Split the lines of a run file into memory classes, write one command file per class
+    Return:
+        groups:     list of (cmd_file, mem) to write an array job for; [(step_script, mem)] if not split
+    """
+    lines = open(step_script).read().splitlines()
+    if nclass <= 1 or len(lines) <= 1:
+        return [(step_script, mem)]
+
+    # predicted memory of each line, unknown ones go to the largest class
+    if mem_hist:
+        pred = np.array([mem_hist.get(line_key(line), np.nan) for line in lines], dtype=float)
+    else:
+        pred = np.array([line_input_size(line) for line in lines], dtype=float)
+        pred[pred == 0] = np.nan
+    if np.all(np.isnan(pred)):
+        print(f' {step_script}: no memory prediction available, not splitting into classes')
+        return [(step_script, mem)]
+    ratio = pred / np.nanmax(pred)
+    ratio[np.isnan(ratio)] = 1.
+
+    # class index, largest memory in the last class
+    cls = np.clip(nclass - 1 - np.floor(-np.log2(ratio)).astype(int), 0, nclass - 1)
+    if len(np.unique(cls)) == 1:
+        return [(step_script, mem)]
+
+    groups = []
+    for k in np.unique(cls):
+        cmd_file = f'{step_script}.c{k+1}'
+        with open(cmd_file, 'w') as f:
+            f.write('\n'.join(np.array(lines)[cls == k]) + '\n')
+        mem_k = mb2memstr(memstr2mb(mem) * ratio[cls == k].max())
+        groups.append((cmd_file, mem_k))
+        print(f' {step_script}: memory class {k+1} with {np.sum(cls == k)} lines, {mem_k} per cpu')
+    return groups
+
+
+def topo_resources(step_script, threads=TOPO_THREADS):
+    """CPUs and OMP threads of the topo step, from the numProcess in the config of its run file
+    The CPUs are capped to one node (CPUS_PER_NODE_LIM), using less threads per process first
+    Return:
+        ncpus_per_task: CPUs of the array task, None if numProcess is not found
+        omp_threads:    OMP_NUM_THREADS of each topo process
+    """
+    num_proc = None
+    for line in open(step_script).read().splitlines():
+        items = dict(read_cmd_config(line))
+        if 'numProcess' in items:
+            num_proc = int(items['numProcess'])
+            break
+    if not num_proc:
+        return None, None
+
+    omp_threads = max(min(threads, CPUS_PER_NODE_LIM // num_proc), 1)
+    ncpus_per_task = min(num_proc * omp_threads, CPUS_PER_NODE_LIM)
+    if omp_threads < threads or num_proc > CPUS_PER_NODE_LIM:
+        print(f' WARNING: {num_proc} topo processes x {threads} threads > {CPUS_PER_NODE_LIM} CPUs per node, '
+              f'use {omp_threads} threads each')
+    print(f' {step_script}: {num_proc} topo processes x {omp_threads} threads, {ncpus_per_task} CPUs')
+    return ncpus_per_task, omp_threads
+
+
+def sec2timestr(seconds):
+    """Convert seconds to the SBATCH --time format, "hours:minutes:seconds" or "days-hours:minutes:seconds"
+    """
+    seconds = int(np.ceil(seconds))
+    d, seconds = divmod(seconds, 86400)
+    h, seconds = divmod(seconds, 3600)
+    m, s = divmod(seconds, 60)
+    if d > 0:
+        return f'{d}-{h:02d}:{m:02d}:{s:02d}'
+    return f'{h}:{m:02d}:{s:02d}'
+
+
+def memstr2mb(mem_str):
+    """Convert SBATCH memory string (e.g. 500M, 20G, 1T; no unit = MB) to megabytes
+    """
+    units = {'K': 1/1024, 'M': 1, 'G': 1024, 'T': 1024**2}
+    mem_str = str(mem_str).strip().upper()
+    if mem_str[-1] in units:
+        return float(mem_str[:-1]) * units[mem_str[-1]]
+    return float(mem_str)
+
+
+def mb2memstr(mem_mb):
+    """Convert megabytes to a rounded-up SBATCH memory string (100M steps below 1G, 1G steps above)
+    """
+    if mem_mb <= 1000:
+        return f'{int(max(np.ceil(mem_mb / 100), 1) * 100)}M'
+    return f'{int(np.ceil(mem_mb / 1024))}G'
+
+
+def read_resources(rsc_file):
+    """Read the resource config table, keep the step number as string (e.g. '01')
+    """
+    return pd.read_table(rsc_file, header=0, sep=r'\s+', dtype={'No': str})
+
+
+def write_fused_steps(fused, fuse_file=FUSE_FILE):
+    """Write the member steps of each fused step, e.g. fuse13_igram  generate_burst_igram,merge_burst_igram
+    """
+    fmt = '{:<31s} {}\n'
+    with open(fuse_file, 'w') as f:
+        f.write(fmt.format('# Step', 'Fused steps'))
+        for name, members in fused.items():
+            f.write(fmt.format(name, ','.join(members)))
+    print(f'create {fuse_file} for the member steps of {len(fused)} fused steps.')
+    return fuse_file
+
+
+def read_fused_steps(fuse_file=FUSE_FILE):
+    """Read the member steps of each fused step into a dict of {fused step: [member steps]}, empty without the file
+    """
+    fused = {}
+    if os.path.isfile(fuse_file):
+        with open(fuse_file) as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) == 2 and not tokens[0].startswith('#'):
+                    fused[tokens[0]] = tokens[1].split(',')
+    return fused
+
+
+def add_fused_rows(rscDf, fused):
+    """Add a row to the resource config table for each fused step, with the resources of its job in fuse_steps():
+    the max CPUs, memory and GPUs, the summed walltime and the min batch of its member steps
+    """
+    rows = []
+    for name, members in fused.items():
+        member_rows = rscDf[rscDf['Step'].isin(members)]
+        if len(member_rows) == 0 or name in set(rscDf['Step']):
+            continue
+        row = member_rows.loc[member_rows['Ncpus_per_task'].idxmax()].copy()
+        row['Step'] = name
+        if 'Mem_per_cpu' in row.index:
+            mem_mb = max(memstr2mb(m) * n for m, n in zip(member_rows['Mem_per_cpu'], member_rows['Ncpus_per_task']))
+            row['Mem_per_cpu'] = mb2memstr(mem_mb / row['Ncpus_per_task'])
+        if 'Time' in row.index:
+            row['Time'] = sec2timestr(sum(timestr2sec(str(x))[0] for x in member_rows['Time']))
+        for col, func in [('Gres', max), ('batch', min)]:
+            if col in row.index:
+                row[col] = func(member_rows[col])
+        if 'pack' in row.index:
+            packs = set(str(x) for x in member_rows['pack'])
+            row['pack'] = packs.pop() if len(packs) == 1 else 1
+        rows.append(row)
+    if not rows:
+        return rscDf
+    return pd.concat([rscDf, pd.DataFrame(rows)], ignore_index=True)
+
+
+def write_resources(rscDf, rsc_file):
+    """Write the resource config table in the same aligned layout as inputs/resources.cfg
+    """
+    table = rscDf.astype(object).where(rscDf.notna(), '')
+    if 'Comments' in table.columns:
+        table['Comments'] = [f'"{x}"' if x != '' else '' for x in table['Comments']]
+    widths = [max([len(str(col))] + [len(str(x)) for x in table[col]]) + 2 for col in table.columns]
+    with open(rsc_file, 'w') as f:
+        f.write(''.join(f'{col:<{w}}' for col, w in zip(table.columns, widths)).rstrip() + '\n')
+        for _, row in table.iterrows():
+            f.write(''.join(f'{str(x):<{w}}' for x, w in zip(row, widths)).rstrip() + '\n')
+    return rsc_file
+
+
+def write_array_jobs(inps, cmd_file, step):
+    """Write the sbatch file(s) running the lines of a command file as a slurm array
+        step:   dict of the step settings and resources of one command, see write_job_scripts()
+    Return:
+        jobs:   list of (job name, pairs/dates processed by each array task), one for each sbatch file
+    """
+    time, ncpus_per_task = step['time'], step['ncpus_per_task']
+
+    # Get the number of commands in the script
+    lines = open(cmd_file).read().splitlines()
+    cmd_num = len(lines)
+    write_cmd_index(cmd_file)
+
+    # command packing: pack lines per array task, pack_procs of them at a time
+    pack, pack_procs = parse_pack(step['pack'])
+    if pack == 'auto':
+        pack = auto_pack(cmd_num, step['max_task'], step['cmd_time'], inps.min_task_time, pack_procs)
+        pack_procs = min(pack_procs, pack)
+    # the lines of a task run ceil(pack / pack_procs) after one another, within the time limit of the partition
+    time_lim = PARTITION_TIME_LIM[step['partition']]
+    max_pack = pack_procs * max(int(timestr2sec(time_lim)[0] // timestr2sec(time)[0]), 1)
+    if pack > max_pack:
+        print(f' WARNING: {cmd_file}: {pack} lines per task x {time} exceeds the {time_lim} limit of the '
+              f'{step["partition"]} partition, pack {max_pack} lines per task')
+        pack = max_pack
+    task_num = int(np.ceil(cmd_num / pack))
+    if pack > 1:
+        # the resources in the table are for one command, scale them for the packed task
+        ncpus_per_task = ncpus_per_task * pack_procs
+        time = sec2timestr(timestr2sec(time)[0] * np.ceil(pack / pack_procs))
+        print(f' {cmd_file}: pack {pack} lines per task ({pack_procs} at a time), {task_num} tasks, walltime {time}')
+    srun_opts = '' if pack_procs == 1 else f'--exact --ntasks=1 --cpus-per-task={ncpus_per_task // pack_procs}'
+    prefetch = 0
+    if int(step['gres']) > 0 and pack > 1:
+        # GPU packed mode: the concurrent job steps share the GPU of the allocation
+        srun_opts = '--overlap ' + srun_opts if pack_procs > 1 else srun_opts
+        prefetch = 1
+
+    # split large sbatch file into multiple parts if needed
+    jobs = []
+    num_sbatch = np.ceil(task_num / SLURM_MAX_ARRAY_SIZE).astype(int)
+    for i in range(num_sbatch):
+        # use ROWINDEX, instead of SLURM_ARRAY_TASK_ID, to select line of interest
+        # link: https://stackoverflow.com/questions/67908698/submitting-slurm-array-job-with-a-limit-above-maxarraysize
+        task_id1   = min(SLURM_MAX_ARRAY_SIZE, task_num - i * SLURM_MAX_ARRAY_SIZE) # ending task index of the current job
+        row_id0    = i * SLURM_MAX_ARRAY_SIZE * pack                                # starting row index of the current job
+        row_id1    = min(cmd_num, (i+1) * SLURM_MAX_ARRAY_SIZE * pack)              # ending row index of the current job
+        suffix     = '' if num_sbatch == 1 else f'.p{i+1}'
+        log_name   = f'slurm-{cmd_file}-%A_%a{suffix}.out'
+        slurm_name = f'{cmd_file}{suffix}.job'
+
+        context = {
+            "groupname"         :   GROUPNAME,
+            "time"              :   time,
+            "nodes"             :   step['nodes'],
+            "ntasks"            :   step['ntasks'],
+            "ncpus_per_task"    :   ncpus_per_task,
+            "omp_threads"       :   step['omp_threads'],
+            "log_name"          :   log_name,
+            "track"             :   inps.track_no,
+            "step_name"         :   step['step_name'],
+            "step_num"          :   step['step_num'],
+            "step_script"       :   cmd_file,
+            "step_index"        :   step['index']+1,
+            "mail_user"         :   mail_user,
+            "row_id0"           :   row_id0,
+            "row_id1"           :   row_id1,
+            "idx_width"         :   IDX_WIDTH,
+            "pack"              :   pack,
+            "pack_procs"        :   pack_procs,
+            "srun_opts"         :   srun_opts,
+            "stage"             :   int(step['stage']),
+            "prefetch"          :   prefetch,
+            "deletion_here"     :   '\n'.join(f'#_deletion_here {x}' for x in step['run_files']),
+            "task_id1"          :   task_id1,
+            "max_task"          :   step['max_task'],
+            "gres"              :   step['gres'],
+            "partition"         :   step['partition'],
+            "mem"               :   step['mem'],
+            # "ntasks_per_node" :   row['Ntasks_per_node'],
+        }
+
+        # Put variables from context dic into the slurm script template
+        print(' '+slurm_name)
+        with open(slurm_name, 'w') as outf:
+            outf.write(inps.template.format(**context))
+
+        # pairs/dates of each array task, to check if the arrays of two steps are index-aligned
+        keys = [line_key(line) for line in lines[row_id0:row_id1]]
+        jobs.append((slurm_name[:-4], [tuple(keys[j:j+pack]) for j in range(0, len(keys), pack)]))
+    return jobs
+
+
+def split_phases(step_script, step, nclass):
+    """Split the lines of a run file calling MERGE_CMDS into a second phase
+    Return:
+        list of (step_script, step, nclass), one for each phase
+    """
+    lines = open(step_script).read().splitlines()
+    is_merge = [any(cmd in line for cmd in MERGE_CMDS) for line in lines]
+    if not any(is_merge) or all(is_merge):
+        return [(step_script, step, nclass)]
+
+    phases = []
+    for phase, flag in [('compute', False), ('merge', True)]:
+        cmd_file = f'{step_script}.{phase}'
+        with open(cmd_file, 'w') as f:
+            f.write('\n'.join(line for line, merge in zip(lines, is_merge) if merge == flag) + '\n')
+        if phase == 'compute':
+            phases.append((cmd_file, dict(step, fuse='-'), nclass))
+        else:
+            # the merge phase is not pipelined: it waits for the whole compute phase, and the next step for it
+            # it is recorded as STEP_merge (time_unix.txt, ledger), and has no deletion lines (kept in the compute phase)
+            name = f'{step["step_name"]}_{phase}'
+            phases.append((cmd_file, dict(step, step_name=name, names=[name], run_files=[], fuse='-'), 1))
+    print(f' {step_script}: split {sum(is_merge)} lines calling {", ".join(MERGE_CMDS)} into {step_script}.merge')
+    return phases
+
+
+def fuse_label(step, inps, cmd_times):
+    """Fusion label of a step: the `fuse` column, or `auto` for short pipelined steps with --auto-fuse
+    """
+    label = str(step['fuse']).strip()
+    if label not in ['', '-', '0', 'nan']:
+        return label
+    cmd_time = cmd_times.get(step['step_name'])
+    if inps.auto_fuse and step['step_name'] in PIPELINE_STEPS and cmd_time is not None:
+        if cmd_time < timestr2sec(inps.min_task_time)[0]:
+            return 'auto'
+    return None
+
+
+def fuse_steps(group, label):
+    """Fuse the run files of consecutive steps into one command file, line by line for the same pair/date
+        group:  list of (step_script, step, nclass) to fuse
+        label:  fusion label of the steps, for the name of the fused step
+    Return:
+        (step_script, step, nclass) of the fused step, or None if the run files do not process the same pairs/dates
+    """
+    lines = [open(step_script).read().splitlines() for step_script, _, _ in group]
+    keys = [[line_key(line) for line in step_lines] for step_lines in lines]
+    for step_keys in keys:
+        if None in step_keys or len(set(step_keys)) != len(step_keys) or set(step_keys) != set(keys[0]):
+            return None
+
+    # fused lines in the order of the first step
+    cmds = [dict(zip(step_keys, step_lines)) for step_keys, step_lines in zip(keys, lines)]
+    step_script = f'{group[0][0]}.fuse'
+    with open(step_script, 'w') as f:
+        for key in keys[0]:
+            f.write(' && '.join(cmd[key] for cmd in cmds) + '\n')
+
+    # resources: enough for the largest step, one after another
+    steps = [step for _, step, _ in group]
+    ncpus_per_task = max(step['ncpus_per_task'] for step in steps)
+    mem_mb = max(memstr2mb(step['mem']) * step['ncpus_per_task'] for step in steps) / ncpus_per_task
+    cmd_times = [step['cmd_time'] for step in steps]
+    packs = set(str(step['pack']) for step in steps)
+    fused = dict(steps[0],
+        step_name       = f'fuse{steps[0]["step_num"][4:]}_{label}',
+        names           = [name for step in steps for name in step['names']],
+        fused_steps     = [name for step in steps for name in step['fused_steps']],
+        run_files       = [name for step in steps for name in step['run_files']],
+        time            = sec2timestr(sum(timestr2sec(step['time'])[0] for step in steps)),
+        nodes           = max(step['nodes'] for step in steps),
+        ntasks          = max(step['ntasks'] for step in steps),
+        ncpus_per_task  = ncpus_per_task,
+        omp_threads     = '$SLURM_CPUS_PER_TASK',
+        mem             = mb2memstr(mem_mb),
+        gres            = max(int(step['gres']) for step in steps),
+        max_task        = min(step['max_task'] for step in steps),
+        pack            = packs.pop() if len(packs) == 1 else 1,
+        stage           = 0,
+        cmd_time        = sum(cmd_times) if None not in cmd_times else None,
+    )
+    fused['partition'] = 'gpu' if fused['gres'] > 0 else 'expansion'
+    print(f' {step_script}: fuse {"+".join(fused["fused_steps"])} as {fused["step_name"]}, {len(keys[0])} lines, '
+          f'{ncpus_per_task} cpus, {fused["mem"]} per cpu, walltime {fused["time"]}')
+    return step_script, fused, 1
+
+
+def write_cmd_index(cmd_file):
+    """Write the byte offsets of each line of a command file to <cmd_file>.idx, IDX_WIDTH bytes per line
+    Line N starts at the offset stored at byte (N-1)*IDX_WIDTH of the index file
+    """
+    idx_file = f'{cmd_file}.idx'
+    offset = 0
+    with open(cmd_file, 'rb') as f, open(idx_file, 'w') as outf:
+        for line in f:
+            outf.write(f'{offset:0{IDX_WIDTH-1}d}\n')
+            offset += len(line)
+    return idx_file
+
+
+def chain_dependency(prev_jobs, jobs, pipeline=True):
+    """Find the dependency of each job on the jobs of the previous step
+        + aftercorr:    if both steps are pipelined and their arrays process the same pairs/dates with the same task IDs
+        + afterok:      on all the jobs of the previous step otherwise
+    Return:
+        deps:   list of (job name, dependency type, list of job names after)
+    """
+    if not prev_jobs:
+        return [(name, 'none', []) for name, _ in jobs]
+
+    aligned = pipeline and len(jobs) == len(prev_jobs)
+    for (_, tasks), (_, prev_tasks) in zip(jobs, prev_jobs):
+        keys = [key for task in tasks for key in task]
+        if not aligned or tasks != prev_tasks or None in keys or len(set(keys)) != len(keys):
+            aligned = False
+            break
+
+    if aligned:
+        return [(name, 'aftercorr', [prev_name]) for (name, _), (prev_name, _) in zip(jobs, prev_jobs)]
+    return [(name, 'afterok', [prev_name for prev_name, _ in prev_jobs]) for name, _ in jobs]
+
+
+def write_dependencies(deps, dep_file='job_dependencies.txt'):
+    """Write the dependency table read by submit_chained_dependencies.sh
+    """
+    fmt = '{:<47s} {:<12s}{}\n'
+    with open(dep_file, 'w') as f:
+        f.write(fmt.format('# Job', 'Dependency', 'After'))
+        for name, dep_type, after in deps:
+            f.write(fmt.format(name, dep_type, ','.join(after) if after else '-'))
+    print(f'create {dep_file} for the job dependencies.')
+    return dep_file
+
+
 def write_job_scripts(inps):
     print(f'>> Writing SLURM job scripts for {inps.track_no}')
 
@@ -140,13 +799,26 @@ def write_job_scripts(inps):
     if check_resources(inps.rscDf):
         pass
 
+    # duration of each command from a previous run
+    cmd_times = read_cmd_time(inps.time_hist, rscDf=inps.rscDf) if inps.time_hist else {}
+
+    # walltime of each step from a previous run
+    if inps.predict_time:
+        if not inps.time_hist:
+            raise Exception('--predict-time needs the time_unix.txt of a previous run with --time-hist')
+        hist_times = read_cmd_time(inps.time_hist, inps.time_quantile, inps.rscDf)
+        print(f'>> Predict walltimes: p{inps.time_quantile*100:g} of {inps.time_hist} x {inps.size_ratio} x {inps.time_pad}')
+    else:
+        hist_times = {}
+
     # Read/write stackSentienl run_files:
     runfiles = sorted([x for x in Path.cwd().glob('run_*') if not '.' in str(x)])
     step_scripts = []
     for run in runfiles:
         step_scripts.append(run.stem)
 
-    # Iterate over the run files, write an sbatch file for each one
+    # Read the resources of each step
+    steps = []
     for index, step_script in enumerate(step_scripts):
         # a table of steps
         step_num        = step_script[:6]
@@ -158,63 +830,91 @@ def write_job_scripts(inps):
         mem             = inps.rscDf[inps.rscDf['Step']==step_name]['Mem_per_cpu'].item()
         gres            = inps.rscDf[inps.rscDf['Step']==step_name]['Gres'].item()
         batch           = inps.rscDf[inps.rscDf['Step']==step_name]['batch'].item()
+        pack            = inps.rscDf[inps.rscDf['Step']==step_name]['pack'].item() if 'pack' in inps.rscDf.columns else 1
+        nclass          = inps.rscDf[inps.rscDf['Step']==step_name]['nclass'].item() if 'nclass' in inps.rscDf.columns else 1
+        stage           = inps.rscDf[inps.rscDf['Step']==step_name]['stage'].item() if 'stage' in inps.rscDf.columns else 0
+        fuse            = inps.rscDf[inps.rscDf['Step']==step_name]['fuse'].item() if 'fuse' in inps.rscDf.columns else '-'
         max_task = batch
 
+        # topo: one process per reference burst, all on one node
+        omp_threads = '$SLURM_CPUS_PER_TASK'
+        if step_name == TOPO_STEP:
+            topo_cpus, topo_threads = topo_resources(step_script, inps.topo_threads)
+            if topo_cpus:
+                ncpus_per_task, omp_threads = topo_cpus, topo_threads
+
+        if step_name in hist_times:
+            pred_time = predict_walltime(hist_times[step_name], inps.size_ratio, inps.time_pad)
+            print(f' {step_name}: walltime {time} -> {pred_time}')
+            time = pred_time
+
         # assign to a HPC partition w/ or w/o gpus
         # The default partition for The Resnick HPCC will change from “any” (CentOS 7) to “expansion” (RHEL 9) on Tuesday, March 26th.
         if int(gres) > 0: partition = 'gpu'
         else: partition = 'expansion'
 
-        # Get the number of commands in the script
-        cmd_num = len(open(step_script).readlines())
-
-        # enough walltime to compute and document the file size?
-        if timestr2sec(time)[0] >= 3600.0:
-            # if walltime more than 60 min, task no. 2 will check filesize
-            check_disk = 2
+        step = {
+            "index"             :   index,
+            "step_num"          :   step_num,
+            "step_name"         :   step_name,
+            "names"             :   [step_name],
+            "fused_steps"       :   [step_name],
+            "run_files"         :   [step_script],
+            "time"              :   time,
+            "nodes"             :   nodes,
+            "ntasks"            :   ntasks,
+            "ncpus_per_task"    :   ncpus_per_task,
+            "omp_threads"       :   omp_threads,
+            "mem"               :   mem,
+            "gres"              :   gres,
+            "partition"         :   partition,
+            "max_task"          :   max_task,
+            "pack"              :   pack,
+            "stage"             :   stage,
+            "fuse"              :   fuse,
+            "cmd_time"          :   cmd_times.get(step_name),
+        }
+        steps.append((step_script, step, nclass))
+
+    # Split the merge lines into a second phase
+    steps = [phase for step in steps for phase in split_phases(*step)]
+
+    # Fuse consecutive steps with the same fusion label
+    groups = []
+    for step_script, step, nclass in steps:
+        label = fuse_label(step, inps, cmd_times)
+        if groups and label and groups[-1][0] == label:
+            groups[-1][1].append((step_script, step, nclass))
         else:
-            # no checking
-            check_disk = 0
-
-        # split large sbatch file into multiple parts if needed
-        num_sbatch = np.ceil(cmd_num / SLURM_MAX_ARRAY_SIZE).astype(int)
-        for i in range(num_sbatch):
-            # use ROWINDEX, instead of SLURM_ARRAY_TASK_ID, to select line of interest
-            # link: https://stackoverflow.com/questions/67908698/submitting-slurm-array-job-with-a-limit-above-maxarraysize
-            task_id1   = min(SLURM_MAX_ARRAY_SIZE, cmd_num - i * SLURM_MAX_ARRAY_SIZE)  # ending task index of the current job
-            row_id0    = i * SLURM_MAX_ARRAY_SIZE                                       # starting row index of the current job
-            suffix     = '' if num_sbatch == 1 else f'.p{i+1}'
-            log_name   = f'slurm-{step_script}-%A_%a{suffix}.out'
-            slurm_name = f'{step_script}{suffix}.job'
-
-            context = {
-                "groupname"         :   GROUPNAME,
-                "time"              :   time,
-                "nodes"             :   nodes,
-                "ntasks"            :   ntasks,
-                "ncpus_per_task"    :   ncpus_per_task,
-                "log_name"          :   log_name,
-                "track"             :   inps.track_no,
-                "step_name"         :   step_name,
-                "step_num"          :   step_num,
-                "step_script"       :   step_script,
-                "step_index"        :   index+1,
-                "mail_user"         :   mail_user,
-                "row_id0"           :   row_id0,
-                "task_id1"          :   task_id1,
-                "max_task"          :   max_task,
-                "gres"              :   gres,
-                "partition"         :   partition,
-                "mem"               :   mem,
-                "check_disk_list"   :   check_disk,
-                # "ntasks_per_node" :   row['Ntasks_per_node'],
-            }
-
-            # Put variables from context dic into the slurm script template
-            print(' '+slurm_name)
-            with open(slurm_name, 'w') as outf:
-                outf.write(inps.template.format(**context))
-
+            groups.append((label, [(step_script, step, nclass)]))
+    steps, fused_names = [], {}
+    for label, group in groups:
+        fused = fuse_steps(group, label) if len(group) > 1 else None
+        if len(group) > 1 and not fused:
+            print(f' {"+".join(x[0] for x in group)}: not the same pairs/dates in the run files, not fused')
+        if fused:
+            fused_names[fused[1]['step_name']] = fused[1]['fused_steps']
+        steps += [fused] if fused else group
+    write_fused_steps(fused_names)
+
+    # Iterate over the (fused) steps, write an sbatch file for each one
+    deps = []
+    prev_jobs, prev_names = [], []
+    for step_script, step, nclass in steps:
+        # split the run file into memory classes, one array job (or more) for each
+        # memory of each pair/date from a previous run
+        jobs = []
+        mem_hist = read_mem_hist(inps.mem_hist, step['step_name']) if inps.mem_hist and int(nclass) > 1 else None
+        cmd_groups = split_mem_classes(step_script, int(nclass), step['mem'], mem_hist)
+        for cmd_file, mem_class in cmd_groups:
+            jobs += write_array_jobs(inps, cmd_file, dict(step, mem=mem_class))
+
+        # depend on the previous step, per task if both steps are pipelined
+        pipeline = inps.pipeline and all(name in PIPELINE_STEPS for name in prev_names + step['names']) and prev_names
+        deps += chain_dependency(prev_jobs, jobs, bool(pipeline))
+        prev_jobs, prev_names = jobs, step['names']
+
+    write_dependencies(deps)
     print(f'create job scripts for {inps.track_no}.')
 
 
@@ -225,6 +925,8 @@ def write_end_cmd(cmd_script='run_atTheEnd.sh', log_dir='log_files'):
         outf.write(f'#!/bin/bash\n')
         outf.write(f'# Commands after topsStack processing. Run this after all the jobs are finished\n\n')
         outf.write(f'mkdir -p {log_dir}\n')
+        outf.write(f'python collect_task_records.py\n')
+        outf.write(f'python collect_disk_usage.py\n')
         outf.write(f'mv *.out *.txt *.log {log_dir}/ \n')
         outf.write(f'reportseff ./{log_dir} --no-color > {log_dir}/reportseff_all.txt\n')
         outf.write(f'python analyse_time_resource.py\n')
@@ -238,7 +940,7 @@ def main(iargs=None):
     inps = parser.parse_args(args=iargs)
 
     # read input resource config and slurm template
-    inps.rscDf = pd.read_table(inps.rsc_file, header=0, delim_whitespace=True)
+    inps.rscDf = read_resources(inps.rsc_file)
     inps.template = open(inps.job_template, 'r').read()
 
     # write *.job scripts
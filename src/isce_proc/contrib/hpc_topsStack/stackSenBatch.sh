@@ -27,13 +27,33 @@ cp ${MAIN_DIR}/scripts/submit_chained_dependencies.sh ./run_files/
 cp ${MAIN_DIR}/scripts/clean_topsStack_files.sh ./run_files/
 # For analysing timings after processing
 cp ${MAIN_DIR}/scripts/analyse_time_resource.py ./run_files/
+# For simulating the makespan/cost of other settings from the timings of a run
+cp ${MAIN_DIR}/scripts/simulate_makespan.py ./run_files/
+# For keeping the performance records of the tracks in one database
+cp ${MAIN_DIR}/scripts/perf_db.py ./run_files/
+# For recommending the CPUs/memory/GPU use of each step from the CPU efficiency of a run
+cp ${MAIN_DIR}/scripts/recommend_resources.py ./run_files/
+# For fitting resources.cfg from previous tracks
+cp ${MAIN_DIR}/scripts/fit_resources.py ./run_files/
+# For staging I/O-heavy steps on node-local scratch
+cp ${MAIN_DIR}/scripts/task_io.py ./run_files/
+# For merging the per-task timing/log records of the jobs
+cp ${MAIN_DIR}/scripts/collect_task_records.py ./run_files/
+# For summing the disk-usage ledger of the jobs into total_file_sizes.txt
+cp ${MAIN_DIR}/scripts/collect_disk_usage.py ./run_files/
+# For adapting the array throttles to the file-system load at runtime
+cp ${MAIN_DIR}/scripts/adapt_throttle.py ./run_files/
+# For monitoring the progress/ETA of the submitted chain
+cp ${MAIN_DIR}/scripts/monitor_chain.py ./run_files/
+# For resubmitting the array tasks that failed
+cp ${MAIN_DIR}/scripts/resubmit_jobs.py ./run_files/
 
 cwd=$(pwd)
 cd ./run_files
 
 
 ## Write SLURM script files for submitting each stage separately
-python write_slurmJobs.py -t $TRACK
+python write_slurmJobs.py -t $TRACK --topo-threads $CPUS_PER_TASK_TOPO
 
 
 # Sed statement below is used to edit the relevant SLURM script files
@@ -43,11 +63,6 @@ python write_slurmJobs.py -t $TRACK
 
 echo 'Editing SLURM script files'
 ## Edit SLURM files
-# Change number of OpenMP threads for topo stage
-# We havea python multiprocessing pool of resources, each of which can use OpenMP
-# The number of python multiprocessing processes is controlled by num_process4topo
-sed -i "s/OMP_NUM_THREADS=\$SLURM_CPUS_PER_TASK/OMP_NUM_THREADS=$CPUS_PER_TASK_TOPO/g" run_01_unpack_topo_reference.job
-
 # Get an email when the final step finishes
 last_job_script=$(ls run_*.job | tail -n 1)
 sed 's/--mail-type=FAIL/--mail-type=FAIL,END/' -i $last_job_script
@@ -57,7 +72,8 @@ sed 's/--mail-type=FAIL/--mail-type=FAIL,END/' -i $last_job_script
 # Add deleting scripts to SLURM files (NB need to edit them to turn off the dry run)
 # Choose what to delete by passing command line arguments
 # NB - when using slurm arrays we move the deletion to one stage later, to avoid one job deleting the files needed by another running job with a different array index
-# Replace the line '#_deletion_here' in SLURM statement
+# Replace the line '#_deletion_here <run file>' in SLURM statement, written by write_slurmJobs.py for each run file of a job
+# (a fused job has one line for each of its member run files)
 # Use the if statement to just do the deletion using the first slurm array, we don't want to repeat this from every array element
 # Need to espace '/' for sed
 # Calling with 'srun' gives us more informative logs when looking at 'sacct' output
@@ -88,25 +104,17 @@ for ((i=0;i<${#target_runfiles[@]};i++)); do
     tops_stack_opt=${tops_stack_opts[i]}
     run_file=${target_runfiles[i]}
 
-    # loop over max of 8000 pairs
-    for fext in .job .p1.job .p2.job .p3.job .p4.job .p5.job .p6.job .p7.job .p8.job
+    # loop over the jobs running this run file: the job and its .pN.job parts / .cN.job memory classes, or a fused job
+    for sbatch_file in $(grep -l "^#_deletion_here ${run_file}$" run_*.job)
     do
-        sbatch_file=${run_file}${fext}
-        if [ -f "${sbatch_file}" ]; then
-            # use double quote to enable variable usage
-            sed "s/#_deletion_here/##if [[ \$SLURM_ARRAY_TASK_ID -eq 1 ]]; then srun .\/clean_topsStack_files.sh ${tops_stack_opt}; fi/g" -i ${sbatch_file}
-        fi
+        # use double quote to enable variable usage
+        sed "s/^#_deletion_here ${run_file}$/##if [[ \$SLURM_ARRAY_TASK_ID -eq 1 ]]; then srun .\/clean_topsStack_files.sh ${tops_stack_opt}; fi/g" -i ${sbatch_file}
     done
 done
 
 # Reminder to not leave the script on 'dry_run'
 echo "Make sure to switch on deleting in the clean_topsStack_files.sh script"
 
-# Write header for file size log
-# fmt_fs="%-35s%-12s%-12s%-12s\\n"
-fmt_fs="%-35s%-12s%-12s%-12s%-12s\\n"
-printf "$fmt_fs" "Step"  "Step number" "Job ID" "Task ID" "Total size" > total_file_sizes.txt
-
 # Go back to process dir
 cd $cwd
 echo 'Normal finished'
@@ -33,7 +33,7 @@ isce.orbitDir           = ~/bak/aux/aux_poeorb/      #Directory with all orbit f
 isce.auxDir             = ~/bak/aux/aux_cal/         #Directory with all aux   files
 isce.startDate          = none                       #[20140825 / no], auto for none (1st date)
 isce.endDate            = none                       #[20190622 / no], auto for none (last date)
-isce.numProcess4topo    = auto                       #auto for numProcess/OMP_NUM_THREADS. Max limited by no. of CPUs per node on server
+isce.numProcess4topo    = auto                       #auto for min(numProcess/OMP_NUM_THREADS, num of reference bursts). Max limited by no. of CPUs per node on server
 isce.updateMode         = yes                        #[yes / no], auto for yes
 ## ionospheric phase estimation
 ## copy $ISCE_STACK/topsStack/ion_param.txt to the local dir to turn ON iono
@@ -7,9 +7,11 @@
 import datetime as dt
 import glob
 import os
+import re
 import subprocess
 import time
 import shutil
+import zipfile
 
 import numpy as np
 
@@ -380,6 +382,44 @@ def dload_s1_orbit(iDict):
     return
 
 
+def count_reference_bursts(slc_dir='./SLC', ref_date=None, start_date=None, swaths='1,2,3'):
+    """Count the bursts of the reference date from the SAFE annotation files (burstList count)
+    Bursts of the selected sub-swaths are summed over the frames (zip or unzipped SAFE) of the reference date.
+    Parameters: slc_dir    - str, directory of the S1*.zip / S1*.SAFE files
+                ref_date   - str, YYYYMMDD, reference date, the first date (after start_date) by default
+                start_date - str, YYYYMMDD, start date of the stack
+                swaths     - str, comma-separated sub-swath numbers
+    Returns:    num_burst  - int, number of bursts, 0 if no annotation found
+    """
+    safe_files = sorted(glob.glob(os.path.join(slc_dir, 'S1*_IW_SLC_*')))
+    safe_dates = [re.search(r'_(\d{8})T', os.path.basename(x)).group(1) for x in safe_files]
+    if not ref_date:
+        dates = sorted(set(x for x in safe_dates if not start_date or x >= start_date))
+        if not dates:
+            return 0
+        ref_date = dates[0]
+
+    swaths = [f'iw{i.strip()}' for i in str(swaths).split(',')]
+    num_burst = 0
+    for safe_file, safe_date in zip(safe_files, safe_dates):
+        if safe_date != ref_date:
+            continue
+        # one annotation per sub-swath (first polarization), e.g. annotation/s1a-iw1-slc-vv-*.xml
+        if zipfile.is_zipfile(safe_file):
+            zf = zipfile.ZipFile(safe_file)
+            names, read = zf.namelist(), lambda x: zf.read(x).decode()
+        else:
+            names = glob.glob(os.path.join(safe_file, 'annotation', '*.xml'))
+            read = lambda x: open(x).read()
+        for swath in swaths:
+            ann_files = sorted(x for x in names if re.search(rf'annotation/s1\w-{swath}-slc-\w+-[^/]*\.xml$', x))
+            if ann_files:
+                match = re.search(r'<burstList count="(\d+)"', read(ann_files[0]))
+                num_burst += int(match.group(1)) if match else 0
+    print(f'number of bursts in the reference date {ref_date}: {num_burst}')
+    return num_burst
+
+
 def prep_stack(iDict):
     """Call stack*.py to generate run_files and config folders"""
 
@@ -464,6 +504,15 @@ def prep_stack(iDict):
                 num_thread = int(os.environ.get('OMP_NUM_THREADS',1))
                 num_proc = np.floor(int(iDict['numProcess']) / num_thread).astype(int)
                 num_proc = max(num_proc, 1)    # ensure the num_proc >= 1
+                # topo runs one process per reference burst, no need for more
+                num_burst = count_reference_bursts(
+                    './SLC',
+                    ref_date=iDict['referenceDate'],
+                    start_date=iDict['startDate'],
+                    swaths=iDict['swathNum'],
+                )
+                if num_burst > 0:
+                    num_proc = min(num_proc, num_burst)
             iargs += ['--num_proc4topo', str(num_proc)]
 
         if iDict['updateMode']: